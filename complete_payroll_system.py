@@ -8,8 +8,27 @@ import calendar
 import json
 from decimal import Decimal, ROUND_HALF_UP
 import hashlib
+import base64
+import binascii
 import secrets
 from functools import wraps
+import threading
+import time
+import atexit
+import argparse
+import sys
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+
+from payroll_rules import DEDUCTION_RULES, compile_rules
+from payroll_repository import (
+    AttendanceRepository, PayrollRepository, migrate_attendance_db, ensure_rollup_tables,
+    ensure_config_version, config_version
+)
+from payslip_renderer import render_payslips
+from stats_cache import StatsCache, conditional_json
+from event_bus import EventBus, event_stream_response
 
 # LINE Bot SDK
 from linebot import LineBotApi, WebhookHandler
@@ -63,6 +82,27 @@ handler = WebhookHandler(WEBHOOK_SECRET)
 # 台灣時區設定
 TW_TZ = pytz.timezone('Asia/Taipei')
 
+# 統計 API 快取（寫入員工、考勤、請假、薪資資料後依類別失效）
+stats_cache = StatsCache(ttl=15)
+
+# 管理後台即時事件（程序內發布／訂閱，由 /api/admin/events 以 SSE 推送）
+event_bus = EventBus()
+
+def publish_stats():
+    """發布最新系統統計（有連線中的後台時才查詢）"""
+    if event_bus.has_subscribers():
+        event_bus.publish('stats', stats_cache.get('system_stats')[0])
+
+def publish_change(scope, event=None, data=None):
+    """寫入提交後清除統計快取並發布事件；發布失敗只記錄，不影響已完成的寫入"""
+    stats_cache.invalidate(scope)
+    try:
+        if event:
+            event_bus.publish(event, data)
+        publish_stats()
+    except Exception as e:
+        print(f"⚠️ 發布即時事件失敗: {e}")
+
 # 按鈕輔助類
 class ButtonHelper:
     @staticmethod
@@ -125,6 +165,45 @@ class DatabaseManager:
         """取得資料庫連接"""
         return sqlite3.connect(self.db_path)
     
+    @contextmanager
+    def session(self):
+        """取得連線，區塊結束時關閉（供資料存取層使用）"""
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+    
+    def get_settings(self, category=None):
+        """取得系統設定 {setting_key: setting_value}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if category:
+            cursor.execute('''
+                SELECT setting_key, setting_value FROM system_settings
+                WHERE setting_category = ?
+            ''', (category,))
+        else:
+            cursor.execute('SELECT setting_key, setting_value FROM system_settings')
+        
+        settings = dict(cursor.fetchall())
+        conn.close()
+        
+        return settings
+    
+    def get_insurance_brackets(self, as_of=None):
+        """取得指定日期適用的投保級距 {insurance_type: [投保薪資(遞增)]}"""
+        with self.session() as conn:
+            return PayrollRepository(self.session).get_insurance_brackets(
+                conn.cursor(), as_of or datetime.now(TW_TZ).date()
+            )
+    
+    def get_withholding_table(self, tax_year):
+        """取得適用於指定年度的扣繳稅額表（無對應年度時沿用最近的舊年度）"""
+        with self.session() as conn:
+            return PayrollRepository(self.session).get_withholding_table(conn.cursor(), tax_year)
+    
     def init_database(self):
         """初始化完整資料庫結構"""
         conn = self.get_connection()
@@ -250,6 +329,7 @@ class DatabaseManager:
                     status TEXT DEFAULT 'active',
                     created_by TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    tax_dependents INTEGER DEFAULT 0,  -- 所得稅扶養人數
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
             ''')
@@ -355,7 +435,7 @@ class DatabaseManager:
                 CREATE TABLE IF NOT EXISTS payroll_details (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     payroll_record_id INTEGER NOT NULL,
-                    item_category TEXT NOT NULL,  -- salary, allowance, deduction, bonus
+                    item_category TEXT NOT NULL,  -- salary, allowance, deduction, bonus, leave
                     item_name TEXT NOT NULL,
                     item_code TEXT,
                     amount REAL NOT NULL,
@@ -412,14 +492,196 @@ class DatabaseManager:
                     related_object_id INTEGER,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     read_at TIMESTAMP,
+                    delivery_status TEXT DEFAULT 'pending',  -- pending, sending, sent, failed
+                    claimed_at TIMESTAMP,  -- 派送程序取走（sending）的時間
+                    sent_at TIMESTAMP,
+                    attempts INTEGER DEFAULT 0,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+            
+            # 16. 投保薪資級距表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS insurance_brackets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    insurance_type TEXT NOT NULL,  -- labor, health
+                    bracket_level INTEGER NOT NULL,
+                    insured_salary REAL NOT NULL,
+                    effective_date DATE NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(insurance_type, effective_date, bracket_level)
+                )
+            ''')
+            
+            # 17. 扣繳稅額表年度參數
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS withholding_tax_years (
+                    tax_year INTEGER PRIMARY KEY,
+                    exemption REAL NOT NULL,  -- 每人免稅額
+                    standard_deduction REAL NOT NULL,  -- 標準扣除額
+                    salary_deduction REAL NOT NULL,  -- 薪資所得特別扣除額
+                    min_withholding REAL DEFAULT 2000,  -- 每月最低扣繳稅額
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # 18. 扣繳稅額累進級距
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS withholding_tax_brackets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tax_year INTEGER NOT NULL,
+                    income_floor REAL NOT NULL,  -- 全年綜合所得淨額級距起點
+                    tax_rate REAL NOT NULL,
+                    FOREIGN KEY (tax_year) REFERENCES withholding_tax_years (tax_year),
+                    UNIQUE(tax_year, income_floor)
+                )
+            ''')
+            
+            # 19. 行事曆特殊日期（國定假日、補班日、公司休假）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS calendar_days (
+                    calendar_date DATE PRIMARY KEY,
+                    day_type TEXT NOT NULL,  -- holiday, workday, closure
+                    day_name TEXT,
+                    created_by TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # 20. 請假分錄（已核准請假展開為每日時數）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leave_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    application_id INTEGER NOT NULL,
+                    user_id TEXT NOT NULL,
+                    leave_date DATE NOT NULL,
+                    leave_type_id INTEGER NOT NULL,
+                    hours REAL NOT NULL,
+                    is_paid BOOLEAN DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (application_id) REFERENCES leave_applications (id),
+                    UNIQUE(application_id, leave_date)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_leave_ledger_user_date
+                ON leave_ledger (user_id, leave_date)
+            ''')
+            
+            # 21. 請假額度計數（每人每假別每年度）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leave_balances (
+                    user_id TEXT NOT NULL,
+                    leave_type_id INTEGER NOT NULL,
+                    leave_year INTEGER NOT NULL,  -- 依每日請假分錄的日期歸屬年度
+                    pending_hours REAL DEFAULT 0,  -- 待審核時數
+                    used_hours REAL DEFAULT 0,  -- 已核准時數
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, leave_type_id, leave_year),
+                    FOREIGN KEY (leave_type_id) REFERENCES leave_types (id)
+                )
+            ''')
+            
+            # 22. 員工薪資轉帳帳戶
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS employee_bank_accounts (
+                    user_id TEXT PRIMARY KEY,
+                    bank_code TEXT NOT NULL,  -- 銀行代碼3碼 + 分行代碼4碼
+                    account_number TEXT NOT NULL,
+                    account_name TEXT,  -- 戶名（未填時使用員工姓名）
+                    updated_by TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+            
+            # 23. 薪資轉帳批次
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payment_batches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    period_year INTEGER NOT NULL,
+                    period_month INTEGER NOT NULL,
+                    payment_date DATE NOT NULL,
+                    record_count INTEGER NOT NULL,
+                    total_amount INTEGER NOT NULL,
+                    account_hash INTEGER NOT NULL,  -- 帳號檢查總和
+                    file_sha256 TEXT NOT NULL,
+                    created_by TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # 24. 管理 API 金鑰（只存雜湊，由 LINE 指令核發；API 以金鑰辨識呼叫者）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_tokens (
+                    token_hash TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
             ''')
             
+            # 考勤查詢索引（依用戶、日期、時間排序讀取打卡記錄）
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_attendance_user_date
+                ON attendance_records (user_id, record_date, record_time)
+            ''')
+            
+            # 請假區間查詢索引（重疊檢查）
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_leave_user_dates
+                ON leave_applications (user_id, start_date, end_date)
+            ''')
+            
+            # 審核佇列分頁索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_leave_status_date
+                ON leave_applications (status, application_date, id)
+            ''')
+            
+            # 加班申請查詢索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_overtime_user_date
+                ON overtime_applications (user_id, overtime_date)
+            ''')
+            
+            # 薪資查詢索引（依月份讀取記錄、依記錄讀取明細）
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_payroll_records_period
+                ON payroll_records (period_year, period_month)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_payroll_details_record
+                ON payroll_details (payroll_record_id)
+            ''')
+            
+            # 既有資料庫補上新增欄位
+            self._ensure_column(cursor, 'salary_deductions', 'tax_dependents', 'INTEGER DEFAULT 0')
+            self._ensure_column(cursor, 'notifications', 'delivery_status', "TEXT DEFAULT 'pending'")
+            self._ensure_column(cursor, 'notifications', 'sent_at', 'TIMESTAMP')
+            self._ensure_column(cursor, 'notifications', 'claimed_at', 'TIMESTAMP')
+            self._ensure_column(cursor, 'notifications', 'attempts', 'INTEGER DEFAULT 0')
+            
+            # 通知派送佇列索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_notifications_delivery
+                ON notifications (delivery_status, priority, id)
+            ''')
+            
             # 插入預設數據
             self._insert_default_data(cursor)
             
+            # 歷史查詢視圖（熱資料表 + 年度歸檔表）
+            ArchiveManager(self).rebuild_views(cursor)
+            
             conn.commit()
+            
+            # 年度薪資彙總（每人每年一列）
+            ensure_rollup_tables(conn)
+            
+            # 計薪設定版本（設定或級距異動時通知計算器重新載入）
+            ensure_config_version(conn)
             print("✅ 資料庫初始化完成")
             
         except Exception as e:
@@ -428,6 +690,12 @@ class DatabaseManager:
         finally:
             conn.close()
     
+    def _ensure_column(self, cursor, table, column, definition):
+        """舊版資料庫缺少欄位時以 ALTER TABLE 補上"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    
     def _insert_default_data(self, cursor):
         """插入預設數據"""
         
@@ -486,6 +754,10 @@ class DatabaseManager:
             ('attendance', 'work_days_per_month', '22', 'number', '每月標準工作天數'),
             ('attendance', 'late_threshold_minutes', '15', 'number', '遲到門檻(分鐘)'),
             ('attendance', 'overtime_threshold_hours', '8', 'number', '加班門檻時數'),
+            ('attendance', 'night_shift_start', '22:00', 'string', '夜班時段起始'),
+            ('attendance', 'night_shift_end', '06:00', 'string', '夜班時段結束'),
+            ('attendance', 'max_shift_hours', '16', 'number', '單一班別最長時數'),
+            ('attendance', 'overtime_requires_approval', '0', 'boolean', '加班須經申請核准才計薪'),
             
             # 薪資設定
             ('payroll', 'minimum_wage_hourly', '183', 'number', '基本工資(時薪)'),
@@ -508,7 +780,13 @@ class DatabaseManager:
             ('system', 'company_name', '範例公司股份有限公司', 'string', '公司名稱'),
             ('system', 'company_address', '台北市信義區', 'string', '公司地址'),
             ('system', 'payroll_cutoff_day', '25', 'number', '薪資計算截止日'),
-            ('system', 'payday', '5', 'number', '發薪日')
+            ('system', 'payday', '5', 'number', '發薪日'),
+            
+            # 薪資轉帳設定
+            ('payment', 'company_id', '', 'string', '公司統一編號'),
+            ('payment', 'company_bank_code', '', 'string', '公司轉帳銀行代碼(7碼)'),
+            ('payment', 'company_account', '', 'string', '公司轉出帳號'),
+            ('payment', 'file_encoding', 'cp950', 'string', '轉帳檔文字編碼')
         ]
         
         for category, key, value, type_, description in default_settings:
@@ -517,6 +795,79 @@ class DatabaseManager:
                 (setting_category, setting_key, setting_value, setting_type, description)
                 VALUES (?, ?, ?, ?, ?)
             ''', (category, key, value, type_, description))
+        
+        # 預設投保薪資級距 (2024年度)
+        labor_brackets = [
+            27470, 27600, 28800, 30300, 31800, 33300, 34800, 36300, 38200,
+            40100, 42000, 43900, 45800
+        ]
+        health_brackets = labor_brackets + [
+            48200, 50600, 53000, 55400, 57800, 60800, 63800, 66800, 69800,
+            72800, 76500, 80200, 83900, 87600, 92100, 96600, 101100, 105600,
+            110100, 115500, 120900, 126300, 131700, 137100, 142500, 147900,
+            150000, 156400, 162800, 169200, 175600, 182000, 189500, 197000,
+            204500, 212000, 219500
+        ]
+        
+        for insurance_type, brackets in (('labor', labor_brackets), ('health', health_brackets)):
+            for level, insured_salary in enumerate(brackets, 1):
+                cursor.execute('''
+                    INSERT OR IGNORE INTO insurance_brackets
+                    (insurance_type, bracket_level, insured_salary, effective_date)
+                    VALUES (?, ?, ?, '2024-01-01')
+                ''', (insurance_type, level, insured_salary))
+        
+        # 預設行事曆：國定假日與補班日
+        default_calendar_days = [
+            ('2024-01-01', 'holiday', '開國紀念日'),
+            ('2024-02-08', 'holiday', '春節'), ('2024-02-09', 'holiday', '春節'),
+            ('2024-02-10', 'holiday', '春節'), ('2024-02-11', 'holiday', '春節'),
+            ('2024-02-12', 'holiday', '春節'), ('2024-02-13', 'holiday', '春節'),
+            ('2024-02-14', 'holiday', '春節'), ('2024-02-17', 'workday', '春節補班'),
+            ('2024-02-28', 'holiday', '和平紀念日'),
+            ('2024-04-04', 'holiday', '兒童節'), ('2024-04-05', 'holiday', '清明節'),
+            ('2024-05-01', 'holiday', '勞動節'),
+            ('2024-06-10', 'holiday', '端午節'),
+            ('2024-09-17', 'holiday', '中秋節'),
+            ('2024-10-10', 'holiday', '國慶日'),
+            ('2025-01-01', 'holiday', '開國紀念日'),
+            ('2025-01-27', 'holiday', '春節'), ('2025-01-28', 'holiday', '春節'),
+            ('2025-01-29', 'holiday', '春節'), ('2025-01-30', 'holiday', '春節'),
+            ('2025-01-31', 'holiday', '春節'), ('2025-02-08', 'workday', '春節補班'),
+            ('2025-02-28', 'holiday', '和平紀念日'),
+            ('2025-04-03', 'holiday', '兒童節'), ('2025-04-04', 'holiday', '清明節'),
+            ('2025-05-01', 'holiday', '勞動節'),
+            ('2025-05-30', 'holiday', '端午節'),
+            ('2025-10-06', 'holiday', '中秋節'),
+            ('2025-10-10', 'holiday', '國慶日')
+        ]
+        
+        for calendar_date, day_type, day_name in default_calendar_days:
+            cursor.execute('''
+                INSERT OR IGNORE INTO calendar_days (calendar_date, day_type, day_name)
+                VALUES (?, ?, ?)
+            ''', (calendar_date, day_type, day_name))
+        
+        # 預設扣繳稅額表 (免稅額, 標準扣除額, 薪資特別扣除額, 累進級距)
+        default_tax_years = [
+            (2023, 92000, 124000, 207000,
+             [(0, 0.05), (560000, 0.12), (1260000, 0.20), (2520000, 0.30), (4720000, 0.40)]),
+            (2024, 97000, 131000, 218000,
+             [(0, 0.05), (590000, 0.12), (1330000, 0.20), (2660000, 0.30), (4980000, 0.40)])
+        ]
+        
+        for tax_year, exemption, standard_deduction, salary_deduction, brackets in default_tax_years:
+            cursor.execute('''
+                INSERT OR IGNORE INTO withholding_tax_years
+                (tax_year, exemption, standard_deduction, salary_deduction)
+                VALUES (?, ?, ?, ?)
+            ''', (tax_year, exemption, standard_deduction, salary_deduction))
+            
+            for income_floor, tax_rate in brackets:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO withholding_tax_brackets (tax_year, income_floor, tax_rate)
+                    VALUES (?, ?, ?)
+                ''', (tax_year, income_floor, tax_rate))
 
 # 權限管理類
 class PermissionManager:
@@ -562,7 +913,39 @@ class PermissionManager:
             return True
         
         return permissions.get(permission, False)
-    
+
+    def issue_api_token(self, user_id):
+        """核發管理 API 金鑰（取代該用戶先前的金鑰），回傳明文金鑰；資料庫只存雜湊"""
+        token = secrets.token_urlsafe(32)
+
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM api_tokens WHERE user_id = ?', (user_id,))
+        cursor.execute('INSERT INTO api_tokens (token_hash, user_id) VALUES (?, ?)',
+                       (hashlib.sha256(token.encode()).hexdigest(), user_id))
+        conn.commit()
+        conn.close()
+
+        return token
+
+    def authenticate_api_token(self, token):
+        """以 API 金鑰辨識呼叫者，回傳在職用戶的 user_id；金鑰無效時回傳 None"""
+        if not token:
+            return None
+
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT t.user_id
+            FROM api_tokens t
+            JOIN users u ON t.user_id = u.user_id
+            WHERE t.token_hash = ? AND u.status = 'active'
+        ''', (hashlib.sha256(token.encode()).hexdigest(),))
+        row = cursor.fetchone()
+        conn.close()
+
+        return row[0] if row else None
+
     def assign_role(self, user_id, role_name, assigned_by):
         """指派角色給用戶"""
         conn = self.db.get_connection()
@@ -649,6 +1032,7 @@ class UserManager:
                     ''', (user_id, role[0]))
                 
                 conn.commit()
+                publish_change('users')
                 print(f"✅ 新用戶已創建: {name} ({employee_id})")
             
             conn.close()
@@ -723,97 +1107,862 @@ class UserManager:
             
             conn.commit()
             conn.close()
+            publish_change('users')
             return True
         except:
             conn.close()
             return False
 
-# 考勤管理類
-class AttendanceManager:
-    def __init__(self, db_manager, permission_manager):
+# 歷史資料歸檔
+class ArchiveManager:
+    """將已結束期間的資料移至年度歸檔表（{table}_archive_{year}），熱資料表只保留近期資料
+    
+    歷史查詢使用 {table}_all 視圖（熱資料表 UNION ALL 所有年度歸檔表），
+    SQLite 會將 WHERE 條件下推至各子表，仍可使用各表索引。
+    歸檔表沿用熱資料表的定義（含限制條件），熱資料表新增欄位時自動補到歸檔表，
+    視圖與搬移一律以熱資料表的欄位清單明列欄位。
+    """
+    
+    # 可歸檔的資料表 → (期間欄位, 歸檔表索引欄位)
+    ARCHIVABLE_TABLES = {
+        'attendance_records': ('record_date', 'user_id, record_date, record_time'),
+        'operation_logs': ('created_at', 'created_at'),
+    }
+    
+    def __init__(self, db_manager):
         self.db = db_manager
-        self.perm = permission_manager
     
-    def clock_in_out(self, user_id, action_type, location=None):
-        """上下班打卡"""
-        taiwan_time = datetime.now(TW_TZ)
-        record_date = taiwan_time.date()
+    def _check_table(self, table):
+        if table not in self.ARCHIVABLE_TABLES:
+            raise ValueError(f"不支援歸檔的資料表: {table}")
+    
+    @staticmethod
+    def _period_range(year, month=None):
+        """期間起訖 [start, end)"""
+        if month:
+            return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+        return date(year, 1, 1), date(year + 1, 1, 1)
+    
+    def list_archive_tables(self, table, cursor=None):
+        """列出資料表現有的年度歸檔表"""
+        self._check_table(table)
+        own_conn = cursor is None
+        if own_conn:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name GLOB ?
+            ORDER BY name
+        ''', (f'{table}_archive_[0-9][0-9][0-9][0-9]',))
+        names = [row[0] for row in cursor.fetchall()]
+        
+        if own_conn:
+            conn.close()
+        return names
+    
+    @staticmethod
+    def _table_columns(cursor, table):
+        """資料表欄位 [(名稱, 型別, 預設值)]"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        return [(row[1], row[2], row[4]) for row in cursor.fetchall()]
+    
+    def _create_archive_table(self, cursor, table, archive_table):
+        """以熱資料表的建表語法建立歸檔表（保留型別、主鍵與限制條件）"""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        definition = cursor.fetchone()[0].split('(', 1)[1]
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {archive_table} ({definition}')
+    
+    def _sync_archive_columns(self, cursor, table, archive_table):
+        """熱資料表新增的欄位補到歸檔表，回傳熱資料表欄位名稱清單"""
+        columns = self._table_columns(cursor, table)
+        existing = {name for name, _, _ in self._table_columns(cursor, archive_table)}
+        
+        for name, column_type, default in columns:
+            if name in existing:
+                continue
+            # ADD COLUMN 不接受 CURRENT_TIMESTAMP 等非常數預設值，此類欄位只補欄位
+            definition = f'{name} {column_type}'
+            if default is not None and not default.upper().startswith(('CURRENT_', '(')):
+                definition += f' DEFAULT {default}'
+            cursor.execute(f'ALTER TABLE {archive_table} ADD COLUMN {definition}')
+        
+        return [name for name, _, _ in columns]
+    
+    def rebuild_view(self, table, cursor):
+        """重建 {table}_all 歷史查詢視圖"""
+        self._check_table(table)
+        archives = self.list_archive_tables(table, cursor)
+        columns = [name for name, _, _ in self._table_columns(cursor, table)]
+        for archive_table in archives:
+            self._sync_archive_columns(cursor, table, archive_table)
+        
+        column_list = ', '.join(columns)
+        cursor.execute(f'DROP VIEW IF EXISTS {table}_all')
+        cursor.execute(f'CREATE VIEW {table}_all AS ' + ' UNION ALL '.join(
+            f'SELECT {column_list} FROM {source}' for source in [table] + archives
+        ))
+    
+    def rebuild_views(self, cursor):
+        """重建所有歷史查詢視圖"""
+        for table in self.ARCHIVABLE_TABLES:
+            self.rebuild_view(table, cursor)
+    
+    def archive_period(self, table, year, month=None):
+        """將指定期間移入年度歸檔表（只允許已結束的期間），回傳搬移筆數"""
+        self._check_table(table)
+        period_column, index_columns = self.ARCHIVABLE_TABLES[table]
+        start, end = self._period_range(year, month)
+        
+        if end > datetime.now(TW_TZ).date().replace(day=1):
+            raise ValueError('只能歸檔已結束的期間')
         
+        archive_table = f'{table}_archive_{year}'
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
         try:
-            # 檢查當日是否已有相同動作
-            cursor.execute('''
-                SELECT id FROM attendance_records 
-                WHERE user_id = ? AND record_date = ? AND action_type = ?
-                ORDER BY record_time DESC LIMIT 1
-            ''', (user_id, record_date, action_type))
+            # 歸檔表沿用原表定義，另建查詢索引
+            self._create_archive_table(cursor, table, archive_table)
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{archive_table} ON {archive_table} ({index_columns})')
+            column_list = ', '.join(self._sync_archive_columns(cursor, table, archive_table))
             
-            existing = cursor.fetchone()
-            
-            # 判斷狀態
-            status = self._determine_status(action_type, taiwan_time)
-            
-            cursor.execute('''
-                INSERT INTO attendance_records 
-                (user_id, record_date, action_type, record_time, taiwan_time, location, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id, record_date, action_type, 
-                taiwan_time.isoformat(), taiwan_time.strftime('%Y-%m-%d %H:%M:%S'),
-                location, status
-            ))
+            where_clause = f'{period_column} >= ? AND {period_column} < ?'
+            params = (str(start), str(end))
+            cursor.execute(f'''
+                INSERT INTO {archive_table} ({column_list})
+                SELECT {column_list} FROM {table} WHERE {where_clause}
+            ''', params)
+            moved = cursor.rowcount
+            cursor.execute(f'DELETE FROM {table} WHERE {where_clause}', params)
             
+            self.rebuild_view(table, cursor)
             conn.commit()
-            record_id = cursor.lastrowid
+            return moved
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
+    
+    def restore_period(self, table, year, month=None):
+        """將歸檔期間搬回熱資料表，回傳搬移筆數"""
+        self._check_table(table)
+        period_column, _ = self.ARCHIVABLE_TABLES[table]
+        start, end = self._period_range(year, month)
+        archive_table = f'{table}_archive_{year}'
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if archive_table not in self.list_archive_tables(table, cursor):
+                return 0
             
-            return {
-                'success': True,
-                'record_id': record_id,
-                'time': taiwan_time.strftime('%H:%M'),
-                'status': status,
-                'message': self._get_status_message(action_type, status)
-            }
+            column_list = ', '.join(self._sync_archive_columns(cursor, table, archive_table))
+            where_clause = f'{period_column} >= ? AND {period_column} < ?'
+            params = (str(start), str(end))
+            cursor.execute(f'''
+                INSERT INTO {table} ({column_list})
+                SELECT {column_list} FROM {archive_table} WHERE {where_clause}
+            ''', params)
+            moved = cursor.rowcount
+            cursor.execute(f'DELETE FROM {archive_table} WHERE {where_clause}', params)
             
-        except Exception as e:
+            # 歸檔表已清空時移除
+            cursor.execute(f'SELECT 1 FROM {archive_table} LIMIT 1')
+            if cursor.fetchone() is None:
+                cursor.execute(f'DROP TABLE {archive_table}')
+            
+            self.rebuild_view(table, cursor)
+            conn.commit()
+            return moved
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
-            return {'success': False, 'error': str(e)}
     
-    def _determine_status(self, action_type, time_obj):
-        """判斷考勤狀態"""
-        hour = time_obj.hour
-        minute = time_obj.minute
+    def get_archive_summary(self):
+        """各歸檔表筆數 {歸檔表: 筆數}"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
         
-        if action_type == 'clock_in':
-            # 上班時間判斷 (假設9:00正常上班)
-            if hour < 9 or (hour == 9 and minute <= 15):
-                return 'normal'
-            else:
-                return 'late'
-        elif action_type == 'clock_out':
-            # 下班時間判斷 (假設18:00正常下班)
-            if hour >= 18:
-                return 'normal'
-            else:
-                return 'early'
+        summary = {}
+        for table in self.ARCHIVABLE_TABLES:
+            for archive_table in self.list_archive_tables(table, cursor):
+                cursor.execute(f'SELECT COUNT(*) FROM {archive_table}')
+                summary[archive_table] = cursor.fetchone()[0]
         
-        return 'normal'
+        conn.close()
+        return summary
+
+# 操作記錄
+class AuditLogger:
+    """緩衝式操作記錄：寫入先進記憶體，由背景執行緒依筆數或時間整批寫入 operation_logs
     
-    def _get_status_message(self, action_type, status):
-        """取得狀態訊息"""
-        messages = {
-            ('clock_in', 'normal'): '正常上班',
-            ('clock_in', 'late'): '遲到',
-            ('clock_out', 'normal'): '正常下班',
-            ('clock_out', 'early'): '早退',
-            ('clock_out', 'overtime'): '加班'
-        }
-        return messages.get((action_type, status), '已記錄')
+    緩衝區有上限：資料庫無法寫入時記錄留在緩衝區重試，超過上限則捨棄最舊的記錄（計入 dropped），
+    log() 不寫入資料庫也不拋出例外，不影響已完成交易的呼叫端；
+    sync_mode 對應 SQLite synchronous（off / normal / full），決定每次寫入是否 fsync。
+    """
     
-    def get_attendance_summary(self, user_id, year, month):
-        """取得考勤統計"""
+    SYNC_MODES = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+    
+    def __init__(self, db_manager, flush_size=200, flush_interval=2.0, capacity=10000, sync_mode='normal'):
+        if sync_mode not in self.SYNC_MODES:
+            raise ValueError(f"未知的 sync_mode: {sync_mode}")
+        
+        self.db = db_manager
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.sync_mode = sync_mode
+        self._buffer = deque()
+        self.dropped = 0
+        self._buffer_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='audit-logger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def log(self, user_id, operation_type, operation_object=None, operation_details=None,
+            result='success', ip_address=None, user_agent=None):
+        """記錄一筆操作（不直接寫入資料庫）"""
+        if isinstance(operation_details, (dict, list)):
+            operation_details = json.dumps(operation_details, ensure_ascii=False, default=str)
+        
+        entry = (
+            user_id or 'system', operation_type, operation_object, operation_details,
+            ip_address, user_agent, result,
+            # 與 CURRENT_TIMESTAMP 相同採 UTC，記錄的是操作發生時間而非寫入時間
+            datetime.now(pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+        )
+        
+        with self._buffer_lock:
+            self._buffer.append(entry)
+            self._trim()
+            pending = len(self._buffer)
+        
+        if pending >= self.flush_size:
+            self._flush_event.set()
+    
+    def _trim(self):
+        """超過上限時捨棄最舊的記錄（需持有 _buffer_lock）"""
+        overflow = len(self._buffer) - self.capacity
+        if overflow <= 0:
+            return
+        for _ in range(overflow):
+            self._buffer.popleft()
+        if self.dropped == 0:
+            print(f"⚠️  操作記錄緩衝區已滿（{self.capacity} 筆），開始捨棄最舊的記錄")
+        self.dropped += overflow
+    
+    def flush(self):
+        """將緩衝區內容整批寫入，回傳寫入筆數"""
+        with self._write_lock:
+            with self._buffer_lock:
+                entries = list(self._buffer)
+                self._buffer.clear()
+            
+            if not entries:
+                return 0
+            
+            conn = None
+            try:
+                conn = self.db.get_connection()
+                conn.execute(f"PRAGMA synchronous = {self.SYNC_MODES[self.sync_mode]}")
+                conn.executemany('''
+                    INSERT INTO operation_logs
+                    (user_id, operation_type, operation_object, operation_details,
+                     ip_address, user_agent, result, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', entries)
+                conn.commit()
+            except Exception:
+                # 寫入失敗時放回緩衝區，下次重試（超過上限的最舊記錄捨棄）
+                with self._buffer_lock:
+                    self._buffer.extendleft(reversed(entries))
+                    self._trim()
+                raise
+            finally:
+                if conn is not None:
+                    conn.close()
+            
+            return len(entries)
+    
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️  操作記錄寫入失敗: {e}")
+    
+    def close(self):
+        """停止背景執行緒並寫入剩餘記錄"""
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._flush_event.set()
+        self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"⚠️  操作記錄寫入失敗: {e}")
+
+# 通知佇列
+class NotificationService:
+    """通知寫入 notifications 表（delivery_status = 'pending'），由 NotificationDispatcher 於背景派送"""
+    
+    def __init__(self, db_manager):
+        self.db = db_manager
+    
+    def enqueue(self, user_id, title, content, notification_type='info', priority=1,
+                related_object_type=None, related_object_id=None, cursor=None):
+        """新增一則待派送通知"""
+        self.enqueue_many([(user_id, title, content, notification_type, priority,
+                            related_object_type, related_object_id)], cursor)
+    
+    def enqueue_many(self, notifications, cursor=None):
+        """批次新增通知；傳入 cursor 時併入呼叫端交易，由呼叫端提交"""
+        if not notifications:
+            return
+        
+        own_conn = cursor is None
+        if own_conn:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+        
+        cursor.executemany('''
+            INSERT INTO notifications
+            (user_id, title, content, notification_type, priority, related_object_type, related_object_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', notifications)
+        
+        if own_conn:
+            conn.commit()
+            conn.close()
+
+# 通知派送
+class NotificationDispatcher:
+    """背景派送通知：依收件人合併訊息，內容相同者以 multicast 一次送出，並限制 API 呼叫頻率"""
+    
+    # LINE 單則文字上限與 multicast 收件人上限
+    MAX_TEXT_LENGTH = 5000
+    MULTICAST_LIMIT = 500
+    
+    def __init__(self, db_manager, line_api, batch_size=500, requests_per_second=10, interval=5, max_attempts=3,
+                 claim_timeout=600):
+        self.db = db_manager
+        self.line_api = line_api
+        self.batch_size = batch_size
+        self.min_call_interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        self._last_call = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """啟動背景派送執行緒"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=None):
+        """停止派送執行緒"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+    
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                # 一批送完立即接續，佇列清空後才等待下一輪
+                if self.dispatch_once() < self.batch_size:
+                    self._stop_event.wait(self.interval)
+            except Exception as e:
+                print(f"⚠️  通知派送失敗: {e}")
+                self._stop_event.wait(self.interval)
+    
+    def _throttle(self):
+        """確保 API 呼叫間隔不低於設定頻率"""
+        wait = self._last_call + self.min_call_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_call = time.monotonic()
+    
+    def _compose(self, items):
+        """將同一收件人的多則通知合併成一則文字"""
+        text = "\n\n".join(f"【{title}】\n{content}" for _, title, content in items)
+        if len(text) > self.MAX_TEXT_LENGTH:
+            text = text[:self.MAX_TEXT_LENGTH - 1] + "…"
+        return text
+    
+    def _claim_batch(self, cursor):
+        """在寫入鎖內取走一批待送通知（標記為 sending），多個派送程序不會取到同一筆"""
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        # 派送中斷（程序重啟等）而停在 sending 超過時限的通知退回待送，計一次嘗試
+        cursor.execute('''
+            UPDATE notifications
+            SET attempts = attempts + 1, claimed_at = NULL,
+                delivery_status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE delivery_status = 'sending' AND claimed_at < datetime('now', ?)
+        ''', (self.max_attempts, f'-{int(self.claim_timeout)} seconds'))
+        
+        cursor.execute('''
+            SELECT id, user_id, title, content
+            FROM notifications
+            WHERE delivery_status = 'pending'
+            ORDER BY priority DESC, id
+            LIMIT ?
+        ''', (self.batch_size,))
+        rows = cursor.fetchall()
+        
+        cursor.executemany('''
+            UPDATE notifications
+            SET delivery_status = 'sending', claimed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND delivery_status = 'pending'
+        ''', [(row[0],) for row in rows])
+        return rows
+    
+    def dispatch_once(self):
+        """派送一批待送通知，回傳處理筆數"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            rows = self._claim_batch(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            conn.close()
+            raise
+        
+        if not rows:
+            conn.close()
+            return 0
+        
+        # 依收件人分組，再將內容相同的收件人合併為一次 multicast
+        by_user = {}
+        for notification_id, user_id, title, content in rows:
+            by_user.setdefault(user_id, []).append((notification_id, title, content))
+        
+        by_text = {}
+        for user_id, items in by_user.items():
+            by_text.setdefault(self._compose(items), []).append(user_id)
+        
+        sent_ids = []
+        failed_ids = []
+        for text, user_ids in by_text.items():
+            for offset in range(0, len(user_ids), self.MULTICAST_LIMIT):
+                recipients = user_ids[offset:offset + self.MULTICAST_LIMIT]
+                notification_ids = [item[0] for user_id in recipients for item in by_user[user_id]]
+                
+                self._throttle()
+                try:
+                    if len(recipients) == 1:
+                        self.line_api.push_message(recipients[0], TextSendMessage(text=text))
+                    else:
+                        self.line_api.multicast(recipients, TextSendMessage(text=text))
+                    sent_ids.extend(notification_ids)
+                except Exception as e:
+                    print(f"⚠️  通知送出失敗 ({len(recipients)} 位收件人): {e}")
+                    failed_ids.extend(notification_ids)
+        
+        # 批次更新派送狀態；失敗達上限次數後標記為 failed
+        cursor.executemany('''
+            UPDATE notifications
+            SET delivery_status = 'sent', sent_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id = ? AND delivery_status = 'sending'
+        ''', [(notification_id,) for notification_id in sent_ids])
+        
+        cursor.executemany('''
+            UPDATE notifications
+            SET attempts = attempts + 1, claimed_at = NULL,
+                delivery_status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE id = ? AND delivery_status = 'sending'
+        ''', [(self.max_attempts, notification_id) for notification_id in failed_ids])
+        
+        conn.commit()
+        conn.close()
+        
+        return len(rows)
+
+# 打卡配對
+class PunchPairer:
+    """串流式上下班打卡配對狀態機
+    
+    依時間順序逐筆讀取打卡記錄，跨日仍可配對（例如 22:00 上班、次日 06:00 下班）。
+    只保留「未配對的上班打卡」與「尚可延長的最後一段工時」兩個狀態，
+    每位用戶的記憶體用量固定。異常情況的處理方式：
+    - 重複上班打卡：班別上限內以最早一筆為準，超過上限視為前一班漏打下班
+    - 重複下班打卡：班別上限內以最晚一筆為準
+    - 沒有對應上班的下班打卡、漏打下班：不計工時，記入 anomalies
+    
+    anomaly_dates 為 (起日, 迄日) 時，只統計打卡日期在 [起日, 迄日) 內的異常
+    （為配對跨月班別而多取的前後日打卡不重複計入）。
+    """
+    
+    def __init__(self, max_shift_hours=16, anomaly_dates=None):
+        self.max_shift = timedelta(hours=max_shift_hours)
+        self.anomaly_dates = anomaly_dates
+        self.anomalies = {
+            'missing_clock_out': 0,
+            'orphan_clock_out': 0,
+            'duplicate_clock_in': 0,
+            'duplicate_clock_out': 0
+        }
+    
+    def _anomaly(self, kind, punch_time):
+        if self.anomaly_dates and not self.anomaly_dates[0] <= punch_time.date() < self.anomaly_dates[1]:
+            return
+        self.anomalies[kind] += 1
+    
+    def pair(self, punches):
+        """punches 為依時間排序的 (action_type, datetime)，逐段產生 (上班時間, 下班時間)"""
+        open_clock_in = None
+        pending_span = None
+        
+        for action_type, punch_time in punches:
+            if action_type == 'clock_in':
+                if pending_span:
+                    yield pending_span
+                    pending_span = None
+                
+                if open_clock_in is None:
+                    open_clock_in = punch_time
+                elif punch_time - open_clock_in <= self.max_shift:
+                    self._anomaly('duplicate_clock_in', punch_time)
+                else:
+                    self._anomaly('missing_clock_out', open_clock_in)
+                    open_clock_in = punch_time
+            
+            elif action_type == 'clock_out':
+                if open_clock_in is not None:
+                    if punch_time - open_clock_in <= self.max_shift:
+                        pending_span = (open_clock_in, punch_time)
+                    else:
+                        self._anomaly('missing_clock_out', open_clock_in)
+                        self._anomaly('orphan_clock_out', punch_time)
+                    open_clock_in = None
+                elif pending_span and punch_time - pending_span[0] <= self.max_shift:
+                    self._anomaly('duplicate_clock_out', punch_time)
+                    pending_span = (pending_span[0], punch_time)
+                else:
+                    self._anomaly('orphan_clock_out', punch_time)
+        
+        if pending_span:
+            yield pending_span
+        if open_clock_in is not None:
+            self._anomaly('missing_clock_out', open_clock_in)
+
+# 工時區間計算
+class WorkIntervalEngine:
+    """以區間交集計算工時（夜班時段、跨日切分），不需逐分鐘掃描
+    
+    spans 為依起點排序且互不重疊的 (上班時間, 下班時間) 清單，
+    時段清單同樣依起點排序，整月資料以雙指標一次掃描完成。
+    """
+    
+    def __init__(self, night_start='22:00', night_end='06:00'):
+        self.night_start = datetime.strptime(night_start, '%H:%M').time()
+        self.night_end = datetime.strptime(night_end, '%H:%M').time()
+    
+    @staticmethod
+    def overlap_seconds(spans, intervals):
+        """計算每個時段與所有工作區間的重疊秒數"""
+        overlaps = [0.0] * len(intervals)
+        i = j = 0
+        
+        while i < len(spans) and j < len(intervals):
+            span_start, span_end = spans[i]
+            interval_start, interval_end = intervals[j]
+            
+            overlap = (min(span_end, interval_end) - max(span_start, interval_start)).total_seconds()
+            if overlap > 0:
+                overlaps[j] += overlap
+            
+            # 先結束的一方往前推進
+            if span_end <= interval_end:
+                i += 1
+            else:
+                j += 1
+        
+        return overlaps
+    
+    def day_intervals(self, first_date, last_date):
+        """產生 [當日 00:00, 次日 00:00) 的每日時段"""
+        days = (last_date - first_date).days + 1
+        starts = [datetime.combine(first_date + timedelta(days=n), datetime.min.time()) for n in range(days + 1)]
+        return [(starts[n], starts[n + 1]) for n in range(days)]
+    
+    def night_intervals(self, first_date, last_date):
+        """產生夜班時段，起訖跨午夜時結束於次日"""
+        crosses_midnight = self.night_end <= self.night_start
+        intervals = []
+        
+        # 從前一天開始，涵蓋自前一晚延續到第一天清晨的夜班時段
+        day = first_date - timedelta(days=1)
+        while day <= last_date:
+            end_day = day + timedelta(days=1) if crosses_midnight else day
+            intervals.append((datetime.combine(day, self.night_start), datetime.combine(end_day, self.night_end)))
+            day += timedelta(days=1)
+        
+        return intervals
+    
+    def split_by_date(self, spans):
+        """將工作區間切分到各日期 {YYYY-MM-DD: 小時}"""
+        if not spans:
+            return {}
+        
+        intervals = self.day_intervals(spans[0][0].date(), spans[-1][1].date())
+        overlaps = self.overlap_seconds(spans, intervals)
+        
+        return {
+            interval[0].strftime('%Y-%m-%d'): seconds / 3600
+            for interval, seconds in zip(intervals, overlaps) if seconds > 0
+        }
+    
+    def night_hours(self, spans):
+        """計算落在夜班時段內的總時數"""
+        if not spans:
+            return 0
+        
+        intervals = self.night_intervals(spans[0][0].date(), spans[-1][1].date())
+        return sum(self.overlap_seconds(spans, intervals)) / 3600
+
+# 工作行事曆
+class WorkCalendar:
+    """以年度為單位的日期類型索引（bytearray，一天一格），查詢為 O(1)"""
+    
+    WORKDAY = 0
+    WEEKEND = 1
+    HOLIDAY = 2
+    CLOSURE = 3
+    
+    # calendar_days.day_type → 日期類型
+    DAY_TYPES = {'holiday': HOLIDAY, 'workday': WORKDAY, 'closure': CLOSURE}
+    
+    # 日期類型 → 工時分類（公司休假日出勤以休息日計）
+    HOUR_BUCKETS = {WORKDAY: 'weekday', WEEKEND: 'weekend', HOLIDAY: 'holiday', CLOSURE: 'weekend'}
+    
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self._year_maps = {}
+        self._config_version = None
+    
+    def refresh(self):
+        """特殊日期在其他程序或實例中異動過（設定版本號改變）時清除年度索引；每次批次查詢前呼叫一次"""
+        conn = self.db.get_connection()
+        version = config_version(conn.cursor())
+        conn.close()
+        
+        if version != self._config_version:
+            self._year_maps.clear()
+            self._config_version = version
+    
+    def _build_year_map(self, year):
+        """建立年度日期類型索引：先依星期判斷，再套用資料庫中的特殊日期"""
+        first_day = date(year, 1, 1)
+        days_in_year = 366 if calendar.isleap(year) else 365
+        
+        # 1/1 的星期幾決定之後每一天的星期
+        first_weekday = first_day.weekday()
+        year_map = bytearray(
+            self.WEEKEND if (first_weekday + offset) % 7 >= 5 else self.WORKDAY
+            for offset in range(days_in_year)
+        )
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT calendar_date, day_type FROM calendar_days
+            WHERE calendar_date BETWEEN ? AND ?
+        ''', (f"{year}-01-01", f"{year}-12-31"))
+        
+        for calendar_date, day_type in cursor.fetchall():
+            if day_type not in self.DAY_TYPES:
+                continue
+            offset = (datetime.strptime(calendar_date, '%Y-%m-%d').date() - first_day).days
+            year_map[offset] = self.DAY_TYPES[day_type]
+        
+        conn.close()
+        return year_map
+    
+    def day_type(self, day):
+        """取得日期類型"""
+        if isinstance(day, str):
+            day = datetime.strptime(day[:10], '%Y-%m-%d').date()
+        
+        year_map = self._year_maps.get(day.year)
+        if year_map is None:
+            year_map = self._build_year_map(day.year)
+            self._year_maps[day.year] = year_map
+        
+        return year_map[day.timetuple().tm_yday - 1]
+    
+    def hour_bucket(self, day):
+        """取得工時分類：weekday、weekend 或 holiday"""
+        return self.HOUR_BUCKETS[self.day_type(day)]
+    
+    def set_day(self, calendar_date, day_type, day_name=None, created_by=None):
+        """新增或更新特殊日期，並使該年度索引失效"""
+        if day_type not in self.DAY_TYPES:
+            return False
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO calendar_days (calendar_date, day_type, day_name, created_by)
+            VALUES (?, ?, ?, ?)
+        ''', (str(calendar_date), day_type, day_name, created_by))
+        
+        conn.commit()
+        conn.close()
+        
+        self.invalidate(int(str(calendar_date)[:4]))
+        return True
+    
+    def get_special_days(self, year):
+        """取得年度特殊日期列表"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT calendar_date, day_type, day_name FROM calendar_days
+            WHERE calendar_date BETWEEN ? AND ?
+            ORDER BY calendar_date
+        ''', (f"{year}-01-01", f"{year}-12-31"))
+        
+        days = cursor.fetchall()
+        conn.close()
+        
+        return [{'date': d[0], 'day_type': d[1], 'name': d[2]} for d in days]
+    
+    def invalidate(self, year=None):
+        """清除年度索引（year 為 None 時全部清除）"""
+        if year is None:
+            self._year_maps.clear()
+        else:
+            self._year_maps.pop(year, None)
+
+# 考勤管理類
+class AttendanceManager:
+    def __init__(self, db_manager, permission_manager, work_calendar=None, notifier=None, audit_logger=None):
+        self.db = db_manager
+        self.perm = permission_manager
+        self.notifier = notifier or NotificationService(db_manager)
+        self.audit = audit_logger
+        self.calendar = work_calendar or WorkCalendar(db_manager)
+        self.repo = AttendanceRepository(db_manager.session)
+        self._interval_engine = None
+    
+    def clock_in_out(self, user_id, action_type, location=None):
+        """上下班打卡"""
+        taiwan_time = datetime.now(TW_TZ)
+        record_date = taiwan_time.date()
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # 檢查當日是否已有相同動作
+            cursor.execute('''
+                SELECT id FROM attendance_records 
+                WHERE user_id = ? AND record_date = ? AND action_type = ?
+                ORDER BY record_time DESC LIMIT 1
+            ''', (user_id, record_date, action_type))
+            
+            existing = cursor.fetchone()
+            
+            # 判斷狀態
+            status = self._determine_status(action_type, taiwan_time)
+            
+            cursor.execute('''
+                INSERT INTO attendance_records 
+                (user_id, record_date, action_type, record_time, taiwan_time, location, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id, record_date, action_type, 
+                taiwan_time.isoformat(), taiwan_time.strftime('%Y-%m-%d %H:%M:%S'),
+                location, status
+            ))
+            record_id = cursor.lastrowid
+            
+            # 遲到提醒
+            if status == 'late':
+                self.notifier.enqueue(
+                    user_id, '遲到提醒',
+                    f"您今日 {taiwan_time.strftime('%H:%M')} 上班打卡，已超過上班時間",
+                    'warning', 1, 'attendance_record', record_id, cursor
+                )
+            
+            conn.commit()
+            conn.close()
+            publish_change('attendance', 'attendance', {
+                'record_id': record_id, 'user_id': user_id, 'action_type': action_type,
+                'time': taiwan_time.strftime('%H:%M'), 'status': status
+            })
+            
+            if self.audit:
+                self.audit.log(user_id, action_type, 'attendance_record',
+                               {'record_id': record_id, 'status': status, 'location': location})
+            
+            return {
+                'success': True,
+                'record_id': record_id,
+                'time': taiwan_time.strftime('%H:%M'),
+                'status': status,
+                'message': self._get_status_message(action_type, status)
+            }
+            
+        except Exception as e:
+            conn.close()
+            return {'success': False, 'error': str(e)}
+    
+    def _determine_status(self, action_type, time_obj):
+        """判斷考勤狀態"""
+        hour = time_obj.hour
+        minute = time_obj.minute
+        
+        if action_type == 'clock_in':
+            # 上班時間判斷 (假設9:00正常上班)
+            if hour < 9 or (hour == 9 and minute <= 15):
+                return 'normal'
+            else:
+                return 'late'
+        elif action_type == 'clock_out':
+            # 下班時間判斷 (假設18:00正常下班)
+            if hour >= 18:
+                return 'normal'
+            else:
+                return 'early'
+        
+        return 'normal'
+    
+    def _get_status_message(self, action_type, status):
+        """取得狀態訊息"""
+        messages = {
+            ('clock_in', 'normal'): '正常上班',
+            ('clock_in', 'late'): '遲到',
+            ('clock_out', 'normal'): '正常下班',
+            ('clock_out', 'early'): '早退',
+            ('clock_out', 'overtime'): '加班'
+        }
+        return messages.get((action_type, status), '已記錄')
+    
+    def get_attendance_summary(self, user_id, year, month):
+        """取得考勤統計"""
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
@@ -822,11 +1971,10 @@ class AttendanceManager:
                 action_type, status, COUNT(*) as count,
                 MIN(taiwan_time) as first_time,
                 MAX(taiwan_time) as last_time
-            FROM attendance_records 
-            WHERE user_id = ? AND strftime('%Y', record_date) = ? 
-            AND strftime('%m', record_date) = ?
+            FROM attendance_records_all 
+            WHERE user_id = ? AND record_date >= ? AND record_date < ?
             GROUP BY action_type, status
-        ''', (user_id, str(year), f"{month:02d}"))
+        ''', (user_id, str(date(year, month, 1)), str(date(year + month // 12, month % 12 + 1, 1))))
         
         results = cursor.fetchall()
         conn.close()
@@ -863,68 +2011,156 @@ class AttendanceManager:
         
         return summary
     
-    def calculate_work_hours(self, user_id, year, month):
-        """計算工作時數"""
+    def _get_max_shift_hours(self):
+        """取得單一班別最長時數（超過即視為漏打卡）"""
+        try:
+            return float(self.db.get_settings('attendance').get('max_shift_hours', 16))
+        except (TypeError, ValueError):
+            return 16
+    
+    def _get_interval_engine(self):
+        """取得工時區間計算器（夜班時段取自考勤設定）"""
+        if self._interval_engine is None:
+            settings = self.db.get_settings('attendance')
+            night_start = settings.get('night_shift_start', '22:00')
+            night_end = settings.get('night_shift_end', '06:00')
+            try:
+                self._interval_engine = WorkIntervalEngine(night_start, night_end)
+            except (TypeError, ValueError):
+                print(f"⚠️ 夜班時段設定格式錯誤（{night_start} ~ {night_end}），改用預設 22:00 ~ 06:00")
+                self._interval_engine = WorkIntervalEngine()
+        return self._interval_engine
+    
+    def get_approved_overtime(self, user_id, start_date, end_date):
+        """取得期間內已核准的加班申請 {YYYY-MM-DD: [(加班類型, 核准時數), ...]}"""
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT record_date, action_type, record_time
-            FROM attendance_records 
-            WHERE user_id = ? AND strftime('%Y', record_date) = ? 
-            AND strftime('%m', record_date) = ?
-            ORDER BY record_date, record_time
-        ''', (user_id, str(year), f"{month:02d}"))
+            SELECT overtime_date, overtime_type, total_hours
+            FROM overtime_applications
+            WHERE user_id = ? AND overtime_date >= ? AND overtime_date < ?
+            AND status = 'approved'
+            ORDER BY overtime_date, start_time
+        ''', (user_id, str(start_date), str(end_date)))
+        
+        approved = {}
+        for overtime_date, overtime_type, total_hours in cursor:
+            approved.setdefault(overtime_date, []).append((overtime_type, total_hours or 0))
         
-        records = cursor.fetchall()
         conn.close()
+        return approved
+
+    def calculate_work_hours(self, user_id, year, month):
+        """計算工作時數"""
+        month_start = date(year, month, 1)
+        next_month_start = date(year + month // 12, month % 12 + 1, 1)
         
-        daily_hours = {}
-        current_date = None
-        clock_in_time = None
+        # 前後各多取一天，讓跨月的夜班能完整配對；打卡時間以台灣當地時間逐筆串流配對
+        punches = self.repo.iter_punches(
+            user_id, month_start - timedelta(days=1), next_month_start, source='attendance_records_all'
+        )
+        pairer = PunchPairer(self._get_max_shift_hours(), anomaly_dates=(month_start, next_month_start))
         
-        for record_date, action_type, record_time in records:
-            if record_date != current_date:
-                current_date = record_date
-                clock_in_time = None
-            
-            time_obj = datetime.fromisoformat(record_time)
-            
-            if action_type == 'clock_in':
-                clock_in_time = time_obj
-            elif action_type == 'clock_out' and clock_in_time:
-                work_hours = (time_obj - clock_in_time).total_seconds() / 3600
-                daily_hours[record_date] = daily_hours.get(record_date, 0) + work_hours
-                clock_in_time = None
+        # 只計入上班時間落在本月的班別
+        spans = [
+            span for span in pairer.pair(punches)
+            if month_start <= span[0].date() < next_month_start
+        ]
         
+        # 以區間交集計算夜班時數
+        engine = self._get_interval_engine()
+        night_shift_hours = engine.night_hours(spans)
+        
+        # 每日標準工時與加班以班別為單位、歸屬上班日期（跨午夜的班別不在午夜切開）；
+        # 按日曆日期切分只用於判斷落在休息日、國定假日的時數
+        shift_hours = {}
+        self.calendar.refresh()
+        for span in spans:
+            buckets = shift_hours.setdefault(span[0].strftime('%Y-%m-%d'), {'weekday': 0, 'weekend': 0, 'holiday': 0})
+            for work_date, hours in engine.split_by_date([span]).items():
+                buckets[self.calendar.hour_bucket(work_date)] += hours
+        
+        daily_hours = {shift_date: sum(buckets.values()) for shift_date, buckets in shift_hours.items()}
         total_hours = sum(daily_hours.values())
-        work_days = len(daily_hours)
+        work_days = len({span[0].date() for span in spans})
+        
+        # 已核准的加班申請（一次查詢整月）
+        approved_overtime = self.get_approved_overtime(user_id, month_start, next_month_start)
+        requires_approval = self.db.get_settings('attendance').get('overtime_requires_approval') in ('1', 'true')
         
-        # 區分正常工時和加班工時
+        # 依行事曆分類：平日區分正常工時和加班工時，休息日與國定假日另計
         standard_hours_per_day = 8
         regular_hours = 0
         overtime_hours = 0
-        
-        for date, hours in daily_hours.items():
-            if hours <= standard_hours_per_day:
-                regular_hours += hours
-            else:
-                regular_hours += standard_hours_per_day
-                overtime_hours += (hours - standard_hours_per_day)
+        weekend_hours = 0
+        holiday_hours = 0
+        overtime_by_type = {'weekday': 0, 'weekend': 0, 'holiday': 0}
+        approved_overtime_hours = 0
+        unapproved_overtime_hours = 0
+        
+        for work_date, buckets in shift_hours.items():
+            regular_hours += min(buckets['weekday'], standard_hours_per_day)
+            
+            # 需核准的時數：平日超時、休息日與國定假日出勤
+            pending = {
+                'weekday': max(buckets['weekday'] - standard_hours_per_day, 0),
+                'weekend': buckets['weekend'],
+                'holiday': buckets['holiday']
+            }
+            
+            # 加班申請時數以實際打卡時數為上限，先對應同類型時數，再對應其他類型，依申請類型計費
+            for overtime_type, approved_hours in approved_overtime.get(work_date, []):
+                overtime_type = overtime_type if overtime_type in overtime_by_type else 'weekday'
+                for bucket in dict.fromkeys((overtime_type, 'weekday', 'weekend', 'holiday')):
+                    matched = min(approved_hours, pending[bucket])
+                    if matched <= 0:
+                        continue
+                    overtime_by_type[overtime_type] += matched
+                    approved_overtime_hours += matched
+                    overtime_hours += matched
+                    pending[bucket] -= matched
+                    approved_hours -= matched
+            
+            # 未申請的時數：需核准時不計薪，否則平日超時以平日加班計，休息日、國定假日以假日出勤計
+            unapproved_overtime_hours += sum(pending.values())
+            if not requires_approval:
+                overtime_by_type['weekday'] += pending['weekday']
+                overtime_hours += pending['weekday']
+                weekend_hours += pending['weekend']
+                holiday_hours += pending['holiday']
         
         return {
             'total_hours': round(total_hours, 2),
             'regular_hours': round(regular_hours, 2),
             'overtime_hours': round(overtime_hours, 2),
+            'weekday_hours': round(regular_hours + overtime_by_type['weekday'], 2),
+            'weekend_hours': round(weekend_hours, 2),
+            'holiday_hours': round(holiday_hours, 2),
+            'night_shift_hours': round(night_shift_hours, 2),
+            'overtime_by_type': {key: round(value, 2) for key, value in overtime_by_type.items()},
+            'approved_overtime_hours': round(approved_overtime_hours, 2),
+            'unapproved_overtime_hours': round(unapproved_overtime_hours, 2),
             'work_days': work_days,
-            'daily_hours': daily_hours
+            'daily_hours': daily_hours,
+            'punch_anomalies': pairer.anomalies
         }
 
 # 請假管理類
 class LeaveManager:
-    def __init__(self, db_manager, permission_manager):
+    # 請假時數以工作日的上班時段計算，每日最多 WORKDAY_HOURS 小時（含午休的 09:00-18:00 計 8 小時）
+    WORKDAY_START = '09:00'
+    WORKDAY_END = '18:00'
+    WORKDAY_HOURS = 8
+    
+    def __init__(self, db_manager, permission_manager, notifier=None, audit_logger=None, work_calendar=None):
         self.db = db_manager
         self.perm = permission_manager
+        self.notifier = notifier or NotificationService(db_manager)
+        self.audit = audit_logger
+        self.calendar = work_calendar or WorkCalendar(db_manager)
+        self._backfill_leave_ledger()
+        self._backfill_leave_balances()
     
     def apply_leave(self, user_id, leave_type_id, start_date, end_date, reason, start_time=None, end_time=None):
         """申請請假"""
@@ -932,8 +2168,31 @@ class LeaveManager:
         cursor = conn.cursor()
         
         try:
-            # 計算請假時數
-            total_hours = self._calculate_leave_hours(start_date, end_date, start_time, end_time)
+            # 計算請假時數（跨年度的請假依每日時數分別計入各年度額度）
+            hours_by_year = self._leave_hours_by_year(start_date, end_date, start_time, end_time)
+            total_hours = sum(hours_by_year.values())
+            if total_hours <= 0:
+                conn.close()
+                return {'success': False, 'error': '請假期間沒有需出勤的工作日'}
+            
+            # 寫入鎖：重疊與額度檢查到寫入申請在同一交易內，並行申請不會同時通過檢查而超用額度
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            # 檢查與既有請假、出勤是否重疊
+            conflict = self._find_leave_conflict(cursor, user_id, start_date, end_date, start_time, end_time)
+            if conflict:
+                conn.close()
+                return {'success': False, 'error': conflict}
+            
+            # 檢查年度額度（含待審核中的申請）
+            for leave_year, hours in hours_by_year.items():
+                remaining_hours = self.get_leave_balance(user_id, leave_type_id, leave_year, cursor)
+                if remaining_hours is not None and hours > remaining_hours:
+                    conn.close()
+                    return {
+                        'success': False,
+                        'error': f'{leave_year} 年假別額度不足（剩餘 {max(remaining_hours, 0):g} 小時，申請 {hours:g} 小時）'
+                    }
             
             cursor.execute('''
                 INSERT INTO leave_applications 
@@ -942,8 +2201,11 @@ class LeaveManager:
             ''', (user_id, leave_type_id, start_date, end_date, start_time, end_time, total_hours, reason))
             
             application_id = cursor.lastrowid
+            for leave_year, hours in hours_by_year.items():
+                self._adjust_leave_balance(cursor, user_id, leave_type_id, leave_year, hours, new_status='pending')
             conn.commit()
             conn.close()
+            publish_change('leave', 'leave', {'application_ids': [application_id], 'user_id': user_id, 'status': 'pending'})
             
             return {'success': True, 'application_id': application_id}
             
@@ -951,29 +2213,75 @@ class LeaveManager:
             conn.close()
             return {'success': False, 'error': str(e)}
     
-    def _calculate_leave_hours(self, start_date, end_date, start_time, end_time):
-        """計算請假時數"""
+    def _leave_window(self, start_date, end_date, start_time=None, end_time=None):
+        """請假區間換算為 [開始, 結束) 的 datetime；日假為整天"""
         if isinstance(start_date, str):
-            start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+            start_date = datetime.strptime(start_date[:10], '%Y-%m-%d').date()
         if isinstance(end_date, str):
-            end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-        
-        days = (end_date - start_date).days + 1
+            end_date = datetime.strptime(end_date[:10], '%Y-%m-%d').date()
         
         if start_time and end_time:
-            # 時假計算
             if isinstance(start_time, str):
-                start_time = datetime.strptime(start_time, '%H:%M').time()
+                start_time = datetime.strptime(start_time[:5], '%H:%M').time()
             if isinstance(end_time, str):
-                end_time = datetime.strptime(end_time, '%H:%M').time()
-            
-            start_datetime = datetime.combine(start_date, start_time)
-            end_datetime = datetime.combine(end_date, end_time)
-            
-            return (end_datetime - start_datetime).total_seconds() / 3600
-        else:
-            # 日假計算 (一天8小時)
-            return days * 8
+                end_time = datetime.strptime(end_time[:5], '%H:%M').time()
+            return datetime.combine(start_date, start_time), datetime.combine(end_date, end_time)
+        
+        return (datetime.combine(start_date, datetime.min.time()),
+                datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    
+    def _find_leave_conflict(self, cursor, user_id, start_date, end_date, start_time=None, end_time=None):
+        """檢查與既有請假或出勤記錄是否重疊，有衝突時回傳說明文字"""
+        window_start, window_end = self._leave_window(start_date, end_date, start_time, end_time)
+        first_date = window_start.strftime('%Y-%m-%d')
+        last_date = (window_end - timedelta(microseconds=1)).strftime('%Y-%m-%d')
+        
+        # 以 (user_id, start_date, end_date) 索引取出日期範圍有交集的申請，再比對時段
+        cursor.execute('''
+            SELECT id, start_date, end_date, start_time, end_time
+            FROM leave_applications
+            WHERE user_id = ? AND start_date <= ? AND end_date >= ?
+            AND status IN ('pending', 'approved')
+        ''', (user_id, last_date, first_date))
+        
+        for app_id, app_start, app_end, app_start_time, app_end_time in cursor.fetchall():
+            other_start, other_end = self._leave_window(app_start, app_end, app_start_time, app_end_time)
+            if other_start < window_end and window_start < other_end:
+                return f'與請假申請 #{app_id}（{app_start} ~ {app_end}）時間重疊'
+        
+        # 請假期間已有出勤：上下班打卡配對成班別後比對區間交集（班別涵蓋整段請假也算重疊），
+        # 前後各多取一天以配對跨日班別；補請已歸檔期間的假也要比對，因此查詢含歸檔表的視圖
+        cursor.execute('''
+            SELECT action_type, record_time
+            FROM attendance_records_all
+            WHERE user_id = ? AND record_date >= ? AND record_date <= ?
+            AND action_type IN ('clock_in', 'clock_out')
+            ORDER BY record_time, id
+        ''', (user_id, (window_start - timedelta(days=1)).strftime('%Y-%m-%d'),
+              (window_end + timedelta(days=1)).strftime('%Y-%m-%d')))
+        punches = [
+            (action_type, datetime.fromisoformat(record_time).replace(tzinfo=None))
+            for action_type, record_time in cursor.fetchall()
+        ]
+        
+        for shift_start, shift_end in PunchPairer().pair(punches):
+            if shift_start < window_end and window_start < shift_end:
+                return f'請假期間 {shift_start.strftime("%Y-%m-%d")} 已有出勤記錄（{shift_start.strftime("%H:%M")} ~ {shift_end.strftime("%H:%M")}）'
+        
+        # 尚未下班打卡的班別等未能配對的打卡，打卡時間落在請假期間內也算重疊
+        for action_type, punch_time in punches:
+            if window_start <= punch_time < window_end:
+                return f'請假期間 {punch_time.strftime("%Y-%m-%d")} 已有出勤打卡記錄'
+        
+        return None
+
+    def _leave_hours_by_year(self, start_date, end_date, start_time=None, end_time=None):
+        """依每日請假時數（與請假分錄相同）彙總各年度時數 {年度: 小時}，跨年度的請假分別計入"""
+        hours_by_year = {}
+        for leave_date, hours in self._expand_leave_days(start_date, end_date, start_time, end_time):
+            leave_year = int(leave_date[:4])
+            hours_by_year[leave_year] = hours_by_year.get(leave_year, 0) + hours
+        return hours_by_year
     
     def approve_leave(self, application_id, approved_by, approved=True, reject_reason=None):
         """核准/駁回請假"""
@@ -983,74 +2291,477 @@ class LeaveManager:
         try:
             status = 'approved' if approved else 'rejected'
             
+            # 寫入鎖：讀取原狀態到更新在同一交易內
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            cursor.execute('''
+                SELECT user_id, leave_type_id, start_date, end_date, start_time, end_time, total_hours, status
+                FROM leave_applications WHERE id = ?
+            ''', (application_id,))
+            application = cursor.fetchone()
+            # 只審核待審核的申請：已核准/駁回的申請不重寫審核時間、分錄與通知
+            if not application or application[7] != 'pending':
+                conn.close()
+                return False
+            
             cursor.execute('''
                 UPDATE leave_applications 
                 SET status = ?, approved_by = ?, approved_at = CURRENT_TIMESTAMP, reject_reason = ?
-                WHERE id = ?
+                WHERE id = ? AND status = 'pending'
             ''', (status, approved_by, reject_reason, application_id))
             
+            # 同一交易內更新請假分錄與額度計數
+            self._sync_leave_ledger(cursor, [application_id])
+            app_user_id, leave_type_id, start_date, end_date, start_time, end_time, total_hours, old_status = application
+            for leave_year, hours in self._leave_hours_by_year(start_date, end_date, start_time, end_time).items():
+                self._adjust_leave_balance(
+                    cursor, app_user_id, leave_type_id, leave_year,
+                    hours, old_status=old_status, new_status=status
+                )
+            
+            # 通知申請人
+            result_text = '已核准' if approved else '已駁回'
+            content = f"請假申請 #{application_id}（{start_date} 起，{total_hours:g}小時）{result_text}"
+            if reject_reason:
+                content += f"\n駁回原因：{reject_reason}"
+            self.notifier.enqueue(
+                app_user_id, f'請假申請{result_text}', content,
+                'success' if approved else 'warning', 2, 'leave_application', application_id, cursor
+            )
+            
             conn.commit()
             conn.close()
+            publish_change('leave', 'leave', {'application_ids': [application_id], 'user_id': app_user_id, 'status': status})
+            
+            if self.audit:
+                self.audit.log(approved_by, f'leave_{status}', 'leave_application',
+                               {'application_id': application_id, 'reject_reason': reject_reason})
             return True
             
         except:
             conn.close()
             return False
     
+    def approve_leaves(self, application_ids, approved_by, approved=True, reject_reason=None):
+        """批次核准/駁回待審核請假（單一交易），每位申請人只發一則彙總通知"""
+        status = 'approved' if approved else 'rejected'
+        application_ids = list(dict.fromkeys(int(app_id) for app_id in application_ids))
+        if not application_ids:
+            return {'success': True, 'updated': [], 'skipped': []}
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # 寫入鎖：讀取待審核狀態到更新在同一交易內，並行審核不會重複調整額度與分錄
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            placeholders = ','.join('?' * len(application_ids))
+            cursor.execute(f'''
+                SELECT id, user_id, leave_type_id, start_date, end_date, start_time, end_time, total_hours, status
+                FROM leave_applications
+                WHERE id IN ({placeholders}) AND status = 'pending'
+            ''', application_ids)
+            applications = cursor.fetchall()
+            updated_ids = [app[0] for app in applications]
+            
+            cursor.executemany('''
+                UPDATE leave_applications 
+                SET status = ?, approved_by = ?, approved_at = CURRENT_TIMESTAMP, reject_reason = ?
+                WHERE id = ? AND status = 'pending'
+            ''', [(status, approved_by, reject_reason, app_id) for app_id in updated_ids])
+            if cursor.rowcount != len(updated_ids):
+                raise RuntimeError('請假申請狀態已被變更，請重新整理後再試')
+            
+            # 請假分錄整批同步
+            self._sync_leave_ledger(cursor, updated_ids)
+            
+            # 額度計數依 (用戶, 假別, 年度) 彙總後各更新一次
+            balance_changes = {}
+            applicant_items = {}
+            for (app_id, app_user_id, leave_type_id, start_date, end_date,
+                 start_time, end_time, total_hours, old_status) in applications:
+                for leave_year, hours in self._leave_hours_by_year(start_date, end_date, start_time, end_time).items():
+                    key = (app_user_id, leave_type_id, leave_year, old_status)
+                    balance_changes[key] = balance_changes.get(key, 0) + hours
+                applicant_items.setdefault(app_user_id, []).append((app_id, start_date, end_date, total_hours))
+            
+            for (app_user_id, leave_type_id, leave_year, old_status), hours in balance_changes.items():
+                self._adjust_leave_balance(
+                    cursor, app_user_id, leave_type_id, leave_year, hours,
+                    old_status=old_status, new_status=status
+                )
+            
+            # 每位申請人一則彙總通知
+            result_text = '已核准' if approved else '已駁回'
+            notifications = []
+            for app_user_id, items in applicant_items.items():
+                lines = [f"#{app_id} {start_date} ~ {end_date}（{total_hours:g}小時）" for app_id, start_date, end_date, total_hours in items]
+                content = f"您有 {len(items)} 筆請假申請{result_text}：\n" + "\n".join(lines)
+                if reject_reason:
+                    content += f"\n駁回原因：{reject_reason}"
+                notifications.append((
+                    app_user_id, f'請假申請{result_text}', content,
+                    'success' if approved else 'warning', 2, 'leave_application', items[0][0]
+                ))
+            
+            self.notifier.enqueue_many(notifications, cursor)
+            
+            conn.commit()
+            conn.close()
+            if updated_ids:
+                publish_change('leave', 'leave', {'application_ids': updated_ids, 'status': status})
+            
+            if self.audit:
+                self.audit.log(approved_by, f'leave_bulk_{status}', 'leave_application',
+                               {'application_ids': updated_ids, 'reject_reason': reject_reason})
+            
+            updated_set = set(updated_ids)
+            skipped_ids = [app_id for app_id in application_ids if app_id not in updated_set]
+            return {'success': True, 'updated': updated_ids, 'skipped': skipped_ids}
+        
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            return {'success': False, 'error': str(e)}
+
+    # 申請狀態 → 額度計數欄位
+    BALANCE_COLUMNS = {'pending': 'pending_hours', 'approved': 'used_hours'}
+    
+    def _adjust_leave_balance(self, cursor, user_id, leave_type_id, leave_year, hours, old_status=None, new_status=None):
+        """依申請狀態變化移動額度計數（待審 → 已使用，或釋回）"""
+        cursor.execute('''
+            INSERT OR IGNORE INTO leave_balances (user_id, leave_type_id, leave_year)
+            VALUES (?, ?, ?)
+        ''', (user_id, leave_type_id, leave_year))
+        
+        for status, sign in ((old_status, -1), (new_status, 1)):
+            column = self.BALANCE_COLUMNS.get(status)
+            if column:
+                cursor.execute(f'''
+                    UPDATE leave_balances
+                    SET {column} = MAX({column} + ?, 0), updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND leave_type_id = ? AND leave_year = ?
+                ''', (sign * hours, user_id, leave_type_id, leave_year))
+    
+    def get_leave_balance(self, user_id, leave_type_id, leave_year, cursor=None):
+        """取得單一假別的剩餘額度（小時）；無上限時回傳 None"""
+        own_conn = cursor is None
+        if own_conn:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+        
+        # 額度以假別目前設定為準（假別額度調整後立即生效）
+        cursor.execute('''
+            SELECT lt.max_days_per_year,
+                   COALESCE(lb.used_hours, 0), COALESCE(lb.pending_hours, 0)
+            FROM leave_types lt
+            LEFT JOIN leave_balances lb
+                ON lb.leave_type_id = lt.id AND lb.user_id = ? AND lb.leave_year = ?
+            WHERE lt.id = ?
+        ''', (user_id, leave_year, leave_type_id))
+        result = cursor.fetchone()
+        
+        if own_conn:
+            conn.close()
+        
+        if not result or not result[0]:
+            return None
+        
+        quota_days, used_hours, pending_hours = result
+        return quota_days * 8 - used_hours - pending_hours
+    
+    def get_leave_balances(self, user_id, leave_year):
+        """取得用戶年度各假別額度 {leave_type_id: {...}}"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT lt.id, lt.max_days_per_year,
+                   COALESCE(lb.used_hours, 0), COALESCE(lb.pending_hours, 0)
+            FROM leave_types lt
+            LEFT JOIN leave_balances lb
+                ON lb.leave_type_id = lt.id AND lb.user_id = ? AND lb.leave_year = ?
+            WHERE lt.status = 'active'
+        ''', (user_id, leave_year))
+        
+        balances = {}
+        for leave_type_id, quota_days, used_hours, pending_hours in cursor.fetchall():
+            quota_hours = (quota_days or 0) * 8
+            balances[leave_type_id] = {
+                'quota_hours': quota_hours,
+                'used_hours': used_hours,
+                'pending_hours': pending_hours,
+                'remaining_hours': quota_hours - used_hours - pending_hours if quota_hours else None
+            }
+        
+        conn.close()
+        return balances
+    
+    def _backfill_leave_balances(self):
+        """額度計數表為空時，由既有申請彙總建立"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM leave_balances LIMIT 1')
+        if cursor.fetchone() is None:
+            cursor.execute('''
+                SELECT user_id, leave_type_id, start_date, end_date, start_time, end_time, status
+                FROM leave_applications
+                WHERE status IN ('pending', 'approved')
+            ''')
+            
+            # (用戶, 假別, 年度) → [待審核時數, 已核准時數]
+            balances = {}
+            for user_id, leave_type_id, start_date, end_date, start_time, end_time, status in cursor.fetchall():
+                for leave_year, hours in self._leave_hours_by_year(start_date, end_date, start_time, end_time).items():
+                    counters = balances.setdefault((user_id, leave_type_id, leave_year), [0, 0])
+                    counters[0 if status == 'pending' else 1] += hours
+            
+            cursor.executemany('''
+                INSERT INTO leave_balances (user_id, leave_type_id, leave_year, pending_hours, used_hours)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(*key, pending_hours, used_hours) for key, (pending_hours, used_hours) in balances.items()])
+            conn.commit()
+        
+        conn.close()
+
+    def _expand_leave_days(self, start_date, end_date, start_time=None, end_time=None):
+        """將請假區間展開為工作日的每日時數 [(YYYY-MM-DD, 小時), ...]
+        
+        休息日、國定假日不計；日假每天 WORKDAY_HOURS 小時。
+        跨日時假首日自開始時間、末日至結束時間，中間各日為整天，均以上班時段為限。
+        """
+        if isinstance(start_date, str):
+            start_date = datetime.strptime(start_date[:10], '%Y-%m-%d').date()
+        if isinstance(end_date, str):
+            end_date = datetime.strptime(end_date[:10], '%Y-%m-%d').date()
+        
+        workday_start = datetime.strptime(self.WORKDAY_START, '%H:%M').time()
+        workday_end = datetime.strptime(self.WORKDAY_END, '%H:%M').time()
+        
+        if start_time and end_time:
+            if isinstance(start_time, str):
+                start_time = datetime.strptime(start_time[:5], '%H:%M').time()
+            if isinstance(end_time, str):
+                end_time = datetime.strptime(end_time[:5], '%H:%M').time()
+        
+        days = []
+        self.calendar.refresh()
+        for n in range((end_date - start_date).days + 1):
+            day = start_date + timedelta(days=n)
+            if self.calendar.day_type(day) != WorkCalendar.WORKDAY:
+                continue
+            
+            if not (start_time and end_time):
+                hours = self.WORKDAY_HOURS
+            elif start_date == end_date:
+                # 單日時假：依申請時段計算
+                hours = (datetime.combine(day, end_time) - datetime.combine(day, start_time)).total_seconds() / 3600
+            else:
+                day_start = start_time if day == start_date else workday_start
+                day_end = end_time if day == end_date else workday_end
+                hours = (
+                    datetime.combine(day, min(day_end, workday_end)) - datetime.combine(day, max(day_start, workday_start))
+                ).total_seconds() / 3600
+            
+            hours = min(hours, self.WORKDAY_HOURS)
+            if hours > 0:
+                days.append((day.strftime('%Y-%m-%d'), hours))
+        
+        return days
+    
+    def _sync_leave_ledger(self, cursor, application_ids):
+        """依申請狀態同步請假分錄：已核准者展開為每日分錄，其餘清除"""
+        if not application_ids:
+            return
+        
+        placeholders = ','.join('?' * len(application_ids))
+        cursor.execute(f'DELETE FROM leave_ledger WHERE application_id IN ({placeholders})', application_ids)
+        
+        cursor.execute(f'''
+            SELECT la.id, la.user_id, la.leave_type_id, la.start_date, la.end_date,
+                   la.start_time, la.end_time, lt.is_paid
+            FROM leave_applications la
+            JOIN leave_types lt ON la.leave_type_id = lt.id
+            WHERE la.id IN ({placeholders}) AND la.status = 'approved'
+        ''', application_ids)
+        
+        entries = []
+        for app_id, user_id, leave_type_id, start_date, end_date, start_time, end_time, is_paid in cursor.fetchall():
+            for leave_date, hours in self._expand_leave_days(start_date, end_date, start_time, end_time):
+                entries.append((app_id, user_id, leave_date, leave_type_id, hours, 1 if is_paid else 0))
+        
+        cursor.executemany('''
+            INSERT INTO leave_ledger (application_id, user_id, leave_date, leave_type_id, hours, is_paid)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', entries)
+    
+    def _backfill_leave_ledger(self):
+        """請假分錄表為空時，補建既有已核准申請的分錄"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM leave_ledger LIMIT 1')
+        if cursor.fetchone() is None:
+            cursor.execute("SELECT id FROM leave_applications WHERE status = 'approved'")
+            application_ids = [row[0] for row in cursor.fetchall()]
+            self._sync_leave_ledger(cursor, application_ids)
+            conn.commit()
+        
+        conn.close()
+
+    # 請假申請查詢欄位（順序與 _format_leave_application 對應）
+    APPLICATION_COLUMNS = '''
+        la.id, la.user_id, u.name, lt.type_name, la.start_date, la.end_date,
+        la.total_hours, la.reason, la.status, la.application_date
+    '''
+    
     def get_leave_applications(self, user_id=None, status=None, limit=10):
         """取得請假申請列表"""
         conn = self.db.get_connection()
         cursor = conn.cursor()
         
-        where_conditions = []
-        params = []
+        where_conditions = []
+        params = []
+        
+        if user_id:
+            where_conditions.append("la.user_id = ?")
+            params.append(user_id)
+        
+        if status:
+            where_conditions.append("la.status = ?")
+            params.append(status)
+        
+        where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+        params.append(limit)
+        
+        cursor.execute(f'''
+            SELECT {self.APPLICATION_COLUMNS}
+            FROM leave_applications la
+            JOIN users u ON la.user_id = u.user_id
+            JOIN leave_types lt ON la.leave_type_id = lt.id
+            {where_clause}
+            ORDER BY la.application_date DESC
+            LIMIT ?
+        ''', params)
+        
+        applications = cursor.fetchall()
+        conn.close()
+        
+        return [self._format_leave_application(app) for app in applications]
+    
+    @staticmethod
+    def _encode_queue_cursor(application_date, application_id):
+        """將最後一筆的 (申請時間, id) 編碼為分頁游標"""
+        raw = f"{application_date}|{application_id}".encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+    
+    @staticmethod
+    def _decode_queue_cursor(token):
+        """解析分頁游標，格式錯誤時拋出 ValueError"""
+        try:
+            application_date, application_id = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8').rsplit('|', 1)
+            return application_date, int(application_id)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValueError('無效的分頁游標')
+    
+    def get_managed_department_ids(self, user_id):
+        """取得用戶擔任主管的部門"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT id FROM departments WHERE manager_id = ?', (user_id,))
+        department_ids = [row[0] for row in cursor.fetchall()]
         
-        if user_id:
-            where_conditions.append("la.user_id = ?")
-            params.append(user_id)
+        conn.close()
+        return department_ids
+    
+    def get_approval_queue(self, status='pending', department_id=None, manager_id=None, page_cursor=None, limit=10):
+        """以 keyset 分頁取得審核佇列（申請時間新到舊），回傳該頁與下一頁游標"""
+        limit = max(1, limit)
+        where_conditions = ["la.status = ?"]
+        params = [status]
         
-        if status:
-            where_conditions.append("la.status = ?")
-            params.append(status)
+        if department_id:
+            where_conditions.append("u.department_id = ?")
+            params.append(department_id)
         
-        where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
-        params.append(limit)
+        if manager_id:
+            where_conditions.append("u.department_id IN (SELECT id FROM departments WHERE manager_id = ?)")
+            params.append(manager_id)
+        
+        # 從上一頁最後一筆之後接續，利用 (status, application_date, id) 索引直接定位
+        if page_cursor:
+            last_date, last_id = self._decode_queue_cursor(page_cursor)
+            where_conditions.append("(la.application_date < ? OR (la.application_date = ? AND la.id < ?))")
+            params.extend([last_date, last_date, last_id])
+        
+        # 多取一筆判斷是否還有下一頁
+        params.append(limit + 1)
+        
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
         
         cursor.execute(f'''
-            SELECT la.*, u.name, lt.type_name
+            SELECT {self.APPLICATION_COLUMNS}
             FROM leave_applications la
             JOIN users u ON la.user_id = u.user_id
             JOIN leave_types lt ON la.leave_type_id = lt.id
-            {where_clause}
-            ORDER BY la.application_date DESC
+            WHERE {" AND ".join(where_conditions)}
+            ORDER BY la.application_date DESC, la.id DESC
             LIMIT ?
         ''', params)
         
-        applications = cursor.fetchall()
+        rows = cursor.fetchall()
         conn.close()
         
-        return [self._format_leave_application(app) for app in applications]
-    
+        applications = [self._format_leave_application(app) for app in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = applications[-1]
+            next_cursor = self._encode_queue_cursor(last['application_date'], last['id'])
+        
+        return {'applications': applications, 'next_cursor': next_cursor}
+
     def _format_leave_application(self, app_data):
         """格式化請假申請資料"""
         return {
             'id': app_data[0],
             'user_id': app_data[1],
-            'user_name': app_data[13],
-            'leave_type': app_data[14],
-            'start_date': app_data[3],
-            'end_date': app_data[4],
-            'total_hours': app_data[7],
-            'reason': app_data[8],
-            'status': app_data[10],
+            'user_name': app_data[2],
+            'leave_type': app_data[3],
+            'start_date': app_data[4],
+            'end_date': app_data[5],
+            'total_hours': app_data[6],
+            'reason': app_data[7],
+            'status': app_data[8],
             'application_date': app_data[9]
         }
 
 # 薪資計算引擎
 class PayrollCalculator:
-    def __init__(self, db_manager, permission_manager):
+    def __init__(self, db_manager, permission_manager, work_calendar=None, notifier=None, audit_logger=None):
         self.db = db_manager
         self.perm = permission_manager
+        self.notifier = notifier or NotificationService(db_manager)
+        self.audit = audit_logger
+        self.work_calendar = work_calendar or WorkCalendar(db_manager)
+        self.attendance_mgr = AttendanceManager(db_manager, permission_manager, self.work_calendar, self.notifier)
+        self.repo = PayrollRepository(db_manager.session)
+        self._config_version = None
+        self._settings = None
+        self._deduction_plans = {}  # 計薪月份 → 編譯後的扣款規則
+        self._withholding_tables = {}  # 稅務年度 → 扣繳稅額表（含 LRU 快取）
+    
+    def _refresh_config(self, cursor):
+        """設定、投保級距或扣繳稅額表異動過（版本號改變）時清除快取"""
+        version = config_version(cursor)
+        if version != self._config_version:
+            self._settings = None
+            self._deduction_plans = {}
+            self._withholding_tables = {}
+            self._config_version = version
     
     def calculate_monthly_payroll(self, user_id, year, month):
         """計算月薪資"""
@@ -1058,6 +2769,8 @@ class PayrollCalculator:
         cursor = conn.cursor()
         
         try:
+            self._refresh_config(cursor)
+            
             # 取得用戶薪資結構
             salary_structure = self._get_salary_structure(user_id, cursor)
             
@@ -1065,26 +2778,63 @@ class PayrollCalculator:
             deductions = self._get_deduction_settings(user_id, cursor)
             
             # 計算工時
-            attendance_mgr = AttendanceManager(self.db, self.perm)
-            work_data = attendance_mgr.calculate_work_hours(user_id, year, month)
+            work_data = self.attendance_mgr.calculate_work_hours(user_id, year, month)
+            work_data.update(self._get_leave_hours(user_id, year, month, cursor))
             
             # 計算各項薪資
             calculations = self._calculate_salary_components(salary_structure, work_data)
             
             # 計算扣款
-            deduction_details = self._calculate_deductions(calculations['gross_salary'], deductions)
+            deduction_details = self._calculate_deductions(calculations['gross_salary'], deductions, date(year, month, 1))
             
             # 計算實領薪資
             net_salary = calculations['gross_salary'] - deduction_details['total_deductions']
             
+            # 已確認或已發放的記錄不覆寫（保留發放狀態），只回傳試算結果
+            existing = self.repo.get_record(cursor, user_id, year, month)
+            if existing and existing[1] in self.repo.LOCKED_STATUSES:
+                conn.close()
+                return {
+                    'payroll_id': existing[0],
+                    'status': existing[1],
+                    'work_data': work_data,
+                    'calculations': calculations,
+                    'deduction_details': deduction_details,
+                    'net_salary': net_salary
+                }
+            
+            # 查看薪資單也會重算，只有新產生或實領金額變動時才通知
+            changed = existing is None or round(existing[2] or 0) != round(net_salary)
+            
             # 儲存薪資記錄
             payroll_id = self._save_payroll_record(user_id, year, month, work_data, calculations, deduction_details, net_salary, cursor)
             
+            # 薪資單產生通知
+            if changed:
+                self.notifier.enqueue(
+                    user_id, '薪資單已產生' if existing is None else '薪資單已更新',
+                    f"{year}年{month}月薪資單已{'產生' if existing is None else '更新'}，實領 ${int(net_salary):,}，請輸入「薪資查詢」查看明細",
+                    'info', 2, 'payroll_record', payroll_id, cursor
+                )
+            
             conn.commit()
             conn.close()
+            # 金額未變動的重算（例如查看薪資單）不發布事件，避免洗版後台動態
+            if changed:
+                publish_change('payroll', 'payroll', {
+                    'job': 'calculate', 'period': f'{year}-{month:02d}', 'user_id': user_id,
+                    'payroll_id': payroll_id, 'net_salary': net_salary
+                })
+            else:
+                stats_cache.invalidate('payroll')
+            
+            if self.audit:
+                self.audit.log(user_id, 'payroll_calculated', 'payroll_record',
+                               {'payroll_id': payroll_id, 'period': f'{year}-{month:02d}', 'net_salary': net_salary})
             
             return {
                 'payroll_id': payroll_id,
+                'status': 'draft',
                 'work_data': work_data,
                 'calculations': calculations,
                 'deduction_details': deduction_details,
@@ -1095,6 +2845,19 @@ class PayrollCalculator:
             conn.close()
             raise e
     
+    def _get_settings(self):
+        """取得系統設定（設定版本改變前只載入一次）"""
+        if self._settings is None:
+            self._settings = self.db.get_settings()
+        return self._settings
+    
+    def _get_rate_setting(self, key, default):
+        """取得數值型設定"""
+        try:
+            return float(self._get_settings().get(key, default))
+        except (TypeError, ValueError):
+            return default
+    
     def _get_salary_structure(self, user_id, cursor):
         """取得薪資結構"""
         cursor.execute('''
@@ -1109,8 +2872,8 @@ class PayrollCalculator:
             return {
                 'base_salary': result[2] or 0,
                 'hourly_rate': result[3] or 183,
-                'overtime_rate': result[4] or 1.33,
-                'holiday_rate': result[5] or 2.0,
+                'overtime_rate': result[4] or self._get_rate_setting('overtime_rate_weekday', 1.33),
+                'holiday_rate': result[5] or self._get_rate_setting('overtime_rate_holiday', 2.0),
                 'night_shift_rate': result[6] or 1.33,
                 'position_allowance': result[7] or 0,
                 'transport_allowance': result[8] or 0,
@@ -1124,8 +2887,8 @@ class PayrollCalculator:
         return {
             'base_salary': 0,
             'hourly_rate': 183,
-            'overtime_rate': 1.33,
-            'holiday_rate': 2.0,
+            'overtime_rate': self._get_rate_setting('overtime_rate_weekday', 1.33),
+            'holiday_rate': self._get_rate_setting('overtime_rate_holiday', 2.0),
             'night_shift_rate': 1.33,
             'position_allowance': 0,
             'transport_allowance': 0,
@@ -1138,7 +2901,9 @@ class PayrollCalculator:
     def _get_deduction_settings(self, user_id, cursor):
         """取得扣款設定"""
         cursor.execute('''
-            SELECT * FROM salary_deductions 
+            SELECT labor_insurance, health_insurance, unemployment_insurance, income_tax,
+                   pension, union_fee, loan_deduction, other_deductions, tax_dependents
+            FROM salary_deductions 
             WHERE user_id = ? AND status = 'active'
             ORDER BY effective_date DESC LIMIT 1
         ''', (user_id,))
@@ -1147,14 +2912,15 @@ class PayrollCalculator:
         
         if result:
             return {
-                'labor_insurance': result[2] or 0,
-                'health_insurance': result[3] or 0,
-                'unemployment_insurance': result[4] or 0,
-                'income_tax': result[5] or 0,
-                'pension': result[6] or 0,
-                'union_fee': result[7] or 0,
-                'loan_deduction': result[8] or 0,
-                'other_deductions': result[9] or 0
+                'labor_insurance': result[0] or 0,
+                'health_insurance': result[1] or 0,
+                'unemployment_insurance': result[2] or 0,
+                'income_tax': result[3] or 0,
+                'pension': result[4] or 0,
+                'union_fee': result[5] or 0,
+                'loan_deduction': result[6] or 0,
+                'other_deductions': result[7] or 0,
+                'tax_dependents': result[8] or 0
             }
         
         return {
@@ -1165,32 +2931,76 @@ class PayrollCalculator:
             'pension': 0,
             'union_fee': 0,
             'loan_deduction': 0,
-            'other_deductions': 0
+            'other_deductions': 0,
+            'tax_dependents': 0
         }
     
+    def _get_leave_hours(self, user_id, year, month, cursor):
+        """從請假分錄彙總當月請假時數（有薪 / 無薪）"""
+        month_start = date(year, month, 1)
+        next_month_start = date(year + month // 12, month % 12 + 1, 1)
+        
+        cursor.execute('''
+            SELECT COALESCE(SUM(hours), 0),
+                   COALESCE(SUM(CASE WHEN is_paid THEN hours ELSE 0 END), 0)
+            FROM leave_ledger
+            WHERE user_id = ? AND leave_date >= ? AND leave_date < ?
+        ''', (user_id, str(month_start), str(next_month_start)))
+        
+        leave_hours, paid_leave_hours = cursor.fetchone()
+        return {
+            'leave_hours': round(leave_hours, 2),
+            'paid_leave_hours': round(paid_leave_hours, 2),
+            'unpaid_leave_hours': round(leave_hours - paid_leave_hours, 2)
+        }
+
     def _calculate_salary_components(self, salary_structure, work_data):
         """計算薪資組成"""
         calculations = {}
         
         # 基本薪資
         if salary_structure['base_salary'] > 0:
-            # 月薪制
-            base_salary = salary_structure['base_salary']
+            # 月薪制：無薪假依時薪扣除
+            leave_deduction = work_data.get('unpaid_leave_hours', 0) * salary_structure['hourly_rate']
+            leave_deduction = min(leave_deduction, salary_structure['base_salary'])
+            base_salary = salary_structure['base_salary'] - leave_deduction
         else:
-            # 時薪制
-            base_salary = work_data['regular_hours'] * salary_structure['hourly_rate']
+            # 時薪制：有薪假依時薪計入
+            leave_deduction = 0
+            base_salary = (
+                work_data['regular_hours'] + work_data.get('paid_leave_hours', 0)
+            ) * salary_structure['hourly_rate']
         
         calculations['base_salary'] = round(base_salary, 0)
+        calculations['leave_deduction'] = round(leave_deduction, 0)
         
-        # 加班費
-        overtime_pay = work_data['overtime_hours'] * salary_structure['hourly_rate'] * salary_structure['overtime_rate']
+        # 加班費：依加班類型套用費率（平日依個人加班費率，國定假日依個人假日費率）
+        overtime_rates = {
+            'weekday': salary_structure['overtime_rate'],
+            'weekend': self._get_rate_setting('overtime_rate_weekend', 1.67),
+            'holiday': salary_structure['holiday_rate']
+        }
+        overtime_by_type = work_data.get('overtime_by_type') or {'weekday': work_data['overtime_hours']}
+        overtime_pay = sum(
+            hours * salary_structure['hourly_rate'] * overtime_rates[overtime_type]
+            for overtime_type, hours in overtime_by_type.items()
+        )
         calculations['overtime_pay'] = round(overtime_pay, 0)
         
-        # 假日加班費 (暫時為0，可後續擴充)
-        calculations['holiday_pay'] = 0
+        # 假日出勤工資：休息日依 overtime_rate_weekend，國定假日依個人假日費率
+        holiday_pay = (
+            work_data.get('weekend_hours', 0) * salary_structure['hourly_rate'] *
+            self._get_rate_setting('overtime_rate_weekend', 1.67) +
+            work_data.get('holiday_hours', 0) * salary_structure['hourly_rate'] * salary_structure['holiday_rate']
+        )
+        calculations['holiday_pay'] = round(holiday_pay, 0)
         
-        # 夜班津貼 (暫時為0，可後續擴充)
-        calculations['night_shift_pay'] = 0
+        # 夜班津貼：夜班時數已計入工時，另加發 (夜班費率 - 1) 倍時薪
+        night_shift_pay = (
+            work_data.get('night_shift_hours', 0) * salary_structure['hourly_rate'] *
+            max(salary_structure['night_shift_rate'] - 1, 0)
+        )
+        calculations['night_shift_pay'] = round(night_shift_pay, 0)
         
         # 各項津貼
         total_allowances = (
@@ -1215,86 +3025,357 @@ class PayrollCalculator:
         
         return calculations
     
-    def _calculate_deductions(self, gross_salary, deductions):
+    def _get_deduction_plan(self, period_start=None):
+        """取得編譯後的扣款規則（設定版本改變前每個計薪月份只編譯一次）"""
+        period_start = period_start or datetime.now(TW_TZ).date().replace(day=1)
+        plan = self._deduction_plans.get(period_start)
+        if plan is None:
+            tables = self.db.get_insurance_brackets(period_start)
+            withholding_table = self._get_withholding_table(period_start.year)
+            if withholding_table:
+                tables['withholding'] = withholding_table
+            
+            plan = compile_rules(DEDUCTION_RULES, self._get_settings(), tables)
+            self._deduction_plans[period_start] = plan
+        return plan
+    
+    def _get_withholding_table(self, tax_year):
+        """取得扣繳稅額表（同一稅務年度共用查表快取）"""
+        if tax_year not in self._withholding_tables:
+            self._withholding_tables[tax_year] = self.db.get_withholding_table(tax_year)
+        return self._withholding_tables[tax_year]
+    
+    def _calculate_deductions(self, gross_salary, deductions, period_start=None):
         """計算扣款項目"""
-        details = {}
+        # 扣款設定不為 0 時使用設定值，否則依規則自動計算（勞健保以級距二分搜尋）
+        plan = self._get_deduction_plan(period_start)
+        return plan.evaluate(dict(deductions, gross_salary=gross_salary))
+    
+    def _save_payroll_record(self, user_id, year, month, work_data, calculations, deduction_details, net_salary, cursor):
+        """儲存薪資記錄"""
+        # 重算時沿用原記錄 id（明細與統計彙總以記錄 id 對應），狀態回到草稿
+        payroll_id = self.repo.save_record(cursor, user_id, year, month, {
+            'work_days': work_data['work_days'],
+            'total_work_hours': work_data['total_hours'],
+            'regular_hours': work_data['regular_hours'],
+            'overtime_hours': work_data['overtime_hours'],
+            'holiday_hours': work_data.get('weekend_hours', 0) + work_data.get('holiday_hours', 0),
+            'night_shift_hours': work_data.get('night_shift_hours', 0),
+            'leave_hours': work_data.get('leave_hours', 0),
+            'base_salary': calculations['base_salary'],
+            'overtime_pay': calculations['overtime_pay'],
+            'holiday_pay': calculations['holiday_pay'],
+            'night_shift_pay': calculations['night_shift_pay'],
+            'total_allowances': calculations['total_allowances'],
+            'gross_salary': calculations['gross_salary'],
+            'total_deductions': deduction_details['total_deductions'],
+            'net_salary': net_salary,
+            'status': 'draft'
+        })
         
-        # 如果沒有設定具體扣款，則自動計算
-        if deductions['labor_insurance'] == 0:
-            details['labor_insurance'] = round(gross_salary * 0.105 * 0.2, 0)  # 員工負擔20%
-        else:
-            details['labor_insurance'] = deductions['labor_insurance']
+        # 以新的薪資明細取代舊明細；扣款明細逐條規則產生，合計與 total_deductions 一致
+        details = [
+            ('salary', '基本薪資', calculations['base_salary']),
+            ('salary', '加班費', calculations['overtime_pay']),
+            ('salary', '假日出勤工資', calculations['holiday_pay']),
+            ('salary', '夜班津貼', calculations['night_shift_pay']),
+            ('leave', '無薪假扣薪', calculations.get('leave_deduction', 0)),
+            ('allowance', '各項津貼', calculations['total_allowances'])
+        ] + [
+            ('deduction', rule['label'], deduction_details.get(rule['item'], 0))
+            for rule in DEDUCTION_RULES
+        ]
+        self.repo.replace_details(cursor, payroll_id, details)
+        self.repo.refresh_year_rollup(cursor, user_id, year)
         
-        if deductions['health_insurance'] == 0:
-            details['health_insurance'] = round(gross_salary * 0.0517 * 0.3, 0)  # 員工負擔30%
-        else:
-            details['health_insurance'] = deductions['health_insurance']
+        return payroll_id
+
+# 薪資轉帳批次檔
+class PaymentBatchGenerator:
+    """發薪日轉帳批次檔產生器（固定長度格式）
+    
+    檔案由表頭 H、明細 D、表尾 T 三種記錄組成，每列 RECORD_WIDTH 位元組、CRLF 結尾，
+    中文欄位依銀行要求以 file_encoding（預設 cp950）編碼後按位元組補齊。
+    已確認（confirmed）且有轉帳帳戶的薪資記錄以 fetchmany 分批讀取、逐列寫出，
+    全部寫完後以一個 UPDATE 標記為已發放；整個過程在同一個寫入交易內，
+    讀取與標記的是同一批記錄。表尾附筆數、總金額與帳號檢查總和，另回傳檔案 SHA-256。
+    """
+    
+    RECORD_WIDTH = 120
+    BANK_CODE_WIDTH = 7  # 銀行代碼3碼 + 分行代碼4碼
+    ACCOUNT_WIDTH = 16
+    
+    # 轉帳記錄條件（讀取與標記共用）
+    PAYABLE_CONDITION = '''
+        pr.period_year = ? AND pr.period_month = ? AND pr.status = 'confirmed'
+        AND pr.net_salary > 0
+    '''
+    
+    def __init__(self, db_manager, audit_logger=None, chunk_size=1000):
+        self.db = db_manager
+        self.audit = audit_logger
+        self.chunk_size = chunk_size
+    
+    def _fixed(self, value, width, encoding, numeric=False, truncate=False):
+        """轉為固定位元組寬度：數字靠右補 0，文字靠左補空白
+        
+        超過欄位寬度時拋出 ValueError；只有 truncate 的欄位（戶名等）截斷，且不切開中文字。
+        """
+        if numeric:
+            text = str(int(value or 0)).rjust(width, '0')
+            if len(text) > width:
+                raise ValueError(f"數值 {value} 超過欄位寬度 {width}")
+            return text.encode('ascii')
+        
+        data = str(value or '').encode(encoding, errors='replace')
+        if len(data) > width:
+            if not truncate:
+                raise ValueError(f"欄位值 {value} 超過欄位寬度 {width}")
+            data = data[:width].decode(encoding, errors='ignore').encode(encoding)
+        return data.ljust(width, b' ')
+    
+    def _account_problem(self, bank_code, account_number):
+        """檢查轉帳帳戶，有問題時回傳原因（與標記發放時的 GLOB 條件一致）
         
-        if deductions['unemployment_insurance'] == 0:
-            details['unemployment_insurance'] = round(gross_salary * 0.01 * 0.2, 0)  # 員工負擔20%
-        else:
-            details['unemployment_insurance'] = deductions['unemployment_insurance']
+        銀行代碼須為 BANK_CODE_WIDTH 位 ASCII 數字，帳號須為不超過欄位寬度的 ASCII 數字；
+        不符者不寫入檔案，避免截斷或補齊後轉入錯誤的分行或帳戶。
+        """
+        if not bank_code and not account_number:
+            return '缺少轉帳帳戶'
         
-        if deductions['pension'] == 0:
-            details['pension'] = round(gross_salary * 0.06, 0)  # 6%提撥
-        else:
-            details['pension'] = deductions['pension']
+        bank_code = str(bank_code or '')
+        if not (bank_code.isascii() and bank_code.isdigit() and len(bank_code) == self.BANK_CODE_WIDTH):
+            return f'銀行代碼須為 {self.BANK_CODE_WIDTH} 位數字'
         
-        # 所得稅簡化計算
-        if deductions['income_tax'] == 0 and gross_salary > 40000:
-            details['income_tax'] = round((gross_salary - 40000) * 0.05, 0)
-        else:
-            details['income_tax'] = deductions['income_tax']
+        account_number = str(account_number or '')
+        if not (account_number.isascii() and account_number.isdigit() and len(account_number) <= self.ACCOUNT_WIDTH):
+            return f'帳號須為 {self.ACCOUNT_WIDTH} 位以內的數字'
         
-        details['union_fee'] = deductions['union_fee']
-        details['loan_deduction'] = deductions['loan_deduction']
-        details['other_deductions'] = deductions['other_deductions']
+        return None
+    
+    def _record(self, fields, encoding):
+        line = b''.join(self._fixed(value, width, encoding, *options) for value, width, *options in fields)
+        return line.ljust(self.RECORD_WIDTH, b' ') + b'\r\n'
+    
+    def generate(self, year, month, output, paid_by=None, payment_date=None, dry_run=False):
+        """產生當月轉帳批次檔寫入 output（二進位檔案物件），回傳批次摘要
+        
+        dry_run 時只產生檔案與摘要，不標記發放也不記錄批次。
+        缺少轉帳帳戶或帳戶格式錯誤的記錄不寫入檔案，連同原因列於 missing_accounts 供人事補齊。
+        """
+        settings = self.db.get_settings('payment')
+        company_name = self.db.get_settings('system').get('company_name', '')
+        encoding = settings.get('file_encoding', 'cp950')
+        payment_date = payment_date or date.today()
+        checksum = hashlib.sha256()
+        
+        def write(line):
+            output.write(line)
+            checksum.update(line)
         
-        details['total_deductions'] = sum(details.values())
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
         
-        return details
-    
-    def _save_payroll_record(self, user_id, year, month, work_data, calculations, deduction_details, net_salary, cursor):
-        """儲存薪資記錄"""
-        cursor.execute('''
-            INSERT OR REPLACE INTO payroll_records (
-                user_id, period_year, period_month, work_days, total_work_hours,
-                regular_hours, overtime_hours, base_salary, overtime_pay,
-                total_allowances, gross_salary, total_deductions, net_salary
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id, year, month, work_data['work_days'], work_data['total_hours'],
-            work_data['regular_hours'], work_data['overtime_hours'],
-            calculations['base_salary'], calculations['overtime_pay'],
-            calculations['total_allowances'], calculations['gross_salary'],
-            deduction_details['total_deductions'], net_salary
-        ))
+        try:
+            # 寫入鎖：產生檔案期間不會有其他程序變更待發放記錄
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            write(self._record([
+                ('H', 1, False),
+                (settings.get('company_id', ''), 10, False),
+                (settings.get('company_bank_code', ''), 7, False),
+                (settings.get('company_account', ''), self.ACCOUNT_WIDTH, True),
+                (payment_date.strftime('%Y%m%d'), 8, False),
+                (f"{year}{month:02d}", 6, False),
+                (company_name, 40, False, True)
+            ], encoding))
+            
+            cursor.execute(f'''
+                SELECT pr.user_id, u.employee_id, u.name, ba.bank_code, ba.account_number,
+                       ba.account_name, pr.net_salary
+                FROM payroll_records pr
+                JOIN users u ON u.user_id = pr.user_id
+                LEFT JOIN employee_bank_accounts ba ON ba.user_id = pr.user_id
+                WHERE {self.PAYABLE_CONDITION}
+                ORDER BY pr.id
+            ''', (year, month))
+            
+            record_count = 0
+            total_amount = 0
+            account_hash = 0
+            missing_accounts = []
+            
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                
+                if not dry_run:
+                    event_bus.publish('payroll', {
+                        'job': 'payment_batch', 'period': f"{year}-{month:02d}",
+                        'processed': record_count + len(missing_accounts)
+                    })
+                
+                for user_id, employee_id, name, bank_code, account_number, account_name, net_salary in rows:
+                    problem = self._account_problem(bank_code, account_number)
+                    if problem:
+                        missing_accounts.append({'user_id': user_id, 'name': name, 'reason': problem})
+                        continue
+                    
+                    amount = int(Decimal(str(net_salary)).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+                    record_count += 1
+                    total_amount += amount
+                    account_hash = (account_hash + int(account_number)) % 10 ** 16
+                    
+                    write(self._record([
+                        ('D', 1, False),
+                        (record_count, 6, True),
+                        (bank_code, 7, False),
+                        (account_number, self.ACCOUNT_WIDTH, True),
+                        (amount, 13, True),
+                        (employee_id or user_id[-10:], 10, False, True),
+                        (account_name or name, 40, False, True)
+                    ], encoding))
+            
+            write(self._record([
+                ('T', 1, False),
+                (record_count, 8, True),
+                (total_amount, 15, True),
+                (account_hash, 16, True)
+            ], encoding))
+            
+            summary = {
+                'period': f"{year}-{month:02d}",
+                'payment_date': str(payment_date),
+                'record_count': record_count,
+                'total_amount': total_amount,
+                'account_hash': account_hash,
+                'sha256': checksum.hexdigest(),
+                'missing_accounts': missing_accounts,
+                'dry_run': dry_run
+            }
+            
+            if dry_run or record_count == 0:
+                conn.rollback()
+                return summary
+            
+            # 一次標記整批記錄為已發放（條件與讀取相同，缺帳戶者除外）
+            cursor.execute(f'''
+                UPDATE payroll_records AS pr SET
+                    status = 'paid', paid_by = ?, paid_at = CURRENT_TIMESTAMP, payment_method = 'bank_transfer'
+                WHERE {self.PAYABLE_CONDITION}
+                AND EXISTS (
+                    SELECT 1 FROM employee_bank_accounts ba
+                    WHERE ba.user_id = pr.user_id
+                    AND ba.bank_code NOT GLOB '*[^0-9]*' AND length(ba.bank_code) = ?
+                    AND ba.account_number GLOB '[0-9]*'
+                    AND ba.account_number NOT GLOB '*[^0-9]*' AND length(ba.account_number) <= ?
+                )
+            ''', (paid_by, year, month, self.BANK_CODE_WIDTH, self.ACCOUNT_WIDTH))
+            
+            if cursor.rowcount != record_count:
+                raise RuntimeError(f"標記筆數 {cursor.rowcount} 與檔案筆數 {record_count} 不符")
+            
+            cursor.execute('''
+                INSERT INTO payment_batches
+                (period_year, period_month, payment_date, record_count, total_amount, account_hash, file_sha256, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (year, month, str(payment_date), record_count, total_amount, account_hash, summary['sha256'], paid_by))
+            summary['batch_id'] = cursor.lastrowid
+            
+            # 提交前先送出緩衝區內容，提交後不再有寫檔失敗的可能
+            output.flush()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        payroll_id = cursor.lastrowid
+        # 記錄已標記發放，之後的通知不得再拋出例外（呼叫端會因例外捨棄轉帳檔）
+        publish_change('payroll', 'payroll', {
+            'job': 'payment_batch', 'period': summary['period'], 'done': True,
+            'record_count': record_count, 'total_amount': total_amount
+        })
         
-        # 清除舊的薪資明細
-        cursor.execute('DELETE FROM payroll_details WHERE payroll_record_id = ?', (payroll_id,))
+        if self.audit:
+            self.audit.log(paid_by, 'payment_batch', 'payroll_records', {
+                'batch_id': summary['batch_id'], 'period': summary['period'],
+                'record_count': record_count, 'total_amount': total_amount
+            })
         
-        # 新增薪資明細
-        details = [
-            ('salary', '基本薪資', calculations['base_salary']),
-            ('salary', '加班費', calculations['overtime_pay']),
-            ('allowance', '各項津貼', calculations['total_allowances']),
-            ('deduction', '勞保費', deduction_details['labor_insurance']),
-            ('deduction', '健保費', deduction_details['health_insurance']),
-            ('deduction', '就業保險', deduction_details['unemployment_insurance']),
-            ('deduction', '退休金', deduction_details['pension']),
-            ('deduction', '所得稅', deduction_details['income_tax'])
-        ]
+        return summary
+
+# 薪資單批次匯出
+class PayslipArchive:
+    """整月薪資單 PDF 封存：分批讀取薪資記錄，由程序池產生 PDF 後寫入 zip 串流"""
+    
+    def __init__(self, db_manager, processes=None, chunk_size=200):
+        self.db = db_manager
+        self.processes = processes
+        self.chunk_size = chunk_size
+    
+    def iter_slip_chunks(self, year, month):
+        """逐批產生當月薪資單資料（含扣款明細）"""
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        detail_cursor = conn.cursor()
         
-        for category, name, amount in details:
-            if amount > 0:
-                cursor.execute('''
-                    INSERT INTO payroll_details (payroll_record_id, item_category, item_name, amount)
-                    VALUES (?, ?, ?, ?)
-                ''', (payroll_id, category, name, amount))
+        cursor.execute('''
+            SELECT pr.id, pr.user_id, u.employee_id, u.name,
+                   pr.work_days, pr.total_work_hours, pr.regular_hours, pr.overtime_hours,
+                   pr.holiday_hours, pr.night_shift_hours, pr.leave_hours,
+                   pr.base_salary, pr.overtime_pay, pr.holiday_pay, pr.night_shift_pay,
+                   pr.total_allowances, pr.gross_salary, pr.total_deductions, pr.net_salary
+            FROM payroll_records pr
+            JOIN users u ON u.user_id = pr.user_id
+            WHERE pr.period_year = ? AND pr.period_month = ?
+            ORDER BY pr.id
+        ''', (year, month))
+        columns = [column[0] for column in cursor.description]
         
-        return payroll_id
+        try:
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                
+                slips = {}
+                for row in rows:
+                    slip = dict(zip(columns, row))
+                    slip['deductions'] = []
+                    slip['filename'] = f"{year}{month:02d}_{slip['employee_id'] or slip['user_id']}_{slip['name']}.pdf"
+                    slips[slip.pop('id')] = slip
+                
+                # 整批記錄的扣款明細一次查詢
+                placeholders = ','.join('?' * len(slips))
+                detail_cursor.execute(f'''
+                    SELECT payroll_record_id, item_name, amount FROM payroll_details
+                    WHERE payroll_record_id IN ({placeholders}) AND item_category = 'deduction'
+                    ORDER BY id
+                ''', list(slips))
+                for record_id, item_name, amount in detail_cursor:
+                    slips[record_id]['deductions'].append((item_name, amount))
+                
+                yield list(slips.values())
+        finally:
+            conn.close()
+    
+    def write_zip(self, year, month, output):
+        """將當月所有薪資單寫入 zip（output 可為不可 seek 的串流），回傳張數"""
+        company_name = self.db.get_settings('system').get('company_name', '')
+        count = 0
+        
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for filename, pdf in render_payslips(self.iter_slip_chunks(year, month), company_name,
+                                                 year, month, self.processes):
+                archive.writestr(filename, pdf)
+                count += 1
+                if count % self.chunk_size == 0:
+                    event_bus.publish('payroll', {'job': 'payslips', 'period': f"{year}-{month:02d}", 'processed': count})
+        
+        event_bus.publish('payroll', {'job': 'payslips', 'period': f"{year}-{month:02d}", 'processed': count, 'done': True})
+        return count
 
 # 用戶狀態管理類
 class UserStateManager:
@@ -1333,13 +3414,16 @@ class UserStateManager:
 
 # LINE Bot 訊息處理器
 class LineMessageHandler:
-    def __init__(self, db_manager, permission_manager):
+    def __init__(self, db_manager, permission_manager, audit_logger=None):
         self.db = db_manager
         self.perm = permission_manager
+        self.audit = audit_logger
         self.user_mgr = UserManager(db_manager, permission_manager)
-        self.attendance_mgr = AttendanceManager(db_manager, permission_manager)
-        self.leave_mgr = LeaveManager(db_manager, permission_manager)
-        self.payroll_calc = PayrollCalculator(db_manager, permission_manager)
+        self.work_calendar = WorkCalendar(db_manager)
+        self.notifier = NotificationService(db_manager)
+        self.attendance_mgr = AttendanceManager(db_manager, permission_manager, self.work_calendar, self.notifier, audit_logger)
+        self.leave_mgr = LeaveManager(db_manager, permission_manager, self.notifier, audit_logger, self.work_calendar)
+        self.payroll_calc = PayrollCalculator(db_manager, permission_manager, self.work_calendar, self.notifier, audit_logger)
         self.state_mgr = UserStateManager(db_manager)
         self.button_helper = ButtonHelper()
     
@@ -1404,6 +3488,10 @@ class LineMessageHandler:
         elif text == '請假查詢':
             return self._handle_leave_query(user_id)
         
+        # 管理 API 金鑰（呼叫管理 API 時以金鑰辨識身分）
+        elif text == 'API金鑰':
+            return self._handle_api_token(user_id)
+        
         # 管理員功能
         elif self.perm.has_permission(user_id, 'all') or self.perm.has_permission(user_id, 'payroll'):
             if text == '管理員功能':
@@ -1579,12 +3667,23 @@ class LineMessageHandler:
         # 設定用戶狀態為選擇請假類型
         self.state_mgr.set_user_state(user_id, 'leave_type_selection', {'leave_types': leave_types})
         
-        text = "📝 請假申請\n\n請選擇請假類型："
+        # 今年各假別剩餘額度
+        balances = self.leave_mgr.get_leave_balances(user_id, datetime.now(TW_TZ).year)
+        
+        text = "📝 請假申請\n\n今年剩餘額度："
+        for type_id, type_name, is_paid in leave_types:
+            remaining_hours = balances.get(type_id, {}).get('remaining_hours')
+            remaining_text = "不限" if remaining_hours is None else f"{max(remaining_hours, 0) / 8:g}天"
+            text += f"\n• {type_name}：{remaining_text}"
+        text += "\n\n請選擇請假類型："
         
         # 創建請假類型按鈕
         buttons = []
         for type_id, type_name, is_paid in leave_types:
             paid_text = "💰" if is_paid else "⭕"
+            remaining_hours = balances.get(type_id, {}).get('remaining_hours')
+            if remaining_hours is not None and remaining_hours <= 0:
+                paid_text = "🚫"
             buttons.append({
                 'type': 'postback',
                 'label': f'{paid_text} {type_name}',
@@ -2126,20 +4225,27 @@ class LineMessageHandler:
             self.state_mgr.clear_user_state(user_id)
             return TextSendMessage(text="❌ 設定過程發生錯誤，請重新開始")
     
-    def _handle_leave_approval_start(self, user_id):
+    def _handle_leave_approval_start(self, user_id, page_cursor=None):
         """處理請假審核開始"""
         if not (self.perm.has_permission(user_id, 'all') or self.perm.has_permission(user_id, 'approve')):
             return TextSendMessage(text="❌ 您沒有權限執行此操作")
         
-        # 取得待審核的請假申請
-        pending_applications = self.leave_mgr.get_leave_applications(status='pending', limit=10)
+        # 部門主管只看自己部門的申請，其餘審核者看全部
+        manager_id = None
+        if not self.perm.has_permission(user_id, 'all') and self.leave_mgr.get_managed_department_ids(user_id):
+            manager_id = user_id
+        
+        # 取得待審核的請假申請（分頁）
+        queue = self.leave_mgr.get_approval_queue(status='pending', manager_id=manager_id, page_cursor=page_cursor, limit=10)
+        pending_applications = queue['applications']
         
         if not pending_applications:
             return TextSendMessage(text="📋 目前沒有待審核的請假申請")
         
         # 設定狀態為選擇請假申請
         self.state_mgr.set_user_state(user_id, 'leave_approval_selection', {
-            'applications': pending_applications
+            'applications': pending_applications,
+            'next_cursor': queue['next_cursor']
         })
         
         text = "📋 待審核請假申請：\n\n"
@@ -2148,15 +4254,42 @@ class LineMessageHandler:
             text += f"   {app['start_date']} ~ {app['end_date']} ({app['total_hours']}小時)\n"
             text += f"   申請時間：{app['application_date'][:16]}\n\n"
         
-        text += "請回覆數字選擇要審核的申請，例如：1\n或輸入「取消」結束審核"
+        text += "請回覆數字選擇要審核的申請，例如：1\n輸入「全部同意」核准本頁所有申請\n或輸入「取消」結束審核"
+        if queue['next_cursor']:
+            text += "\n輸入「下一頁」查看更多申請"
         
         return TextSendMessage(text=text)
     
     def _handle_leave_approval_selection(self, user_id, text):
         """處理請假審核選擇"""
+        user_state = self.state_mgr.get_user_state(user_id)
+        if text == '下一頁':
+            next_cursor = user_state['data'].get('next_cursor')
+            if not next_cursor:
+                return TextSendMessage(text="📋 已經是最後一頁")
+            return self._handle_leave_approval_start(user_id, next_cursor)
+        
+        if text == '全部同意':
+            application_ids = [app['id'] for app in user_state['data']['applications']]
+            result = self.leave_mgr.approve_leaves(application_ids, approved_by=user_id, approved=True)
+            self.state_mgr.clear_user_state(user_id)
+            
+            if not result['success']:
+                return TextSendMessage(text="❌ 批次核准失敗，請稍後再試")
+            
+            response_text = f"✅ 已核准 {len(result['updated'])} 筆請假申請\n\n系統將自動通知申請人"
+            if result['skipped']:
+                response_text += f"\n（{len(result['skipped'])} 筆已由他人處理，已略過）"
+            
+            buttons = [
+                {'type': 'message', 'label': '📋 繼續審核', 'text': '請假審核'},
+                {'type': 'message', 'label': '🏠 返回主選單', 'text': '你好'}
+            ]
+            quick_reply = self.button_helper.create_quick_reply_buttons(buttons)
+            return TextSendMessage(text=response_text, quick_reply=quick_reply)
+        
         try:
             selection = int(text)
-            user_state = self.state_mgr.get_user_state(user_id)
             applications = user_state['data']['applications']
             
             if 1 <= selection <= len(applications):
@@ -2367,7 +4500,12 @@ class LineMessageHandler:
                 
                 quick_reply = self.button_helper.create_quick_reply_buttons(buttons)
                 return TextSendMessage(text=text, quick_reply=quick_reply)
-                
+
+            return TextSendMessage(text="❌ 未知的審核決定")
+
+        except (ValueError, IndexError):
+            return TextSendMessage(text="❌ 處理請假審核時發生錯誤")
+
     def _handle_employee_postback(self, user_id, postback_data):
         """處理員工相關的 Postback"""
         # 這個方法可以後續擴展
@@ -2412,6 +4550,23 @@ class LineMessageHandler:
         quick_reply = self.button_helper.create_quick_reply_buttons(buttons)
         return TextSendMessage(text=text, quick_reply=quick_reply)
     
+    def _handle_api_token(self, user_id):
+        """核發管理 API 金鑰（舊金鑰同時失效）"""
+        if not (self.perm.has_permission(user_id, 'all') or self.perm.has_permission(user_id, 'approve')):
+            return TextSendMessage(text="❌ 您沒有權限執行此操作")
+        
+        token = self.perm.issue_api_token(user_id)
+        if self.audit:
+            self.audit.log(user_id, 'api_token_issued', 'api_tokens')
+        
+        return TextSendMessage(text=f"""🔑 管理 API 金鑰（先前的金鑰已失效）
+
+{token}
+
+呼叫管理 API 時請加上標頭：
+Authorization: Bearer <金鑰>
+請勿將金鑰提供給他人""")
+    
     def _handle_employee_management(self, user_id):
         """處理員工管理"""
         if not (self.perm.has_permission(user_id, 'all') or self.perm.has_permission(user_id, 'payroll')):
@@ -2561,11 +4716,17 @@ class LineMessageHandler:
 總工時: {work_data['total_hours']}小時
 正常工時: {work_data['regular_hours']}小時
 加班工時: {work_data['overtime_hours']}小時
+休息日工時: {work_data.get('weekend_hours', 0)}小時
+國定假日工時: {work_data.get('holiday_hours', 0)}小時
+夜班工時: {work_data.get('night_shift_hours', 0)}小時
+請假時數: {work_data.get('leave_hours', 0)}小時（無薪 {work_data.get('unpaid_leave_hours', 0)}小時）
 
 💵 薪資明細
 ─────────────────
-基本薪資: ${int(calc['base_salary']):,}
+基本薪資: ${int(calc['base_salary']):,}（無薪假扣薪 ${int(calc.get('leave_deduction', 0)):,}）
 加班費: ${int(calc['overtime_pay']):,}
+假日出勤: ${int(calc['holiday_pay']):,}
+夜班津貼: ${int(calc['night_shift_pay']):,}
 津貼: ${int(calc['total_allowances']):,}
 薪資總額: ${int(calc['gross_salary']):,}
 
@@ -2594,7 +4755,9 @@ ${int(payroll_data['net_salary']):,}"""
 # 全域變量初始化
 db_manager = DatabaseManager()
 permission_manager = PermissionManager(db_manager)
-message_handler = LineMessageHandler(db_manager, permission_manager)
+audit_logger = AuditLogger(db_manager)
+message_handler = LineMessageHandler(db_manager, permission_manager, audit_logger)
+notification_dispatcher = NotificationDispatcher(db_manager, line_bot_api)
 
 # LINE Bot Webhook 處理
 @app.route("/callback", methods=['POST'])
@@ -2698,6 +4861,13 @@ def handle_follow(event):
         TextSendMessage(text=welcome_message, quick_reply=quick_reply)
     )
 
+def api_caller():
+    """由 Authorization: Bearer <API 金鑰> 辨識呼叫者（金鑰經 LINE「API金鑰」指令核發）"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    return permission_manager.authenticate_api_token(token.strip())
+
 # Web API 路由
 @app.route('/api/users/<user_id>/payroll')
 def get_user_payroll_api(user_id):
@@ -2706,7 +4876,7 @@ def get_user_payroll_api(user_id):
     month = request.args.get('month', datetime.now().month, type=int)
     
     try:
-        payroll_calc = PayrollCalculator(db_manager, permission_manager)
+        payroll_calc = message_handler.payroll_calc
         payroll_data = payroll_calc.calculate_monthly_payroll(user_id, year, month)
         
         return jsonify({
@@ -2719,6 +4889,87 @@ def get_user_payroll_api(user_id):
             'error': str(e)
         }), 500
 
+@app.route('/api/payroll/cube')
+def payroll_cube_api():
+    """API: 薪資統計立方體切分（期間 × 部門 × 項目）"""
+    caller = api_caller()
+    if not caller:
+        return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+    
+    if not (permission_manager.has_permission(caller, 'all') or permission_manager.has_permission(caller, 'payroll')):
+        return jsonify({'success': False, 'error': '沒有查詢薪資統計的權限'}), 403
+    
+    def parse_period(value):
+        period = datetime.strptime(value, '%Y-%m')
+        return period.year * 100 + period.month
+    
+    this_month = datetime.now().strftime('%Y-%m')
+    try:
+        start_period = parse_period(request.args.get('from', this_month))
+        end_period = parse_period(request.args.get('to', request.args.get('from', this_month)))
+        department_ids = [int(value) for value in request.args.getlist('department_id')]
+    except ValueError:
+        return jsonify({'success': False, 'error': 'from/to 格式為 YYYY-MM，department_id 須為整數'}), 400
+    
+    group_by = request.args.get('group_by', 'period,department_id,item_category').split(',')
+    unknown = set(group_by) - set(PayrollRepository.CUBE_DIMENSIONS) - {''}
+    if unknown:
+        return jsonify({'success': False, 'error': f"group_by 僅支援 {', '.join(PayrollRepository.CUBE_DIMENSIONS)}"}), 400
+    
+    with db_manager.session() as conn:
+        cursor = conn.cursor()
+        cells = message_handler.payroll_calc.repo.query_cube(
+            cursor, start_period, end_period, group_by, department_ids,
+            request.args.get('item_category'), request.args.get('item_name')
+        )
+        
+        if 'department_id' in group_by:
+            cursor.execute('SELECT id, dept_name FROM departments')
+            department_names = dict(cursor.fetchall())
+            for cell in cells:
+                cell['department_name'] = department_names.get(cell['department_id'], '未分配')
+    
+    for cell in cells:
+        if 'period' in cell:
+            cell['period'] = f"{cell['period'] // 100}-{cell['period'] % 100:02d}"
+    
+    return jsonify({'success': True, 'cells': cells})
+
+@app.route('/api/calendar/<int:year>', methods=['GET', 'POST'])
+def calendar_days_api(year):
+    """API: 查詢或設定行事曆特殊日期"""
+    work_calendar = message_handler.work_calendar
+    
+    if request.method == 'POST':
+        # 特殊日期決定工時以平日或假日費率計薪，只有管理員可以設定；設定者由 API 金鑰辨識
+        created_by = api_caller()
+        if not created_by:
+            return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+        if not permission_manager.has_permission(created_by, 'all'):
+            return jsonify({'success': False, 'error': '沒有設定行事曆的權限'}), 403
+        
+        data = request.get_json(silent=True) or {}
+        
+        # 寫入的日期會在計算薪資時逐筆解析，格式錯誤的日期不能進資料表
+        try:
+            calendar_date = date.fromisoformat(data.get('date'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'date 格式必須為 YYYY-MM-DD'}), 400
+        
+        if calendar_date.year != year:
+            return jsonify({'success': False, 'error': '日期與年度不符'}), 400
+        
+        if not work_calendar.set_day(calendar_date.isoformat(), data.get('day_type'), data.get('name'), created_by):
+            return jsonify({'success': False, 'error': 'day_type 必須為 holiday、workday 或 closure'}), 400
+        
+        audit_logger.log(
+            created_by, 'calendar_set', 'calendar_days', data,
+            ip_address=request.remote_addr, user_agent=request.headers.get('User-Agent')
+        )
+        return jsonify({'success': True})
+    
+    return jsonify(work_calendar.get_special_days(year))
+
 @app.route('/api/attendance/summary')
 def get_attendance_summary_api():
     """API: 取得考勤統計"""
@@ -2754,15 +5005,71 @@ def get_attendance_summary_api():
 
 @app.route('/api/leaves/pending')
 def get_pending_leaves_api():
-    """API: 取得待審核請假"""
-    leave_mgr = LeaveManager(db_manager, permission_manager)
-    applications = leave_mgr.get_leave_applications(status='pending', limit=20)
+    """API: 取得待審核請假（審核者由 API 金鑰辨識，部門主管只看自己部門的申請）"""
+    caller = api_caller()
+    if not caller:
+        return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+    
+    if not (permission_manager.has_permission(caller, 'all') or permission_manager.has_permission(caller, 'approve')):
+        return jsonify({'success': False, 'error': '沒有審核權限'}), 403
+    
+    leave_mgr = message_handler.leave_mgr
+    manager_id = None
+    if not permission_manager.has_permission(caller, 'all') and leave_mgr.get_managed_department_ids(caller):
+        manager_id = caller
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    
+    try:
+        queue = leave_mgr.get_approval_queue(
+            status='pending',
+            department_id=request.args.get('department_id', type=int),
+            manager_id=manager_id,
+            page_cursor=request.args.get('cursor'),
+            limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    return jsonify(applications)
+    return jsonify(queue)
 
-@app.route('/api/system/stats')
-def get_system_stats_api():
-    """API: 取得系統統計"""
+@app.route('/api/leaves/bulk-approve', methods=['POST'])
+def bulk_approve_leaves_api():
+    """API: 批次核准/駁回請假（審核者由 API 金鑰辨識，不採用請求內容）"""
+    approved_by = api_caller()
+    if not approved_by:
+        return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+    
+    if not (permission_manager.has_permission(approved_by, 'all') or permission_manager.has_permission(approved_by, 'approve')):
+        return jsonify({'success': False, 'error': '沒有審核權限'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    application_ids = data.get('application_ids') or []
+    
+    if not isinstance(application_ids, list):
+        return jsonify({'success': False, 'error': '需提供 application_ids'}), 400
+    
+    approved = data.get('approved', True)
+    if not isinstance(approved, bool):
+        return jsonify({'success': False, 'error': 'approved 須為 true 或 false'}), 400
+    
+    try:
+        result = message_handler.leave_mgr.approve_leaves(
+            application_ids, approved_by,
+            approved=approved,
+            reject_reason=data.get('reject_reason')
+        )
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'application_ids 格式錯誤'}), 400
+    
+    if not result['success']:
+        return jsonify(result), 409
+    
+    # 不存在或已非待審核的申請列於 skipped，全部未處理時回傳 409
+    return jsonify(result), 409 if result['skipped'] and not result['updated'] else 200
+
+def compute_system_stats():
+    """計算系統統計（由 stats_cache 快取）"""
     conn = db_manager.get_connection()
     cursor = conn.cursor()
     
@@ -2770,13 +5077,14 @@ def get_system_stats_api():
     cursor.execute('SELECT COUNT(*) FROM users WHERE status = "active"')
     active_users = cursor.fetchone()[0]
     
-    # 本月考勤統計
-    current_month = datetime.now().strftime('%Y-%m')
+    # 本月考勤統計（以日期範圍查詢，可使用 record_date 索引）
+    month_start = datetime.now(TW_TZ).date().replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
     cursor.execute('''
         SELECT COUNT(DISTINCT user_id) 
         FROM attendance_records 
-        WHERE strftime('%Y-%m', record_date) = ?
-    ''', (current_month,))
+        WHERE record_date >= ? AND record_date < ?
+    ''', (month_start.isoformat(), next_month.isoformat()))
     
     monthly_attendance = cursor.fetchone()[0]
     
@@ -2786,12 +5094,24 @@ def get_system_stats_api():
     
     conn.close()
     
-    return jsonify({
+    return {
         'active_employees': active_users,
         'monthly_attendance': monthly_attendance,
         'pending_leaves': pending_leaves,
         'system_status': 'running'
-    })
+    }
+
+stats_cache.register('system_stats', compute_system_stats, topics=('users', 'attendance', 'leave'))
+
+@app.route('/api/system/stats')
+def get_system_stats_api():
+    """API: 取得系統統計（快取，支援 ETag / If-None-Match）"""
+    return conditional_json(stats_cache, 'system_stats')
+
+@app.route('/api/admin/events')
+def admin_events_api():
+    """API: 管理後台即時事件串流（SSE；連線時先送出目前統計）"""
+    return event_stream_response(event_bus, initial=[('stats', stats_cache.get('system_stats')[0])])
 
 # 管理後台路由
 @app.route('/admin')
@@ -2856,29 +5176,66 @@ def admin_dashboard():
     </div>
     
     <script>
-        // 載入統計數據
-        fetch('/api/system/stats')
-            .then(response => response.json())
-            .then(data => {
-                document.getElementById('stats').innerHTML = `
-                    <p>👥 在職員工: <span class="stat">${data.active_employees}</span></p>
-                    <p>📊 本月出勤: <span class="stat">${data.monthly_attendance}</span></p>
-                    <p>⏳ 待審請假: <span class="stat">${data.pending_leaves}</span></p>
-                `;
-            })
-            .catch(error => {
-                document.getElementById('stats').innerHTML = '<p>❌ 載入失敗</p>';
-            });
-            
+        function renderStats(data) {
+            document.getElementById('stats').innerHTML = `
+                <p>👥 在職員工: <span class="stat">${data.active_employees}</span></p>
+                <p>📊 本月出勤: <span class="stat">${data.monthly_attendance}</span></p>
+                <p>⏳ 待審請假: <span class="stat">${data.pending_leaves}</span></p>
+            `;
+        }
+        
         // 載入活動記錄
         document.getElementById('activities').innerHTML = `
-            <table class="table">
+            <table class="table" id="activity-table">
                 <tr><th>時間</th><th>用戶</th><th>操作</th><th>狀態</th></tr>
                 <tr><td>剛剛</td><td>系統</td><td>系統啟動</td><td>✅</td></tr>
                 <tr><td>剛剛</td><td>系統</td><td>資料庫初始化</td><td>✅</td></tr>
                 <tr><td>剛剛</td><td>系統</td><td>LINE Bot 設定</td><td>✅</td></tr>
             </table>
         `;
+        
+        function addActivity(user, action, status) {
+            const table = document.getElementById('activity-table');
+            const row = table.insertRow(1);
+            [new Date().toLocaleTimeString(), user, action, status].forEach(text => {
+                row.insertCell().textContent = text;
+            });
+            while (table.rows.length > 21) {
+                table.deleteRow(-1);
+            }
+        }
+        
+        const ACTION_LABELS = { clock_in: '上班打卡', clock_out: '下班打卡' };
+        const LEAVE_LABELS = { pending: '申請請假', approved: '核准請假', rejected: '駁回請假' };
+        const JOB_LABELS = { calculate: '薪資計算', payment_batch: '轉帳批次', payslips: '薪資單封存' };
+        
+        if (window.EventSource) {
+            // 即時事件：統計與活動由伺服器推送，斷線時瀏覽器自動重連
+            const events = new EventSource('/api/admin/events');
+            events.addEventListener('stats', e => renderStats(JSON.parse(e.data)));
+            events.addEventListener('attendance', e => {
+                const data = JSON.parse(e.data);
+                addActivity(data.user_id, `${ACTION_LABELS[data.action_type] || data.action_type} ${data.time}`, ['late', 'early'].includes(data.status) ? '⚠️' : '✅');
+            });
+            events.addEventListener('leave', e => {
+                const data = JSON.parse(e.data);
+                addActivity(data.user_id || '管理員', `${LEAVE_LABELS[data.status] || data.status} #${data.application_ids.join(', #')}`, '📝');
+            });
+            events.addEventListener('payroll', e => {
+                const data = JSON.parse(e.data);
+                const progress = data.job === 'calculate' ? `實領 $${Math.round(data.net_salary).toLocaleString()}`
+                    : data.done ? '完成' : `已處理 ${data.processed} 筆`;
+                addActivity(data.user_id || '系統', `${JOB_LABELS[data.job] || data.job} ${data.period} ${progress}`, data.done || data.job === 'calculate' ? '✅' : '⏳');
+            });
+        } else {
+            // 不支援 SSE 的瀏覽器只載入一次統計數據
+            fetch('/api/system/stats')
+                .then(response => response.json())
+                .then(renderStats)
+                .catch(error => {
+                    document.getElementById('stats').innerHTML = '<p>❌ 載入失敗</p>';
+                });
+        }
     </script>
 </body>
 </html>
@@ -2992,7 +5349,134 @@ def home():
 </html>
     ''')
 
+# 歸檔 / 資料搬移命令列
+def run_archive_cli(argv):
+    """歸檔命令列：archive / restore / archive-list / migrate-attendance-db / payment-batch / payslips"""
+    parser = argparse.ArgumentParser(prog='complete_payroll_system.py', description='歷史資料歸檔、搬移、轉帳批次與薪資單封存')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    for command, help_text in (('archive', '將已結束期間移入年度歸檔表'), ('restore', '將歸檔期間搬回熱資料表')):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('table', choices=sorted(ArchiveManager.ARCHIVABLE_TABLES))
+        sub.add_argument('year', type=int)
+        sub.add_argument('--month', type=int, choices=range(1, 13))
+    
+    subparsers.add_parser('archive-list', help='列出歸檔表與筆數')
+    
+    sub = subparsers.add_parser('migrate-attendance-db', help='將 salary_finance 的 attendance.db 搬移到本資料庫')
+    sub.add_argument('source', help='來源資料庫路徑')
+    sub.add_argument('--chunk-size', type=int, default=1000)
+    
+    sub = subparsers.add_parser('payment-batch', help='產生當月薪資轉帳批次檔並標記已發放')
+    sub.add_argument('year', type=int)
+    sub.add_argument('month', type=int, choices=range(1, 13))
+    sub.add_argument('--output', help='輸出檔案（預設 payroll_transfer_YYYYMM.txt）')
+    sub.add_argument('--paid-by', default='system')
+    sub.add_argument('--payment-date', type=date.fromisoformat, help='轉帳日期 YYYY-MM-DD（預設今天）')
+    sub.add_argument('--dry-run', action='store_true', help='只產生檔案，不標記發放')
+    
+    sub = subparsers.add_parser('payslips', help='產生當月全體薪資單 PDF 封存檔（zip）')
+    sub.add_argument('year', type=int)
+    sub.add_argument('month', type=int, choices=range(1, 13))
+    sub.add_argument('--output', help='輸出檔案（預設 payslips_YYYYMM.zip，- 為標準輸出）')
+    sub.add_argument('--processes', type=int, help='平行程序數（預設為 CPU 核心數）')
+    
+    args = parser.parse_args(argv)
+    
+    if args.command == 'payslips':
+        archive = PayslipArchive(db_manager, args.processes)
+        if args.output == '-':
+            count = archive.write_zip(args.year, args.month, sys.stdout.buffer)
+            print(f"✅ 已產生 {count} 張薪資單", file=sys.stderr)
+            return 0
+        
+        output_path = args.output or f"payslips_{args.year}{args.month:02d}.zip"
+        started = time.time()
+        with open(output_path, 'wb') as output:
+            count = archive.write_zip(args.year, args.month, output)
+        print(f"✅ 已產生 {count} 張薪資單 → {output_path}（{time.time() - started:.1f} 秒）")
+        return 0
+    
+    if args.command == 'payment-batch':
+        output_path = args.output or f"payroll_transfer_{args.year}{args.month:02d}.txt"
+        
+        # 正式批次不覆寫既有檔案，避免已上傳的轉帳檔被取代
+        if not args.dry_run and os.path.exists(output_path):
+            print(f"❌ {output_path} 已存在，請指定其他 --output")
+            return 1
+        
+        # 先寫入暫存檔，產生成功（正式批次已標記發放）後才改名，中途失敗不留下不完整的轉帳檔
+        partial_path = output_path + '.partial'
+        summary = None
+        try:
+            with open(partial_path, 'wb') as output:
+                summary = PaymentBatchGenerator(db_manager, audit_logger).generate(
+                    args.year, args.month, output, args.paid_by, args.payment_date, args.dry_run
+                )
+            os.replace(partial_path, output_path)
+        finally:
+            # 正式批次一旦提交，暫存檔就是唯一的轉帳檔，改名失敗也要保留
+            committed = summary is not None and 'batch_id' in summary
+            if os.path.exists(partial_path):
+                if committed:
+                    print(f"❌ 批次 #{summary['batch_id']} 已標記發放，轉帳檔保留於 {partial_path}")
+                else:
+                    os.remove(partial_path)
+        
+        print(f"{'🔍 試算' if args.dry_run else '✅ 已產生'} {output_path}")
+        print(f"   筆數 {summary['record_count']}，總金額 {summary['total_amount']:,}，帳號檢查碼 {summary['account_hash']}")
+        print(f"   SHA-256 {summary['sha256']}")
+        for missing in summary['missing_accounts']:
+            print(f"⚠️ 未轉帳（{missing['reason']}）：{missing['name']} ({missing['user_id']})")
+        return 0
+    
+    if args.command == 'migrate-attendance-db':
+        if not os.path.exists(args.source):
+            print(f"❌ 找不到來源資料庫 {args.source}")
+            return 1
+        
+        conn = db_manager.get_connection()
+        try:
+            moved = migrate_attendance_db(
+                args.source, conn, args.chunk_size,
+                progress=lambda table, count: print(f"  {table}: {count}")
+            )
+        finally:
+            conn.close()
+        
+        for table, count in moved.items():
+            if table.endswith('_skipped'):
+                print(f"⚠️ {table[:-len('_skipped')]} 有 {count} 筆資料格式錯誤，已略過")
+            else:
+                print(f"✅ {table} 已搬移 {count} 筆")
+        return 0
+    
+    archive_mgr = ArchiveManager(db_manager)
+    
+    if args.command == 'archive-list':
+        for archive_table, count in archive_mgr.get_archive_summary().items():
+            print(f"{archive_table}: {count}")
+        return 0
+    
+    period = f"{args.year}" + (f"-{args.month:02d}" if args.month else "")
+    try:
+        if args.command == 'archive':
+            moved = archive_mgr.archive_period(args.table, args.year, args.month)
+            print(f"✅ {args.table} {period} 已歸檔 {moved} 筆")
+        else:
+            moved = archive_mgr.restore_period(args.table, args.year, args.month)
+            print(f"✅ {args.table} {period} 已還原 {moved} 筆")
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    
+    return 0
+
 if __name__ == "__main__":
+    # 歸檔 / 資料搬移命令列
+    if len(sys.argv) > 1 and sys.argv[1] in ('archive', 'restore', 'archive-list', 'migrate-attendance-db', 'payment-batch', 'payslips'):
+        sys.exit(run_archive_cli(sys.argv[1:]))
+    
     print("🚀 啟動完整薪資管理系統...")
     print("✅ 資料庫初始化完成")
     print("✅ 權限管理系統已啟用")
@@ -3020,4 +5504,8 @@ if __name__ == "__main__":
     print("   💰 薪資查詢 - 便捷操作")
     print("   🔧 管理功能 - 直覺式管理")
     
+    # 背景派送通知
+    notification_dispatcher.start()
+    print("✅ 通知派送服務已啟動")
+    
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,106 @@
+# event_bus.py - 程序內事件發布／訂閱與 Server-Sent Events 串流
+#
+# 寫入端呼叫 publish(事件, 資料)，每個 SSE 連線各有一個有上限的佇列，
+# 發布時不等待讀取端；佇列滿（用戶端跟不上）時結束該連線，
+# 瀏覽器的 EventSource 會自動重連並帶上 Last-Event-ID，由最近事件記錄補送漏掉的事件。
+#
+# 事件只在同一程序內傳遞，命令列工具等其他程序的事件不會出現在串流中。
+
+import json
+import queue
+import threading
+from collections import deque
+
+from flask import request, Response
+
+
+class Subscription:
+    """單一連線的事件佇列"""
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+
+class EventBus:
+    """執行緒安全的事件匯流排"""
+
+    def __init__(self, history=200, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history)  # 最近事件 (id, 事件, 資料)，供重連補送
+        self._next_id = 1
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def publish(self, event, data):
+        """發布事件（不阻塞；沒有訂閱者時只記入最近事件）"""
+        with self._lock:
+            message = (self._next_id, event, data)
+            self._next_id += 1
+            self._history.append(message)
+
+            for subscription in list(self._subscribers):
+                try:
+                    subscription.queue.put_nowait(message)
+                except queue.Full:
+                    subscription.closed = True
+                    self._subscribers.discard(subscription)
+
+    def subscribe(self, last_event_id=None):
+        """建立訂閱；帶 last_event_id 時先放入之後的最近事件"""
+        subscription = Subscription(self.queue_size)
+
+        with self._lock:
+            if last_event_id is not None and last_event_id < self._next_id:
+                missed = [message for message in self._history if message[0] > last_event_id]
+                for message in missed[-self.queue_size:]:
+                    subscription.queue.put_nowait(message)
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscription.closed = True
+            self._subscribers.discard(subscription)
+
+
+def _format_event(event, data, event_id=None):
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def sse_stream(bus, last_event_id=None, initial=(), heartbeat=15):
+    """SSE 文字串流；initial 為連線時先送出的 (事件, 資料)，閒置時每 heartbeat 秒送出註解保持連線"""
+    subscription = bus.subscribe(last_event_id)
+    try:
+        yield 'retry: 3000\n\n'
+        for event, data in initial:
+            yield _format_event(event, data)
+
+        while True:
+            # 佇列滿而被移除的連線，送完已排入的事件後結束，由用戶端重連補送
+            if subscription.closed and subscription.queue.empty():
+                return
+            try:
+                event_id, event, data = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield _format_event(event, data, event_id)
+    finally:
+        bus.unsubscribe(subscription)
+
+
+def event_stream_response(bus, initial=()):
+    """回傳 SSE 回應（依 Last-Event-ID 標頭補送重連期間的事件）"""
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    response = Response(sse_stream(bus, last_event_id, initial), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 反向代理不緩衝串流
+    return response
@@ -0,0 +1,879 @@
+# payroll_repository.py - 考勤 / 薪資資料存取層（complete_payroll_system 與 salary_finance 共用）
+#
+# 統一資料格式以 payroll_system.db 為準：
+#   attendance_records   action_type 為 clock_in / clock_out，record_date + record_time（ISO 含時區）
+#   payroll_records      津貼總額欄位為 total_allowances
+#   payroll_details      項目類型欄位為 item_category
+#   system_settings      (setting_category, setting_key) 設定
+#
+# 舊版 attendance.db（salary_finance 原本使用）為：
+#   attendance_records   action_type 為 上班 / 下班，只有 taiwan_time 文字欄位
+#   payroll_records      allowances；payroll_details item_type；payroll_settings
+#   ensure_punch_epochs() 另加上 punch_epoch（UTC 秒數）與產生欄位 punch_date
+#
+# 各 Repository 在第一次使用時以 PRAGMA table_info 判斷資料庫屬於哪一種格式，
+# 呼叫端不必知道底層是哪個資料庫。session 為回傳 context manager 的函式，
+# 進入時取得連線、離開時釋放（由各應用程式決定是否關閉或共用連線）。
+#
+# migrate_attendance_db() 以分批（fetchmany / executemany）方式將 attendance.db
+# 搬移到統一格式的資料庫，進度記錄在 migration_state，中斷後可從上次位置續跑。
+#
+# payroll_year_rollups 為每人每年一列的年度彙總（應發、實發、各扣款項目），
+# 兩個應用程式儲存薪資記錄時呼叫 refresh_year_rollup() 更新，年度統計與扣繳憑單只讀這張表。
+# payroll_cube 為期間 × 部門 × 項目的金額彙總，replace_details() 寫入明細時增量維護。
+#
+# config_version 為計薪設定（費率、投保級距、扣繳稅額表）的版本號，由觸發器在設定資料表
+# 有任何寫入時遞增；長駐的計算器快取編譯後的扣款規則，以版本號判斷是否需要重新載入。
+
+import json
+from datetime import datetime, timedelta
+
+from payroll_rules import WithholdingTaxTable
+
+# 舊版打卡動作 → 統一格式
+ACTION_TYPE_MAP = {'上班': 'clock_in', '下班': 'clock_out'}
+
+# 台灣時間（無日光節約時間）
+TW_OFFSET = '+08:00'
+TW_OFFSET_SECONDS = 8 * 3600
+
+# 台灣時間的 epoch 起點：epoch 秒數直接相加即得當地時間，不需解析字串
+TW_EPOCH = datetime(1970, 1, 1) + timedelta(seconds=TW_OFFSET_SECONDS)
+
+
+def normalize_action_type(action_type):
+    """將打卡動作轉為統一格式（clock_in / clock_out）"""
+    return ACTION_TYPE_MAP.get(action_type, action_type)
+
+
+# 年度彙總
+ROLLUP_COLUMNS = [
+    'user_id', 'period_year', 'months', 'gross_salary', 'net_salary', 'total_deductions',
+    'total_work_hours', 'income_tax', 'deduction_items'
+]
+
+# 扣繳憑單的扣繳稅額取自此扣款項目
+INCOME_TAX_ITEM = '所得稅'
+
+
+# 彙總資料表：(表名, 建立語法, 回填方法)
+ROLLUP_TABLES = [
+    ('payroll_year_rollups', ['''
+        CREATE TABLE payroll_year_rollups (
+            user_id TEXT NOT NULL,
+            period_year INTEGER NOT NULL,
+            months INTEGER DEFAULT 0,
+            gross_salary REAL DEFAULT 0,
+            net_salary REAL DEFAULT 0,
+            total_deductions REAL DEFAULT 0,
+            total_work_hours REAL DEFAULT 0,
+            income_tax REAL DEFAULT 0,
+            deduction_items TEXT,  -- JSON {扣款項目名稱: 年度金額}
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, period_year)
+        )
+    '''], 'rebuild_year_rollups'),
+
+    # 統計立方體：期間 (YYYYMM) × 部門 × 項目類型 × 項目名稱
+    ('payroll_cube', ['''
+        CREATE TABLE payroll_cube (
+            period INTEGER NOT NULL,
+            department_id INTEGER NOT NULL,  -- 0 表示未分配部門
+            item_category TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            amount REAL DEFAULT 0,
+            item_count INTEGER DEFAULT 0,
+            PRIMARY KEY (period, department_id, item_category, item_name)
+        ) WITHOUT ROWID
+    ''', '''
+        CREATE TABLE IF NOT EXISTS payroll_cube_members (
+            payroll_record_id INTEGER PRIMARY KEY,
+            department_id INTEGER NOT NULL  -- 計入立方體時的部門
+        )
+    '''], 'rebuild_cube'),
+]
+
+
+def ensure_rollup_tables(conn):
+    """建立彙總資料表；新建立且已有薪資記錄時以既有資料回填"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    repository = PayrollRepository(None)
+
+    for table, statements, rebuild in ROLLUP_TABLES:
+        if table in existing:
+            continue
+
+        for statement in statements:
+            cursor.execute(statement)
+        if 'payroll_records' in existing and 'payroll_details' in existing:
+            getattr(repository, rebuild)(cursor)
+
+    conn.commit()
+
+
+# 計薪設定資料表（含行事曆特殊日期）：任何寫入都會遞增 config_version（只處理資料庫中存在的資料表）
+CONFIG_TABLES = (
+    'system_settings', 'payroll_settings', 'insurance_brackets',
+    'withholding_tax_years', 'withholding_tax_brackets', 'calendar_days'
+)
+
+
+def ensure_config_version(conn):
+    """建立設定版本表，並在各設定資料表加上寫入時遞增版本的觸發器"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS config_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO config_version (id, version) VALUES (1, 0)')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+    for table in CONFIG_TABLES:
+        if table not in existing:
+            continue
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_config_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE config_version SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+    conn.commit()
+
+
+def config_version(cursor):
+    """目前的計薪設定版本（尚未建立版本表時為 0）"""
+    try:
+        cursor.execute('SELECT version FROM config_version WHERE id = 1')
+    except Exception:
+        return 0
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _rollup_dict(row):
+    rollup = dict(zip(ROLLUP_COLUMNS, row))
+    rollup['deduction_items'] = json.loads(rollup['deduction_items'] or '{}')
+    return rollup
+
+
+def tw_date_to_epoch(day, days=0):
+    """台灣日期（往後 days 天）00:00 的 epoch 秒數"""
+    local_midnight = datetime.strptime(str(day)[:10], '%Y-%m-%d') + timedelta(days=days)
+    return int((local_midnight - TW_EPOCH).total_seconds())
+
+
+def _table_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+class _SchemaAware:
+    """依資料表欄位判斷資料庫格式，結果只查詢一次"""
+
+    def __init__(self, session):
+        self.session = session
+        self._unified = None
+        self._punch_epoch = None
+
+    def is_unified(self, cursor):
+        if self._unified is None:
+            self._unified = 'record_time' in _table_columns(cursor, 'attendance_records')
+        return self._unified
+
+    def has_punch_epoch(self, cursor):
+        """舊版格式是否已完成 punch_epoch 欄位搬移"""
+        if self._punch_epoch is None:
+            self._punch_epoch = 'punch_epoch' in _table_columns(cursor, 'attendance_records')
+        return self._punch_epoch
+
+
+class AttendanceRepository(_SchemaAware):
+    """打卡記錄存取"""
+
+    def iter_punches(self, user_id, start_date, end_date, source='attendance_records'):
+        """依時間順序逐筆產生 [start_date, end_date] 期間的 (action_type, datetime)
+
+        action_type 一律為統一格式，datetime 為不含時區的台灣當地時間；
+        查詢走 (user_id, 日期) 範圍條件，不對每筆資料套用 strftime。
+        """
+        with self.session() as conn:
+            cursor = conn.cursor()
+
+            if self.is_unified(cursor):
+                cursor.execute(f'''
+                    SELECT action_type, record_time
+                    FROM {source}
+                    WHERE user_id = ? AND record_date >= ? AND record_date <= ?
+                    AND action_type IN ('clock_in', 'clock_out')
+                    ORDER BY record_time, id
+                ''', (user_id, str(start_date), str(end_date)))
+
+                for action_type, record_time in cursor:
+                    yield action_type, datetime.fromisoformat(record_time).replace(tzinfo=None)
+            elif self.has_punch_epoch(cursor):
+                # 舊版格式：以 (user_id, punch_epoch) 索引範圍查詢，時間以整數運算換算
+                cursor.execute(f'''
+                    SELECT action_type, punch_epoch
+                    FROM {source}
+                    WHERE user_id = ? AND punch_epoch >= ? AND punch_epoch < ?
+                    AND action_type IN ('上班', '下班', 'clock_in', 'clock_out')
+                    ORDER BY punch_epoch, id
+                ''', (user_id, tw_date_to_epoch(start_date), tw_date_to_epoch(end_date, days=1)))
+
+                for action_type, punch_epoch in cursor:
+                    yield normalize_action_type(action_type), TW_EPOCH + timedelta(seconds=punch_epoch)
+            else:
+                # 尚未搬移的舊版格式：taiwan_time 為 'YYYY-MM-DD HH:MM:SS'，字串比較即時間順序
+                cursor.execute(f'''
+                    SELECT action_type, taiwan_time
+                    FROM {source}
+                    WHERE user_id = ? AND taiwan_time >= ? AND taiwan_time < date(?, '+1 day')
+                    AND action_type IN ('上班', '下班', 'clock_in', 'clock_out')
+                    ORDER BY taiwan_time, id
+                ''', (user_id, str(start_date), str(end_date)))
+
+                for action_type, taiwan_time in cursor:
+                    yield normalize_action_type(action_type), datetime.strptime(taiwan_time, '%Y-%m-%d %H:%M:%S')
+
+
+class PayrollRepository(_SchemaAware):
+    """薪資記錄與設定存取"""
+
+    # 統一格式 → 舊版欄位名稱
+    LEGACY_RECORD_COLUMNS = {'total_allowances': 'allowances'}
+
+    # 已確認、已發放的記錄不再重算覆寫（金額與發放狀態以記錄為準）
+    LOCKED_STATUSES = ('confirmed', 'paid')
+
+    # 統一格式中薪資計算會用到的設定類別，同名設定以後者為準（搬移來的舊版設定在 payroll 類別）
+    SETTING_CATEGORIES = ('insurance', 'payroll')
+
+    def get_settings(self, cursor, categories=SETTING_CATEGORIES):
+        """取得薪資相關設定 {setting_key: setting_value}（統一格式取 system_settings 指定類別）"""
+        if not self.is_unified(cursor):
+            cursor.execute('SELECT setting_key, setting_value FROM payroll_settings')
+            return dict(cursor.fetchall())
+
+        settings = {}
+        for category in categories:
+            cursor.execute('''
+                SELECT setting_key, setting_value FROM system_settings
+                WHERE setting_category = ?
+            ''', (category,))
+            settings.update(cursor.fetchall())
+        return settings
+
+    def get_insurance_brackets(self, cursor, as_of):
+        """取得指定日期適用的投保級距 {insurance_type: [投保薪資(遞增)]}（沒有級距表時為空）"""
+        if not _table_columns(cursor, 'insurance_brackets'):
+            return {}
+
+        # 每種保險取生效日不晚於 as_of 的最新版本
+        cursor.execute('''
+            SELECT b.insurance_type, b.insured_salary
+            FROM insurance_brackets b
+            WHERE b.effective_date = (
+                SELECT MAX(effective_date) FROM insurance_brackets
+                WHERE insurance_type = b.insurance_type AND effective_date <= ?
+            )
+            ORDER BY b.insurance_type, b.insured_salary
+        ''', (str(as_of),))
+
+        brackets = {}
+        for insurance_type, insured_salary in cursor.fetchall():
+            brackets.setdefault(insurance_type, []).append(insured_salary)
+        return brackets
+
+    def get_withholding_table(self, cursor, tax_year):
+        """取得適用於指定年度的扣繳稅額表（無對應年度時沿用最近的舊年度，沒有稅額表時為 None）"""
+        if not _table_columns(cursor, 'withholding_tax_years'):
+            return None
+
+        cursor.execute('''
+            SELECT tax_year, exemption, standard_deduction, salary_deduction, min_withholding
+            FROM withholding_tax_years
+            WHERE tax_year <= ?
+            ORDER BY tax_year DESC LIMIT 1
+        ''', (tax_year,))
+        year_row = cursor.fetchone()
+        if not year_row:
+            return None
+
+        cursor.execute('''
+            SELECT income_floor, tax_rate FROM withholding_tax_brackets
+            WHERE tax_year = ?
+            ORDER BY income_floor
+        ''', (year_row[0],))
+        brackets = cursor.fetchall()
+        if not brackets:
+            return None
+
+        return WithholdingTaxTable(
+            tax_year=year_row[0],
+            brackets=brackets,
+            exemption=year_row[1],
+            standard_deduction=year_row[2],
+            salary_deduction=year_row[3],
+            min_withholding=year_row[4] or 0
+        )
+
+    def get_record(self, cursor, user_id, year, month):
+        """取得當月薪資記錄 (id, status, net_salary)，無記錄時回傳 None"""
+        cursor.execute('''
+            SELECT id, status, net_salary FROM payroll_records
+            WHERE user_id = ? AND period_year = ? AND period_month = ?
+        ''', (user_id, year, month))
+        return cursor.fetchone()
+
+    def save_record(self, cursor, user_id, year, month, fields):
+        """新增或更新當月薪資記錄，fields 使用統一格式欄位名稱，回傳記錄 id
+
+        記錄已確認或已發放時拋出 ValueError，呼叫端應先以 get_record 檢查。
+        """
+        if not self.is_unified(cursor):
+            fields = {self.LEGACY_RECORD_COLUMNS.get(column, column): value for column, value in fields.items()}
+
+        existing = self.get_record(cursor, user_id, year, month)
+        if existing and existing[1] in self.LOCKED_STATUSES:
+            raise ValueError(f"{year}年{month}月薪資記錄已{'發放' if existing[1] == 'paid' else '確認'}，不可重新計算")
+
+        columns = list(fields)
+        if existing:
+            assignments = ', '.join(f'{column} = ?' for column in columns)
+            cursor.execute(f'''
+                UPDATE payroll_records SET {assignments}, calculated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', [fields[column] for column in columns] + [existing[0]])
+            return existing[0]
+
+        placeholders = ', '.join('?' * (len(columns) + 3))
+        cursor.execute(f'''
+            INSERT INTO payroll_records (user_id, period_year, period_month, {', '.join(columns)})
+            VALUES ({placeholders})
+        ''', [user_id, year, month] + [fields[column] for column in columns])
+        return cursor.lastrowid
+
+    def replace_details(self, cursor, payroll_record_id, details):
+        """以新的明細取代薪資記錄的明細，details 為 (類型, 名稱, 金額[, 備註])，金額為 0 者略過"""
+        category_column = self._category_column(cursor)
+
+        # 統計立方體先扣除舊明細，寫入新明細後再加回
+        self._apply_cube(cursor, payroll_record_id, -1)
+        cursor.execute('DELETE FROM payroll_details WHERE payroll_record_id = ?', (payroll_record_id,))
+        cursor.executemany(f'''
+            INSERT INTO payroll_details (payroll_record_id, {category_column}, item_name, amount, notes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (payroll_record_id, category, name, amount, notes[0] if notes else None)
+            for category, name, amount, *notes in details if amount > 0
+        ])
+        self._apply_cube(cursor, payroll_record_id, 1)
+
+    # 統計立方體可切分的維度
+    CUBE_DIMENSIONS = ('period', 'department_id', 'item_category', 'item_name')
+
+    def _record_department(self, cursor, payroll_record_id):
+        """薪資記錄所屬部門（舊版格式沒有部門，一律為 0）"""
+        if not self.is_unified(cursor):
+            return 0
+        cursor.execute('''
+            SELECT COALESCE(u.department_id, 0)
+            FROM payroll_records pr LEFT JOIN users u ON u.user_id = pr.user_id
+            WHERE pr.id = ?
+        ''', (payroll_record_id,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _apply_cube(self, cursor, payroll_record_id, sign):
+        """將一筆薪資記錄的明細加入（sign=1）或移出（sign=-1）統計立方體
+
+        移出時使用當初計入的部門（payroll_cube_members），員工調部門後舊月份仍留在原部門。
+        """
+        if sign < 0:
+            cursor.execute('SELECT department_id FROM payroll_cube_members WHERE payroll_record_id = ?', (payroll_record_id,))
+            row = cursor.fetchone()
+            if not row:
+                return
+            department_id = row[0]
+        else:
+            department_id = self._record_department(cursor, payroll_record_id)
+            cursor.execute('''
+                INSERT OR REPLACE INTO payroll_cube_members (payroll_record_id, department_id)
+                VALUES (?, ?)
+            ''', (payroll_record_id, department_id))
+
+        cursor.execute(f'''
+            INSERT INTO payroll_cube (period, department_id, item_category, item_name, amount, item_count)
+            SELECT pr.period_year * 100 + pr.period_month, ?, pd.{self._category_column(cursor)}, pd.item_name,
+                   ? * SUM(pd.amount), ? * COUNT(*)
+            FROM payroll_details pd
+            JOIN payroll_records pr ON pr.id = pd.payroll_record_id
+            WHERE pd.payroll_record_id = ?
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (period, department_id, item_category, item_name) DO UPDATE SET
+                amount = amount + excluded.amount,
+                item_count = item_count + excluded.item_count
+        ''', (department_id, sign, sign, payroll_record_id))
+
+        if sign < 0:
+            cursor.execute('DELETE FROM payroll_cube WHERE item_count <= 0')
+            cursor.execute('DELETE FROM payroll_cube_members WHERE payroll_record_id = ?', (payroll_record_id,))
+
+    def rebuild_cube(self, cursor):
+        """以既有薪資明細重建統計立方體（部門以目前歸屬計算），回傳格數"""
+        cursor.execute('DELETE FROM payroll_cube')
+        cursor.execute('DELETE FROM payroll_cube_members')
+
+        if self.is_unified(cursor):
+            cursor.execute('''
+                INSERT INTO payroll_cube_members (payroll_record_id, department_id)
+                SELECT pr.id, COALESCE(u.department_id, 0)
+                FROM payroll_records pr LEFT JOIN users u ON u.user_id = pr.user_id
+            ''')
+        else:
+            cursor.execute('INSERT INTO payroll_cube_members (payroll_record_id, department_id) SELECT id, 0 FROM payroll_records')
+
+        cursor.execute(f'''
+            INSERT INTO payroll_cube (period, department_id, item_category, item_name, amount, item_count)
+            SELECT pr.period_year * 100 + pr.period_month, m.department_id,
+                   pd.{self._category_column(cursor)}, pd.item_name, SUM(pd.amount), COUNT(*)
+            FROM payroll_details pd
+            JOIN payroll_records pr ON pr.id = pd.payroll_record_id
+            JOIN payroll_cube_members m ON m.payroll_record_id = pr.id
+            GROUP BY 1, 2, 3, 4
+        ''')
+        return cursor.rowcount
+
+    def query_cube(self, cursor, start_period, end_period, group_by=('period', 'department_id', 'item_category'),
+                   department_ids=None, item_category=None, item_name=None):
+        """切分統計立方體：期間為 YYYYMM 整數（含起訖），依 group_by 維度加總
+
+        回傳 [{維度...: 值, 'amount': 金額, 'item_count': 明細筆數}]
+        """
+        group_by = [dimension for dimension in self.CUBE_DIMENSIONS if dimension in group_by]
+        conditions = ['period BETWEEN ? AND ?']
+        params = [start_period, end_period]
+
+        if department_ids:
+            conditions.append(f"department_id IN ({','.join('?' * len(department_ids))})")
+            params.extend(department_ids)
+        if item_category:
+            conditions.append('item_category = ?')
+            params.append(item_category)
+        if item_name:
+            conditions.append('item_name = ?')
+            params.append(item_name)
+
+        select_columns = group_by + ['SUM(amount)', 'SUM(item_count)']
+        grouping = f"GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}" if group_by else ''
+        cursor.execute(f'''
+            SELECT {', '.join(select_columns)} FROM payroll_cube
+            WHERE {' AND '.join(conditions)}
+            {grouping}
+        ''', params)
+
+        return [
+            dict(zip(group_by + ['amount', 'item_count'], row))
+            for row in cursor.fetchall() if row[-1]
+        ]
+
+    # 匯出欄位（標題, 統一格式欄位）；明細欄位為 None 時表示該記錄沒有明細
+    EXPORT_COLUMNS = [
+        ('員工ID', 'pr.user_id'), ('姓名', 'u.name'), ('年', 'pr.period_year'), ('月', 'pr.period_month'),
+        ('工作天數', 'pr.work_days'), ('總工時', 'pr.total_work_hours'), ('正常工時', 'pr.regular_hours'),
+        ('加班工時', 'pr.overtime_hours'), ('基本薪資', 'pr.base_salary'), ('加班費', 'pr.overtime_pay'),
+        ('津貼', 'pr.total_allowances'), ('應發薪資', 'pr.gross_salary'), ('扣款總額', 'pr.total_deductions'),
+        ('實發薪資', 'pr.net_salary'), ('狀態', 'pr.status'),
+        ('項目類型', 'pd.item_category'), ('項目名稱', 'pd.item_name'), ('項目金額', 'pd.amount'), ('備註', 'pd.notes')
+    ]
+
+    def iter_export_rows(self, cursor, year, month, chunk_size=500):
+        """逐批產生當月薪資匯出資料（每筆明細一列，沒有明細的記錄也輸出一列）
+
+        依 payroll_records.id、payroll_details.id 順序讀取，不需排序暫存，
+        每次只以 fetchmany 取 chunk_size 列，記憶體用量與總筆數無關。
+        """
+        unified = self.is_unified(cursor)
+        legacy_columns = {'pr.total_allowances': 'pr.allowances', 'pd.item_category': 'pd.item_type'}
+        columns = [
+            column if unified else legacy_columns.get(column, column)
+            for _, column in self.EXPORT_COLUMNS
+        ]
+
+        cursor.execute(f'''
+            SELECT {', '.join(columns)}
+            FROM payroll_records pr
+            LEFT JOIN users u ON u.user_id = pr.user_id
+            LEFT JOIN payroll_details pd ON pd.payroll_record_id = pr.id
+            WHERE pr.period_year = ? AND pr.period_month = ?
+            ORDER BY pr.id, pd.id
+        ''', (year, month))
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def _category_column(self, cursor):
+        return 'item_category' if self.is_unified(cursor) else 'item_type'
+
+    def refresh_year_rollup(self, cursor, user_id, year):
+        """重算單一員工的年度彙總（儲存薪資記錄後呼叫，只讀取該員工當年度最多 12 筆記錄）"""
+        cursor.execute('''
+            SELECT COUNT(*), SUM(gross_salary), SUM(net_salary), SUM(total_deductions), SUM(total_work_hours)
+            FROM payroll_records
+            WHERE user_id = ? AND period_year = ?
+        ''', (user_id, year))
+        months, gross_salary, net_salary, total_deductions, total_work_hours = cursor.fetchone()
+
+        if not months:
+            cursor.execute('DELETE FROM payroll_year_rollups WHERE user_id = ? AND period_year = ?', (user_id, year))
+            return
+
+        cursor.execute(f'''
+            SELECT pd.item_name, SUM(pd.amount)
+            FROM payroll_details pd
+            JOIN payroll_records pr ON pr.id = pd.payroll_record_id
+            WHERE pr.user_id = ? AND pr.period_year = ? AND pd.{self._category_column(cursor)} = 'deduction'
+            GROUP BY pd.item_name
+        ''', (user_id, year))
+        deduction_items = dict(cursor.fetchall())
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO payroll_year_rollups
+            (user_id, period_year, months, gross_salary, net_salary, total_deductions, total_work_hours,
+             income_tax, deduction_items, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (
+            user_id, year, months, gross_salary or 0, net_salary or 0, total_deductions or 0,
+            total_work_hours or 0, deduction_items.get(INCOME_TAX_ITEM, 0),
+            json.dumps(deduction_items, ensure_ascii=False)
+        ))
+
+    def rebuild_year_rollups(self, cursor, year=None):
+        """以既有薪資記錄重建年度彙總（建立彙總表或修正資料時使用），回傳彙總筆數"""
+        condition = 'WHERE period_year = ?' if year else ''
+        params = (year,) if year else ()
+
+        cursor.execute(f'SELECT DISTINCT user_id, period_year FROM payroll_records {condition}', params)
+        keys = cursor.fetchall()
+        for user_id, period_year in keys:
+            self.refresh_year_rollup(cursor, user_id, period_year)
+        return len(keys)
+
+    def get_year_rollup(self, cursor, user_id, year):
+        """取得單一員工年度彙總，沒有記錄時回傳 None"""
+        cursor.execute(f'''
+            SELECT {', '.join(ROLLUP_COLUMNS)} FROM payroll_year_rollups
+            WHERE user_id = ? AND period_year = ?
+        ''', (user_id, year))
+        row = cursor.fetchone()
+        return _rollup_dict(row) if row else None
+
+    def iter_year_rollups(self, cursor, year, chunk_size=500):
+        """逐批產生全體員工年度彙總（年度扣繳憑單用，每位員工只讀一列）"""
+        cursor.execute(f'''
+            SELECT {', '.join('r.' + column for column in ROLLUP_COLUMNS)}, u.name
+            FROM payroll_year_rollups r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            WHERE r.period_year = ?
+            ORDER BY r.user_id
+        ''', (year,))
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(_rollup_dict(row[:-1]), name=row[-1]) for row in rows]
+
+
+# taiwan_time 文字 → UTC epoch 秒數（格式錯誤時為 NULL）
+_PUNCH_EPOCH_EXPR = "CAST(strftime('%s', {0}, '-8 hours') AS INTEGER)"
+
+
+def ensure_punch_epochs(conn, chunk_size=5000):
+    """舊版 attendance_records 加上數值時間欄位並回填既有資料，回傳回填筆數
+
+    - punch_epoch：打卡時間的 UTC epoch 秒數，(user_id, punch_epoch) 建索引供範圍查詢
+    - punch_date：由 punch_epoch 產生的台灣日期（VIRTUAL 產生欄位，不佔儲存空間）
+    - 觸發器：只寫入 taiwan_time 的舊程式新增或修改記錄時自動補上 punch_epoch
+    回填依 id 分段進行，每段各自提交；重複執行只處理尚未回填的資料。
+    """
+    cursor = conn.cursor()
+    columns = _table_columns(cursor, 'attendance_records')
+    if 'record_time' in columns or 'taiwan_time' not in columns:
+        return 0
+
+    if 'punch_epoch' not in columns:
+        cursor.execute('ALTER TABLE attendance_records ADD COLUMN punch_epoch INTEGER')
+        cursor.execute(f'''
+            ALTER TABLE attendance_records ADD COLUMN punch_date TEXT
+            GENERATED ALWAYS AS (date(punch_epoch + {TW_OFFSET_SECONDS}, 'unixepoch')) VIRTUAL
+        ''')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attendance_user_epoch
+        ON attendance_records (user_id, punch_epoch)
+    ''')
+    triggers = [
+        ('trg_attendance_punch_epoch_insert', 'INSERT', 'NEW.punch_epoch IS NULL'),
+        ('trg_attendance_punch_epoch_update', 'UPDATE OF taiwan_time', 'NEW.taiwan_time IS NOT OLD.taiwan_time')
+    ]
+    for trigger, event, condition in triggers:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {trigger}
+            AFTER {event} ON attendance_records
+            WHEN {condition}
+            BEGIN
+                UPDATE attendance_records SET punch_epoch = {_PUNCH_EPOCH_EXPR.format('NEW.taiwan_time')}
+                WHERE id = NEW.id;
+            END
+        ''')
+    conn.commit()
+
+    cursor.execute('SELECT MAX(id) FROM attendance_records WHERE punch_epoch IS NULL')
+    max_id = cursor.fetchone()[0] or 0
+
+    backfilled = 0
+    for low in range(0, max_id, chunk_size):
+        cursor.execute(f'''
+            UPDATE attendance_records SET punch_epoch = {_PUNCH_EPOCH_EXPR.format('taiwan_time')}
+            WHERE id > ? AND id <= ? AND punch_epoch IS NULL
+            AND {_PUNCH_EPOCH_EXPR.format('taiwan_time')} IS NOT NULL
+        ''', (low, low + chunk_size))
+        backfilled += cursor.rowcount
+        conn.commit()
+
+    return backfilled
+
+
+def _migration_position(target, table):
+    cursor = target.execute('SELECT last_id FROM migration_state WHERE source_table = ?', (table,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _stream(source, table, columns, after_id, chunk_size):
+    """以 id 遞增分批讀取來源資料表"""
+    cursor = source.execute(f'''
+        SELECT id, {', '.join(columns)} FROM {table}
+        WHERE id > ? ORDER BY id
+    ''', (after_id,))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def _convert_punch(row):
+    """舊版打卡 → 統一格式；taiwan_time 為空或格式錯誤時回傳 None（略過該筆）"""
+    user_id, action_type, taiwan_time, created_at = row
+    try:
+        punch_time = datetime.strptime(taiwan_time, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return (
+        user_id, punch_time.strftime('%Y-%m-%d'), normalize_action_type(action_type),
+        punch_time.isoformat() + TW_OFFSET, taiwan_time, 'normal', created_at
+    )
+
+
+def _effective_date(row, date_index, created_index):
+    """舊版 effective_date 可為空，以建立日期代替"""
+    row = list(row)
+    if not row[date_index]:
+        row[date_index] = (row[created_index] or datetime.now().strftime('%Y-%m-%d'))[:10]
+    return tuple(row)
+
+
+# 來源資料表 → (讀取欄位, 寫入語法, 資料轉換)；資料轉換回傳 None 的列略過不搬
+MIGRATION_STEPS = [
+    ('users', ['user_id', 'name', 'status'],
+     'INSERT OR IGNORE INTO users (user_id, name, status) VALUES (?, ?, ?)',
+     lambda row: (row[0], row[1] or f"用戶{row[0][-4:]}", row[2] or 'active')),
+
+    ('attendance_records', ['user_id', 'action_type', 'taiwan_time', 'created_at'],
+     '''INSERT INTO attendance_records
+        (user_id, record_date, action_type, record_time, taiwan_time, status, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+     _convert_punch),
+
+    ('salary_structures',
+     ['user_id', 'base_salary', 'hourly_rate', 'overtime_rate', 'holiday_rate', 'position_allowance',
+      'transport_allowance', 'meal_allowance', 'other_allowances', 'effective_date', 'created_at'],
+     '''INSERT INTO salary_structures
+        (user_id, base_salary, hourly_rate, overtime_rate, holiday_rate, position_allowance,
+         transport_allowance, meal_allowance, other_allowances, effective_date, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+     lambda row: _effective_date(row, 9, 10)),
+
+    ('salary_deductions',
+     ['user_id', 'labor_insurance', 'health_insurance', 'income_tax', 'pension', 'other_deductions',
+      'effective_date', 'created_at'],
+     '''INSERT INTO salary_deductions
+        (user_id, labor_insurance, health_insurance, income_tax, pension, other_deductions,
+         effective_date, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+     lambda row: _effective_date(row, 6, 7)),
+
+    # 同一用戶同一月份已存在於目標資料庫者保留目標資料
+    ('payroll_records',
+     ['user_id', 'period_year', 'period_month', 'total_work_hours', 'regular_hours', 'overtime_hours',
+      'holiday_hours', 'work_days', 'base_salary', 'overtime_pay', 'holiday_pay', 'allowances',
+      'gross_salary', 'total_deductions', 'net_salary', 'status', 'calculated_at', 'confirmed_at', 'paid_at'],
+     '''INSERT OR IGNORE INTO payroll_records
+        (user_id, period_year, period_month, total_work_hours, regular_hours, overtime_hours,
+         holiday_hours, work_days, base_salary, overtime_pay, holiday_pay, total_allowances,
+         gross_salary, total_deductions, net_salary, status, calculated_at, confirmed_at, paid_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+     None),
+]
+
+# 逐筆寫入並記錄舊 id → 新 id 的資料表（明細只掛到本次實際寫入的記錄）
+ID_MAPPED_TABLES = ('payroll_records',)
+
+
+def migrate_attendance_db(source_path, target_conn, chunk_size=1000, progress=None):
+    """將舊版 attendance.db 分批搬移到統一格式資料庫（target_conn 需已建立資料表）
+
+    每批於同一交易內寫入資料並更新 migration_state，中斷後重跑會從上次位置繼續；
+    結束時重建年度彙總與統計立方體。
+    回傳 {來源資料表: 本次搬移筆數}，無法轉換而略過的筆數記在 {來源資料表}_skipped。
+    """
+    import sqlite3
+
+    source = sqlite3.connect(source_path)
+    target_conn.execute('''
+        CREATE TABLE IF NOT EXISTS migration_state (
+            source_table TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    target_conn.execute('''
+        CREATE TABLE IF NOT EXISTS migration_id_map (
+            source_table TEXT NOT NULL,
+            legacy_id INTEGER NOT NULL,
+            new_id INTEGER NOT NULL,
+            PRIMARY KEY (source_table, legacy_id)
+        )
+    ''')
+
+    source_tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    moved = {}
+
+    try:
+        for table, columns, insert_sql, convert in MIGRATION_STEPS:
+            if table not in source_tables:
+                continue
+
+            # 舊資料庫可能缺少較新的欄位
+            available = _table_columns(source.cursor(), table)
+            read_columns = [column if column in available else 'NULL' for column in columns]
+
+            moved[table] = 0
+            skipped = 0
+            for rows in _stream(source, table, read_columns, _migration_position(target_conn, table), chunk_size):
+                values = [(row[0], convert(row[1:]) if convert else row[1:]) for row in rows]
+                values = [(legacy_id, value) for legacy_id, value in values if value is not None]
+                skipped += len(rows) - len(values)
+
+                if table in ID_MAPPED_TABLES:
+                    for legacy_id, value in values:
+                        cursor = target_conn.execute(insert_sql, value)
+                        if cursor.rowcount:
+                            target_conn.execute('''
+                                INSERT OR REPLACE INTO migration_id_map (source_table, legacy_id, new_id)
+                                VALUES (?, ?, ?)
+                            ''', (table, legacy_id, cursor.lastrowid))
+                else:
+                    target_conn.executemany(insert_sql, [value for _, value in values])
+                target_conn.execute('''
+                    INSERT OR REPLACE INTO migration_state (source_table, last_id, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (table, rows[-1][0]))
+                target_conn.commit()
+
+                moved[table] += len(values)
+                if progress:
+                    progress(table, moved[table])
+
+            if skipped:
+                moved[f'{table}_skipped'] = skipped
+
+        if 'payroll_details' in source_tables:
+            moved['payroll_details'] = _migrate_payroll_details(source, target_conn, chunk_size, progress)
+
+        if 'payroll_settings' in source_tables:
+            # 舊版設定併入 system_settings 的 payroll 類別，既有設定不覆寫
+            target_conn.executemany('''
+                INSERT OR IGNORE INTO system_settings
+                (setting_category, setting_key, setting_value, setting_type, description)
+                VALUES ('payroll', ?, ?, 'number', ?)
+            ''', source.execute('SELECT setting_key, setting_value, description FROM payroll_settings').fetchall())
+            target_conn.commit()
+
+        if 'payroll_records' in source_tables:
+            # 搬移寫入的薪資記錄不經 save_record，年度彙總與統計立方體整批重建
+            # （每次執行都重建，前次在重建前中斷時也能補上）
+            ensure_rollup_tables(target_conn)
+            cursor = target_conn.cursor()
+            repository = PayrollRepository(None)
+            repository.rebuild_year_rollups(cursor)
+            repository.rebuild_cube(cursor)
+            target_conn.commit()
+    finally:
+        source.close()
+
+    return moved
+
+
+def _migrate_payroll_details(source, target_conn, chunk_size, progress):
+    """薪資明細依 migration_id_map 對應到本次搬移寫入的薪資記錄（目標已有的記錄保留原明細）"""
+    moved = 0
+    cursor = source.execute('''
+        SELECT id, payroll_record_id, item_type, item_name, amount, calculation_base, notes
+        FROM payroll_details
+        WHERE id > ? ORDER BY id
+    ''', (_migration_position(target_conn, 'payroll_details'),))
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        legacy_ids = sorted({row[1] for row in rows})
+        record_ids = dict(target_conn.execute(f'''
+            SELECT legacy_id, new_id FROM migration_id_map
+            WHERE source_table = 'payroll_records' AND legacy_id IN ({', '.join('?' * len(legacy_ids))})
+        ''', legacy_ids).fetchall())
+
+        values = [
+            (record_ids[row[1]], row[2] or 'salary', row[3], row[4] or 0, row[5], row[6])
+            for row in rows if row[1] in record_ids
+        ]
+        target_conn.executemany('''
+            INSERT INTO payroll_details
+            (payroll_record_id, item_category, item_name, amount, calculation_base, notes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', values)
+        target_conn.execute('''
+            INSERT OR REPLACE INTO migration_state (source_table, last_id, updated_at)
+            VALUES ('payroll_details', ?, CURRENT_TIMESTAMP)
+        ''', (rows[-1][0],))
+        target_conn.commit()
+
+        moved += len(values)
+        if progress:
+            progress('payroll_details', moved)
+
+    return moved
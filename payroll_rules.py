@@ -0,0 +1,299 @@
+# payroll_rules.py - 宣告式薪資扣款規則編譯器
+#
+# 規則定義格式（每條規則為一個 dict）：
+#   item           扣款項目代碼，例如 'labor_insurance'
+#   label          顯示名稱，例如 '勞保費'
+#   type           規則類型：'rate'（費率計算，預設）、'bracket'（投保級距）、
+#                  'withholding'（扣繳稅額表）或 'fixed'（固定金額）
+#   table          bracket / withholding 規則使用的查表名稱，例如 'labor'、'health'
+#   dependents     withholding 規則的扶養人數欄位，預設 'tax_dependents'
+#   base           計算基準欄位，預設 'gross_salary'
+#   rate           費率預設值；rate_setting 指定從系統設定讀取的鍵
+#   share          員工負擔比例，預設 1
+#   threshold      起徵點（基準扣除此值後才計算）；threshold_setting 同上
+#   cap            基準上限；cap_setting 同上
+#   override       若該欄位值不為 0，直接使用該值（預設與 item 相同）
+#
+# compile_rules() 只在設定載入時執行一次，將規則轉成扁平的閉包清單，
+# 之後每位員工的計算不再解讀規則內容；批次計算時則逐條規則對整欄資料運算。
+#
+# DEDUCTION_RULES 為兩個應用程式共用的規則定義：complete_payroll_system 使用全部規則；
+# salary_finance 只取其中的勞保、健保、退休金、所得稅與其他扣款（見 salary_finance.DEDUCTION_ITEMS），
+# 不扣就業保險、工會費與借支扣款。兩者共有的項目以同樣的薪資與設定計算，金額相同。
+
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+# 扣款規則定義（費率取自系統設定，未設定時使用預設值；
+# 勞保、就保以勞保投保薪資級距計算，健保以健保投保金額級距計算，沒有級距表時以薪資計；
+# 所得稅依扣繳稅額表計算，未設定稅額表時退回起徵點 × 稅率）
+DEDUCTION_RULES = [
+    {'item': 'labor_insurance', 'label': '勞保費', 'type': 'bracket', 'table': 'labor',
+     'rate_setting': 'labor_insurance_rate', 'rate': 0.105, 'share': 0.2},
+    {'item': 'health_insurance', 'label': '健保費', 'type': 'bracket', 'table': 'health',
+     'rate_setting': 'health_insurance_rate', 'rate': 0.0517, 'share': 0.3},
+    {'item': 'unemployment_insurance', 'label': '就業保險', 'type': 'bracket', 'table': 'labor',
+     'rate_setting': 'unemployment_insurance_rate', 'rate': 0.01, 'share': 0.2},
+    {'item': 'pension', 'label': '退休金', 'rate_setting': 'pension_rate', 'rate': 0.06},
+    {'item': 'income_tax', 'label': '所得稅', 'type': 'withholding', 'table': 'withholding',
+     'dependents': 'tax_dependents', 'rate_setting': 'income_tax_rate', 'rate': 0.05,
+     'threshold_setting': 'income_tax_threshold', 'threshold': 40000},
+    {'item': 'union_fee', 'label': '工會費', 'type': 'fixed'},
+    {'item': 'loan_deduction', 'label': '借支扣款', 'type': 'fixed'},
+    {'item': 'other_deductions', 'label': '其他扣款', 'type': 'fixed'}
+]
+
+
+def lookup_bracket(levels, amount):
+    """以二分搜尋取得投保級距：不低於 amount 的最小級距，超過最高級距時以最高級距計"""
+    index = bisect_left(levels, amount)
+    if index >= len(levels):
+        return levels[-1]
+    return levels[index]
+
+
+class WithholdingTaxTable:
+    """薪資所得扣繳稅額表（單一稅務年度）
+
+    以全年薪資推算應納稅額：月薪 × 12 − 薪資特別扣除 − 標準扣除 −
+    免稅額 × (本人 + 扶養人數)，再依累進級距計稅後攤回每月。
+    各級距起點的累計稅額預先計算，查表只需一次二分搜尋；
+    重複的 (月薪, 扶養人數) 組合由 LRU 快取直接回傳。
+    """
+
+    def __init__(self, tax_year, brackets, exemption, standard_deduction,
+                 salary_deduction, min_withholding=0, cache_size=4096):
+        # brackets: [(級距起點, 稅率), ...]
+        brackets = sorted(brackets)
+        self.tax_year = tax_year
+        self.exemption = exemption
+        self.standard_deduction = standard_deduction
+        self.salary_deduction = salary_deduction
+        self.min_withholding = min_withholding
+        self.floors = [floor for floor, _ in brackets]
+        self.rates = [rate for _, rate in brackets]
+
+        # 預先計算每個級距起點的累計稅額
+        self.base_taxes = [0]
+        for index in range(1, len(brackets)):
+            width = self.floors[index] - self.floors[index - 1]
+            self.base_taxes.append(self.base_taxes[-1] + width * self.rates[index - 1])
+
+        self.monthly_tax = lru_cache(maxsize=cache_size)(self._monthly_tax)
+
+    def _monthly_tax(self, gross_salary, dependents=0):
+        """計算每月應扣繳稅額"""
+        taxable = (gross_salary * 12 - self.salary_deduction - self.standard_deduction
+                   - self.exemption * (1 + dependents))
+        if taxable <= 0 or not self.floors:
+            return 0
+
+        index = max(bisect_right(self.floors, taxable) - 1, 0)
+        annual_tax = self.base_taxes[index] + (taxable - self.floors[index]) * self.rates[index]
+        monthly_tax = round(annual_tax / 12, 0)
+
+        # 每月扣繳稅額未達最低扣繳額者免予扣繳
+        if monthly_tax < self.min_withholding:
+            return 0
+        return monthly_tax
+
+    def lookup(self, gross_salary, dependents=0):
+        """查詢扣繳稅額（以整數月薪與扶養人數作為快取鍵）"""
+        return self.monthly_tax(int(round(gross_salary or 0)), int(dependents or 0))
+
+    def lookup_batch(self, gross_salaries, dependents_list):
+        """批次查詢扣繳稅額"""
+        return [self.lookup(gross, dependents) for gross, dependents in zip(gross_salaries, dependents_list)]
+
+
+def _resolve(rule, key, settings, default=None):
+    """取得規則參數：優先使用系統設定，其次使用規則內的預設值"""
+    setting_key = rule.get(f'{key}_setting')
+    if setting_key and setting_key in settings:
+        try:
+            return float(settings[setting_key])
+        except (TypeError, ValueError):
+            pass
+    return rule.get(key, default)
+
+
+def _compile_rate_rule(rule, settings, tables):
+    """編譯費率型規則：round(min(max(基準 - 起徵點, 0), 上限) × 費率 × 負擔比例)"""
+    base_field = rule.get('base', 'gross_salary')
+    override_field = rule.get('override', rule['item'])
+    factor = _resolve(rule, 'rate', settings, 0) * rule.get('share', 1)
+    threshold = _resolve(rule, 'threshold', settings, 0) or 0
+    cap = _resolve(rule, 'cap', settings)
+
+    def evaluate(row):
+        override = row.get(override_field) or 0
+        if override:
+            return override
+        base = (row.get(base_field) or 0) - threshold
+        if base <= 0:
+            return 0
+        if cap is not None and base > cap:
+            base = cap
+        return round(base * factor, 0)
+
+    def evaluate_column(columns, size):
+        bases = columns.get(base_field) or [0] * size
+        overrides = columns.get(override_field) or [0] * size
+        results = []
+        for base, override in zip(bases, overrides):
+            if override:
+                results.append(override)
+                continue
+            base = (base or 0) - threshold
+            if base <= 0:
+                results.append(0)
+                continue
+            if cap is not None and base > cap:
+                base = cap
+            results.append(round(base * factor, 0))
+        return results
+
+    return evaluate, evaluate_column
+
+
+def _compile_bracket_rule(rule, settings, tables):
+    """編譯投保級距規則：round(投保薪資 × 費率 × 負擔比例)，投保薪資以級距表查得"""
+    base_field = rule.get('base', 'gross_salary')
+    override_field = rule.get('override', rule['item'])
+    factor = _resolve(rule, 'rate', settings, 0) * rule.get('share', 1)
+    levels = sorted(tables.get(rule['table']) or [])
+
+    def insured_salary(base):
+        return lookup_bracket(levels, base) if levels else base
+
+    def evaluate(row):
+        override = row.get(override_field) or 0
+        if override:
+            return override
+        base = row.get(base_field) or 0
+        if base <= 0:
+            return 0
+        return round(insured_salary(base) * factor, 0)
+
+    def evaluate_column(columns, size):
+        bases = columns.get(base_field) or [0] * size
+        overrides = columns.get(override_field) or [0] * size
+        results = []
+        for base, override in zip(bases, overrides):
+            if override:
+                results.append(override)
+            elif not base or base <= 0:
+                results.append(0)
+            else:
+                results.append(round(insured_salary(base) * factor, 0))
+        return results
+
+    return evaluate, evaluate_column
+
+
+def _compile_withholding_rule(rule, settings, tables):
+    """編譯扣繳稅額表規則，未載入稅額表時改以起徵點 × 稅率計算"""
+    table = tables.get(rule.get('table', 'withholding'))
+    if table is None:
+        return _compile_rate_rule(rule, settings, tables)
+
+    base_field = rule.get('base', 'gross_salary')
+    override_field = rule.get('override', rule['item'])
+    dependents_field = rule.get('dependents', 'tax_dependents')
+
+    def evaluate(row):
+        override = row.get(override_field) or 0
+        if override:
+            return override
+        return table.lookup(row.get(base_field), row.get(dependents_field))
+
+    def evaluate_column(columns, size):
+        bases = columns.get(base_field) or [0] * size
+        overrides = columns.get(override_field) or [0] * size
+        dependents = columns.get(dependents_field) or [0] * size
+        taxes = table.lookup_batch(bases, dependents)
+        return [override or tax for override, tax in zip(overrides, taxes)]
+
+    return evaluate, evaluate_column
+
+
+def _compile_fixed_rule(rule, settings, tables):
+    """編譯固定金額規則：直接取用扣款設定中的金額"""
+    override_field = rule.get('override', rule['item'])
+
+    def evaluate(row):
+        return row.get(override_field) or 0
+
+    def evaluate_column(columns, size):
+        values = columns.get(override_field) or [0] * size
+        return [value or 0 for value in values]
+
+    return evaluate, evaluate_column
+
+
+# 規則類型 → 編譯函式，新增規則類型時在此註冊
+RULE_COMPILERS = {
+    'rate': _compile_rate_rule,
+    'bracket': _compile_bracket_rule,
+    'withholding': _compile_withholding_rule,
+    'fixed': _compile_fixed_rule,
+}
+
+
+class CompiledRulePlan:
+    """編譯後的扣款計算計畫，可重複用於每位員工"""
+
+    def __init__(self, steps):
+        # steps: [(item, label, evaluate, evaluate_column), ...]
+        self.steps = steps
+        self.items = [step[0] for step in steps]
+        self.labels = {step[0]: step[1] for step in steps}
+
+    def evaluate(self, row):
+        """計算單一員工的扣款明細，row 需包含基準欄位與扣款設定"""
+        details = {}
+        for item, _, evaluate, _ in self.steps:
+            details[item] = evaluate(row)
+        details['total_deductions'] = sum(details.values())
+        return details
+
+    def evaluate_batch(self, rows):
+        """批次計算：將資料轉為欄位後逐條規則整欄運算"""
+        size = len(rows)
+        if not size:
+            return []
+
+        fields = set()
+        for row in rows:
+            fields.update(row.keys())
+        columns = {field: [row.get(field, 0) for row in rows] for field in fields}
+
+        results = [{} for _ in range(size)]
+        totals = [0] * size
+        for item, _, _, evaluate_column in self.steps:
+            for index, amount in enumerate(evaluate_column(columns, size)):
+                results[index][item] = amount
+                totals[index] += amount
+
+        for index, total in enumerate(totals):
+            results[index]['total_deductions'] = total
+        return results
+
+
+def compile_rules(rules, settings=None, tables=None):
+    """將規則定義編譯成計算計畫
+
+    settings 為 {setting_key: value}；tables 為查表資料，
+    投保級距為 {名稱: [投保薪資, ...]}，扣繳稅額表為 {名稱: WithholdingTaxTable}
+    """
+    settings = settings or {}
+    tables = tables or {}
+    steps = []
+    for rule in rules:
+        rule_type = rule.get('type', 'rate')
+        compiler = RULE_COMPILERS.get(rule_type)
+        if compiler is None:
+            raise ValueError(f"未知的規則類型: {rule_type} ({rule.get('item')})")
+        evaluate, evaluate_column = compiler(rule, settings, tables)
+        steps.append((rule['item'], rule.get('label', rule['item']), evaluate, evaluate_column))
+    return CompiledRulePlan(steps)
@@ -0,0 +1,196 @@
+# payslip_renderer.py - 薪資單 PDF 產生器（不依賴外部套件）
+#
+# 每張薪資單為單頁 A4 PDF，中文使用 PDF 閱讀器內建的 MSung-Light 字型
+# （Adobe-CNS1，UniCNS-UCS2-H 編碼，不需內嵌字型檔）。
+#
+# PayslipTemplate 在建立時將版面「編譯」成固定內容：
+#   - 固定的 PDF 物件（Catalog、Pages、Page、字型）預先序列化為位元組
+#   - 所有標題與欄位名稱預先轉成內容串流指令
+#   - 數值欄位只保留 (座標, 欄位, 格式)，產生時填入數值並靠右對齊
+# 每張薪資單只需組合數值指令與 xref，不再解讀版面設定。
+#
+# render_payslips() 以程序池平行產生：每個工作程序在初始化時編譯一次版面，
+# 之後只接收薪資單資料、回傳 (檔名, PDF 位元組)。
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+
+LABEL_X = 60
+VALUE_X = 320
+LINE_HEIGHT = 18
+
+# 版面：(區段標題, [(欄位名稱, 欄位, 格式)])，格式為 'days' / 'hours' / 'money'
+SECTIONS = [
+    ('工時統計', [
+        ('工作天數', 'work_days', 'days'),
+        ('總工時', 'total_work_hours', 'hours'),
+        ('正常工時', 'regular_hours', 'hours'),
+        ('加班工時', 'overtime_hours', 'hours'),
+        ('假日工時', 'holiday_hours', 'hours'),
+        ('夜班工時', 'night_shift_hours', 'hours'),
+        ('請假時數', 'leave_hours', 'hours'),
+    ]),
+    ('薪資明細', [
+        ('基本薪資', 'base_salary', 'money'),
+        ('加班費', 'overtime_pay', 'money'),
+        ('假日出勤工資', 'holiday_pay', 'money'),
+        ('夜班津貼', 'night_shift_pay', 'money'),
+        ('各項津貼', 'total_allowances', 'money'),
+        ('薪資總額', 'gross_salary', 'money'),
+    ]),
+]
+
+FORMATS = {
+    'days': lambda value: f"{int(value or 0)} 天",
+    'hours': lambda value: f"{float(value or 0):.1f} 小時",
+    'money': lambda value: f"${int(round(value or 0)):,}",
+}
+
+
+def _hex(text):
+    """文字轉為 UCS-2 十六進位字串（UniCNS-UCS2-H 編碼）"""
+    return '<' + text.encode('utf-16-be').hex().upper() + '>'
+
+
+def _text_width(text, size):
+    """估算文字寬度：半形字 500、全形字 1000（千分之一字級）"""
+    return sum(500 if ord(char) < 128 else 1000 for char in text) * size / 1000
+
+
+def _text_op(x, y, text, size):
+    return f"BT /F1 {size} Tf {x:.1f} {y:.1f} Td {_hex(text)} Tj ET\n"
+
+
+def _right_op(right_x, y, text, size):
+    return _text_op(right_x - _text_width(text, size), y, text, size)
+
+
+def _line_op(y):
+    return f"{LABEL_X} {y:.1f} m {VALUE_X} {y:.1f} l S\n"
+
+
+class PayslipTemplate:
+    """預先編譯的薪資單版面"""
+
+    def __init__(self, company_name, year, month):
+        ops = [
+            _text_op(LABEL_X, 790, company_name, 16),
+            _text_op(LABEL_X, 766, f"{year}年{month}月 薪資單", 13),
+        ]
+        self.fields = []
+
+        y = 716
+        for title, items in SECTIONS:
+            ops.append(_text_op(LABEL_X, y, title, 12))
+            ops.append(_line_op(y - 5))
+            y -= LINE_HEIGHT + 4
+            for label, field, fmt in items:
+                ops.append(_text_op(LABEL_X + 10, y, label, 11))
+                self.fields.append((y, field, FORMATS[fmt]))
+                y -= LINE_HEIGHT
+            y -= 10
+
+        ops.append(_text_op(LABEL_X, y, '扣款項目', 12))
+        ops.append(_line_op(y - 5))
+        self.deduction_y = y - LINE_HEIGHT - 4
+
+        self.static_ops = ''.join(ops)
+        self.objects = self._compile_objects()
+
+    @staticmethod
+    def _compile_objects():
+        """固定的 PDF 物件（內容串流為 4 號物件，於產生時補上）"""
+        objects = {
+            1: '<< /Type /Catalog /Pages 2 0 R >>',
+            2: '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+            3: (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+                '/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>'),
+            5: '<< /Type /Font /Subtype /Type0 /BaseFont /MSung-Light /Encoding /UniCNS-UCS2-H /DescendantFonts [6 0 R] >>',
+            6: ('<< /Type /Font /Subtype /CIDFontType0 /BaseFont /MSung-Light '
+                '/CIDSystemInfo << /Registry (Adobe) /Ordering (CNS1) /Supplement 0 >> '
+                '/FontDescriptor 7 0 R /DW 1000 /W [1 95 500] >>'),
+            7: ('<< /Type /FontDescriptor /FontName /MSung-Light /Flags 6 /FontBBox [-160 -249 1015 1071] '
+                '/ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 880 /StemV 93 >>'),
+        }
+        return {number: f"{number} 0 obj\n{body}\nendobj\n".encode('ascii') for number, body in objects.items()}
+
+    def render(self, slip):
+        """slip 含員工資料、SECTIONS 欄位與 deductions [(名稱, 金額)]，回傳 PDF 位元組"""
+        ops = [
+            self.static_ops,
+            _text_op(LABEL_X, 742, f"員工：{slip['name']}　員工編號：{slip.get('employee_id') or slip['user_id']}", 11),
+        ]
+        for y, field, formatter in self.fields:
+            ops.append(_right_op(VALUE_X, y, formatter(slip.get(field)), 11))
+
+        y = self.deduction_y
+        for name, amount in slip.get('deductions', ()):
+            ops.append(_text_op(LABEL_X + 10, y, name, 11))
+            ops.append(_right_op(VALUE_X, y, FORMATS['money'](amount), 11))
+            y -= LINE_HEIGHT
+        ops.append(_text_op(LABEL_X + 10, y, '扣款總額', 11))
+        ops.append(_right_op(VALUE_X, y, FORMATS['money'](slip.get('total_deductions')), 11))
+
+        y -= LINE_HEIGHT + 14
+        ops.append(_line_op(y + 12))
+        ops.append(_text_op(LABEL_X, y, '實領薪資', 14))
+        ops.append(_right_op(VALUE_X, y, FORMATS['money'](slip.get('net_salary')), 14))
+
+        content = ''.join(ops).encode('ascii')
+        objects = dict(self.objects)
+        objects[4] = b'4 0 obj\n<< /Length %d >>\nstream\n%s\nendstream\nendobj\n' % (len(content), content)
+
+        output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number in sorted(objects):
+            offsets.append(len(output))
+            output += objects[number]
+
+        xref_offset = len(output)
+        output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1)
+        output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets) + 1, xref_offset)
+        return bytes(output)
+
+
+# 工作程序內的版面（每個程序初始化時編譯一次）
+_worker_template = None
+
+
+def init_worker(company_name, year, month):
+    global _worker_template
+    _worker_template = PayslipTemplate(company_name, year, month)
+
+
+def render_payslip(slip):
+    """於工作程序內產生一張薪資單，回傳 (檔名, PDF 位元組)"""
+    return slip['filename'], _worker_template.render(slip)
+
+
+def render_payslips(slip_chunks, company_name, year, month, processes=None):
+    """平行產生整批薪資單，依輸入順序逐張產生 (檔名, PDF 位元組)
+
+    slip_chunks 為分批的薪資單資料，一次只送出一批給程序池，記憶體用量與總人數無關。
+    processes 為 1 時在目前程序內依序產生（不建立程序池）。
+    """
+    processes = processes or os.cpu_count() or 1
+
+    if processes == 1:
+        init_worker(company_name, year, month)
+        for chunk in slip_chunks:
+            yield from map(render_payslip, chunk)
+        return
+
+    # 主程式有背景執行緒（稽核寫入、通知派送）與資料庫連線，fork 可能複製到持有中的鎖而卡住；
+    # 改由 forkserver（不支援時用 spawn）建立乾淨的工作程序，版面由 init_worker 在各程序重建
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker,
+                             initargs=(company_name, year, month)) as executor:
+        for chunk in slip_chunks:
+            yield from executor.map(render_payslip, chunk, chunksize=max(1, len(chunk) // (processes * 4)))
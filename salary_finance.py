@@ -1,13 +1,35 @@
 # payroll_system.py - 修正後的完整薪資計算系統
-from flask import Flask, request, abort, render_template_string, jsonify
+from flask import Flask, request, abort, render_template_string, jsonify, Response, stream_with_context
 import sqlite3
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import pytz
 import calendar
 import json
+import threading
+import csv
+import io
+import tempfile
+import hashlib
+from contextlib import contextmanager
+from functools import wraps
 from decimal import Decimal, ROUND_HALF_UP
 
+from payroll_rules import DEDUCTION_RULES, compile_rules
+from payroll_repository import (
+    AttendanceRepository, PayrollRepository, ensure_punch_epochs, ensure_rollup_tables,
+    ensure_config_version, config_version
+)
+from stats_cache import StatsCache, conditional_json
+
+# XLSX 匯出（選用）
+try:
+    from openpyxl import Workbook
+    XLSX_AVAILABLE = True
+except ImportError:
+    Workbook = None
+    XLSX_AVAILABLE = False
+
 # LINE Bot SDK v2 - 修正導入問題
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
@@ -54,10 +76,91 @@ handler = WebhookHandler(WEBHOOK_SECRET)
 # 台灣時區設定
 TW_TZ = pytz.timezone('Asia/Taipei')
 
+# 扣款規則與 complete_payroll_system 共用（見 payroll_rules.DEDUCTION_RULES），
+# 但只取本系統原有的扣款項目：就業保險、工會費與借支扣款不在本系統的實領薪資中扣除
+DEDUCTION_ITEMS = ('labor_insurance', 'health_insurance', 'pension', 'income_tax', 'other_deductions')
+SALARY_DEDUCTION_RULES = [rule for rule in DEDUCTION_RULES if rule['item'] in DEDUCTION_ITEMS]
+
+# 扣款明細備註
+DEDUCTION_NOTES = {
+    'labor_insurance': '員工負擔部分',
+    'health_insurance': '員工負擔部分',
+    'pension': '6%提撥',
+    'income_tax': '預扣稅額',
+    'other_deductions': '其他項目'
+}
+
+# 資料庫連線提供者
+class ConnectionProvider:
+    """整個程序共用一條 SQLite 連線，以可重入鎖序列化各執行緒的存取"""
+    
+    def __init__(self, db_path='attendance.db'):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self._conn = None
+    
+    def connection(self):
+        """取得共用連線（第一次使用時才建立）"""
+        with self.lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            return self._conn
+    
+    @contextmanager
+    def session(self):
+        """持有鎖並取得連線，區塊內的查詢不會與其他執行緒交錯；發生例外時捨棄未提交的寫入"""
+        with self.lock:
+            try:
+                yield self.connection()
+            except Exception:
+                self.rollback()
+                raise
+    
+    def rollback(self):
+        """捨棄共用連線上未提交的寫入，避免由下一個使用連線的執行緒一併提交"""
+        with self.lock:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.rollback()
+    
+    @contextmanager
+    def reader(self):
+        """另開一條唯讀連線，供長時間串流查詢使用（不持有共用連線鎖）"""
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def synchronized(method):
+    """方法執行期間持有連線鎖（服務物件需有 self.db 連線提供者），發生例外時捨棄未提交的寫入"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.db.lock:
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                self.db.rollback()
+                raise
+    return wrapper
+
+# 資料庫路徑（搬移到統一資料庫後可指向 payroll_system.db）
+DB_PATH = os.environ.get('SALARY_DB_PATH', 'attendance.db')
+
+db_provider = ConnectionProvider(DB_PATH)
+
+# 統計 API 快取（薪資寫入後失效）
+stats_cache = StatsCache(ttl=15)
+
 # 初始化用戶管理
 def init_user_management():
     """初始化用戶管理資料表"""
-    conn = sqlite3.connect('attendance.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     # 用戶表
@@ -88,67 +191,46 @@ def init_user_management():
 
 # 用戶管理功能
 def create_or_get_user(user_id):
-    """創建或取得用戶"""
+    """創建或取得用戶（資料表於啟動時建立，此處不執行 DDL）"""
     try:
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        
-        # 確保表存在
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT UNIQUE,
-                name TEXT,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        with db_provider.session() as conn:
+            cursor = conn.cursor()
+            
+            # 檢查用戶是否存在
+            cursor.execute('SELECT id, name FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS attendance_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                action_type TEXT,
-                taiwan_time TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
+        if user:
+            return True
         
-        # 檢查用戶是否存在
-        cursor.execute('SELECT id, name FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        # 取得 LINE 用戶資訊為網路呼叫，不持有共用連線鎖
+        try:
+            profile = line_bot_api.get_profile(user_id)
+            user_name = profile.display_name
+        except:
+            user_name = f"用戶{user_id[-4:]}"
         
-        if not user:
-            # 創建新用戶
-            try:
-                # 嘗試取得用戶資訊
-                profile = line_bot_api.get_profile(user_id)
-                user_name = profile.display_name
-            except:
-                user_name = f"用戶{user_id[-4:]}"
-            
+        with db_provider.session() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR IGNORE INTO users (user_id, name) VALUES (?, ?)
             ''', (user_id, user_name))
-            
+            created = cursor.rowcount > 0
             conn.commit()
-            print(f"✅ 新用戶已創建: {user_name} ({user_id})")
         
-        conn.close()
+        if created:
+            print(f"✅ 新用戶已創建: {user_name} ({user_id})")
         return True
         
     except Exception as e:
         print(f"❌ 創建用戶時發生錯誤: {e}")
-        if 'conn' in locals():
-            conn.close()
         return False
 
 # 初始化薪資相關資料庫
 def init_payroll_db():
     """初始化薪資計算相關資料表"""
     try:
-        conn = sqlite3.connect('attendance.db')
+        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         
         # 用戶表 (確保存在)
@@ -250,6 +332,11 @@ def init_payroll_db():
             )
         ''')
         
+        # 薪資查詢索引（依月份讀取記錄、依記錄讀取明細）
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_records_period ON payroll_records (period_year, period_month)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_details_record ON payroll_details (payroll_record_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_payroll_records_user_period ON payroll_records (user_id, period_year)')
+        
         # 薪資設定表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS payroll_settings (
@@ -288,16 +375,32 @@ def init_payroll_db():
 
 # 薪資計算引擎
 class PayrollCalculator:
-    def __init__(self):
+    """薪資計算服務：啟動時建立一次，所有訊息共用；資料表只在建立時檢查一次"""
+    
+    def __init__(self, provider=None):
+        self.db = provider or db_provider
+        self.attendance_repo = AttendanceRepository(self.db.session)
+        self.payroll_repo = PayrollRepository(self.db.session)
+        self._deduction_plans = {}  # 計薪月份 → 編譯後的扣款規則
+        self._config_version = None
+        self._cursor = None
         try:
-            self.conn = sqlite3.connect('attendance.db')
-            self.cursor = self.conn.cursor()
             # 確保必要的表存在
-            self._ensure_tables_exist()
+            with self.db.lock:
+                self._ensure_tables_exist()
         except Exception as e:
             print(f"❌ 薪資計算器初始化失敗: {e}")
-            self.conn = None
-            self.cursor = None
+    
+    @property
+    def conn(self):
+        return self.db.connection()
+    
+    @property
+    def cursor(self):
+        # 共用游標只在持有連線鎖時使用
+        if self._cursor is None:
+            self._cursor = self.conn.cursor()
+        return self._cursor
     
     def _ensure_tables_exist(self):
         """確保所有必要的表都存在"""
@@ -336,32 +439,75 @@ class PayrollCalculator:
                 )
             ''')
             
+            # 打卡時間改存 epoch 秒數（含產生的日期欄位與索引），並回填既有記錄
+            backfilled = ensure_punch_epochs(self.conn)
+            if backfilled:
+                print(f"✅ 已回填 {backfilled} 筆打卡記錄的時間欄位")
+            
+            # 年度薪資彙總（每人每年一列）
+            ensure_rollup_tables(self.conn)
+            
+            # 計薪設定版本（設定異動時重新編譯扣款規則）
+            ensure_config_version(self.conn)
+            
             self.conn.commit()
         except Exception as e:
             print(f"❌ 確保表存在時發生錯誤: {e}")
     
-    def __del__(self):
-        if hasattr(self, 'conn') and self.conn:
-            self.conn.close()
-    
+    @synchronized
     def get_setting(self, key, default=0):
         """取得系統設定值"""
         if not self.cursor:
             return default
             
         try:
-            self.cursor.execute('SELECT setting_value FROM payroll_settings WHERE setting_key = ?', (key,))
-            result = self.cursor.fetchone()
-            if result:
+            value = self.payroll_repo.get_settings(self.cursor).get(key)
+            if value is not None:
                 try:
-                    return float(result[0])
+                    return float(value)
                 except:
-                    return result[0]
+                    return value
         except Exception as e:
             print(f"❌ 取得設定值時發生錯誤: {e}")
         
         return default
     
+    @synchronized
+    def get_settings(self):
+        """取得所有薪資設定 {setting_key: setting_value}"""
+        if not self.cursor:
+            return {}
+        
+        try:
+            return self.payroll_repo.get_settings(self.cursor)
+        except Exception as e:
+            print(f"❌ 取得設定值時發生錯誤: {e}")
+            return {}
+    
+    @synchronized
+    def get_deduction_plan(self, period_start=None):
+        """取得編譯後的扣款規則（每個計薪月份編譯一次，設定版本改變時重新編譯）
+
+        資料庫有投保級距與扣繳稅額表（統一格式）時一併載入，沒有時依規則以薪資與起徵點計算。
+        """
+        version = config_version(self.cursor)
+        if version != self._config_version:
+            self._deduction_plans = {}
+            self._config_version = version
+        
+        period_start = period_start or datetime.now(TW_TZ).date().replace(day=1)
+        plan = self._deduction_plans.get(period_start)
+        if plan is None:
+            tables = self.payroll_repo.get_insurance_brackets(self.cursor, period_start)
+            withholding_table = self.payroll_repo.get_withholding_table(self.cursor, period_start.year)
+            if withholding_table:
+                tables['withholding'] = withholding_table
+            
+            plan = compile_rules(SALARY_DEDUCTION_RULES, self.get_settings(), tables)
+            self._deduction_plans[period_start] = plan
+        return plan
+    
+    @synchronized
     def get_user_salary_structure(self, user_id):
         """取得用戶薪資結構"""
         self.cursor.execute('''
@@ -397,44 +543,26 @@ class PayrollCalculator:
             'other_allowances': 0
         }
     
+    @synchronized
     def get_user_deductions(self, user_id):
-        """取得用戶扣款設定"""
+        """取得用戶扣款設定 {扣款項目: 金額, 'tax_dependents': 扶養人數}（舊版資料表沒有的欄位為 0）"""
         self.cursor.execute('''
-            SELECT labor_insurance, health_insurance, income_tax, pension, other_deductions
-            FROM salary_deductions 
+            SELECT * FROM salary_deductions 
             WHERE user_id = ? 
             ORDER BY effective_date DESC LIMIT 1
         ''', (user_id,))
         
-        result = self.cursor.fetchone()
-        if result:
-            return {
-                'labor_insurance': result[0] or 0,
-                'health_insurance': result[1] or 0,
-                'income_tax': result[2] or 0,
-                'pension': result[3] or 0,
-                'other_deductions': result[4] or 0
-            }
-        
-        return {
-            'labor_insurance': 0,
-            'health_insurance': 0,
-            'income_tax': 0,
-            'pension': 0,
-            'other_deductions': 0
-        }
+        columns = [column[0] for column in self.cursor.description]
+        result = dict(zip(columns, self.cursor.fetchone() or ()))
+        fields = list(DEDUCTION_ITEMS) + ['tax_dependents']
+        return {field: result.get(field) or 0 for field in fields}
     
+    @synchronized
     def calculate_work_hours(self, user_id, year, month):
         """計算指定月份的工作時數"""
-        # 取得該月份的所有打卡記錄
-        self.cursor.execute('''
-            SELECT action_type, taiwan_time, DATE(taiwan_time) as work_date
-            FROM attendance_records 
-            WHERE user_id = ? AND strftime('%Y', taiwan_time) = ? AND strftime('%m', taiwan_time) = ?
-            ORDER BY taiwan_time
-        ''', (user_id, str(year), f"{month:02d}"))
-        
-        records = self.cursor.fetchall()
+        # 取得該月份的所有打卡記錄（日期範圍查詢，動作統一為 clock_in / clock_out）
+        last_day = calendar.monthrange(year, month)[1]
+        punches = self.attendance_repo.iter_punches(user_id, f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day:02d}")
         
         # 按日期分組計算工時
         daily_hours = {}
@@ -443,17 +571,16 @@ class PayrollCalculator:
         current_date = None
         clock_in_time = None
         
-        for action_type, time_str, work_date in records:
+        for action_type, time_obj in punches:
+            work_date = time_obj.strftime('%Y-%m-%d')
             if work_date != current_date:
                 current_date = work_date
                 clock_in_time = None
             
-            time_obj = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-            
-            if action_type == '上班':
+            if action_type == 'clock_in':
                 clock_in_time = time_obj
                 work_days.add(work_date)
-            elif action_type == '下班' and clock_in_time:
+            elif action_type == 'clock_out' and clock_in_time:
                 # 計算當日工時
                 work_hours = (time_obj - clock_in_time).total_seconds() / 3600
                 daily_hours[work_date] = daily_hours.get(work_date, 0) + work_hours
@@ -467,7 +594,7 @@ class PayrollCalculator:
         regular_hours = 0
         overtime_hours = 0
         
-        for date, hours in daily_hours.items():
+        for day, hours in daily_hours.items():
             if hours <= standard_hours:
                 regular_hours += hours
             else:
@@ -482,8 +609,55 @@ class PayrollCalculator:
             'daily_hours': daily_hours
         }
     
+    @synchronized
     def calculate_monthly_payroll(self, user_id, year, month):
         """計算指定月份的薪資"""
+        payroll_data, deductions = self._calculate_gross(user_id, year, month)
+        gross_salary = payroll_data['calculations']['gross_salary']
+        
+        # 扣款計算（扣款設定不為 0 時使用設定值，否則依規則自動計算）
+        plan = self.get_deduction_plan(date(year, month, 1))
+        self._apply_deductions(payroll_data, plan.evaluate(dict(deductions, gross_salary=gross_salary)))
+        return payroll_data
+    
+    @synchronized
+    def calculate_monthly_payroll_batch(self, user_ids, year, month):
+        """批次計算多位員工的月薪資：各自算出應發薪資後，扣款規則整欄運算一次
+
+        回傳 {user_id: 薪資資料}，計算失敗的員工對應其例外。
+        """
+        results = {}
+        rows = []
+        for user_id in user_ids:
+            try:
+                payroll_data, deductions = self._calculate_gross(user_id, year, month)
+            except Exception as e:
+                results[user_id] = e
+                continue
+            results[user_id] = payroll_data
+            rows.append(dict(deductions, gross_salary=payroll_data['calculations']['gross_salary']))
+        
+        calculated = [user_id for user_id in user_ids if not isinstance(results[user_id], Exception)]
+        plan = self.get_deduction_plan(date(year, month, 1))
+        for user_id, deduction_details in zip(calculated, plan.evaluate_batch(rows)):
+            self._apply_deductions(results[user_id], deduction_details)
+        return results
+    
+    def _apply_deductions(self, payroll_data, deduction_details):
+        """將扣款明細併入薪資資料並計算實領薪資"""
+        calculations = payroll_data['calculations']
+        total_deductions = deduction_details.pop('total_deductions')
+        calculations['total_deductions'] = round(total_deductions, 0)
+        
+        # 實領薪資
+        net_salary = calculations['gross_salary'] - total_deductions
+        calculations['net_salary'] = round(net_salary, 0)
+        
+        # 詳細扣款項目
+        calculations['deduction_details'] = deduction_details
+    
+    def _calculate_gross(self, user_id, year, month):
+        """計算工時與應發薪資，回傳 (薪資資料, 扣款設定)；呼叫端需持有連線鎖"""
         
         # 取得工時資料
         work_data = self.calculate_work_hours(user_id, year, month)
@@ -528,155 +702,82 @@ class PayrollCalculator:
                        calculations['allowances'])
         calculations['gross_salary'] = round(gross_salary, 0)
         
-        # 扣款計算
-        if deductions['labor_insurance'] == 0:
-            # 自動計算勞保費 (以薪資總額計算)
-            labor_insurance_rate = self.get_setting('labor_insurance_rate', 0.105)
-            labor_insurance = gross_salary * labor_insurance_rate * 0.2  # 員工負擔20%
-        else:
-            labor_insurance = deductions['labor_insurance']
-        
-        if deductions['health_insurance'] == 0:
-            # 自動計算健保費
-            health_insurance_rate = self.get_setting('health_insurance_rate', 0.0517)
-            health_insurance = gross_salary * health_insurance_rate * 0.3  # 員工負擔30%
-        else:
-            health_insurance = deductions['health_insurance']
-        
-        if deductions['pension'] == 0:
-            # 自動計算退休金提撥
-            pension_rate = self.get_setting('pension_rate', 0.06)
-            pension = gross_salary * pension_rate
-        else:
-            pension = deductions['pension']
-        
-        # 所得稅計算 (簡化版)
-        income_tax_threshold = self.get_setting('income_tax_threshold', 40000)
-        if gross_salary > income_tax_threshold and deductions['income_tax'] == 0:
-            income_tax = (gross_salary - income_tax_threshold) * 0.05  # 簡化稅率5%
-        else:
-            income_tax = deductions['income_tax']
-        
-        total_deductions = (labor_insurance + health_insurance + 
-                           pension + income_tax + deductions['other_deductions'])
-        calculations['total_deductions'] = round(total_deductions, 0)
-        
-        # 實領薪資
-        net_salary = gross_salary - total_deductions
-        calculations['net_salary'] = round(net_salary, 0)
-        
-        # 詳細扣款項目
-        calculations['deduction_details'] = {
-            'labor_insurance': round(labor_insurance, 0),
-            'health_insurance': round(health_insurance, 0),
-            'pension': round(pension, 0),
-            'income_tax': round(income_tax, 0),
-            'other_deductions': round(deductions['other_deductions'], 0)
-        }
-        
-        return {
+        payroll_data = {
             'work_data': work_data,
             'calculations': calculations,
             'salary_structure': salary_structure
         }
+        return payroll_data, deductions
     
+    @synchronized
     def save_payroll_record(self, user_id, year, month, payroll_data):
-        """儲存薪資計算記錄"""
+        """儲存薪資計算記錄（已確認或已發放的記錄不覆寫，回傳原記錄 id）"""
         work_data = payroll_data['work_data']
         calc = payroll_data['calculations']
         
-        # 檢查是否已存在記錄
-        self.cursor.execute('''
-            SELECT id FROM payroll_records 
-            WHERE user_id = ? AND period_year = ? AND period_month = ?
-        ''', (user_id, year, month))
-        
-        existing = self.cursor.fetchone()
-        
-        if existing:
-            # 更新現有記錄
-            self.cursor.execute('''
-                UPDATE payroll_records SET
-                    total_work_hours = ?, regular_hours = ?, overtime_hours = ?,
-                    work_days = ?, base_salary = ?, overtime_pay = ?, holiday_pay = ?,
-                    allowances = ?, gross_salary = ?, total_deductions = ?, net_salary = ?,
-                    calculated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (
-                work_data['total_hours'], work_data['regular_hours'], work_data['overtime_hours'],
-                work_data['work_days'], calc['base_salary'], calc['overtime_pay'], calc['holiday_pay'],
-                calc['allowances'], calc['gross_salary'], calc['total_deductions'], calc['net_salary'],
-                existing[0]
-            ))
-            record_id = existing[0]
-        else:
-            # 新增記錄
-            self.cursor.execute('''
-                INSERT INTO payroll_records (
-                    user_id, period_year, period_month, total_work_hours, regular_hours, 
-                    overtime_hours, work_days, base_salary, overtime_pay, holiday_pay,
-                    allowances, gross_salary, total_deductions, net_salary
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id, year, month, work_data['total_hours'], work_data['regular_hours'],
-                work_data['overtime_hours'], work_data['work_days'], calc['base_salary'],
-                calc['overtime_pay'], calc['holiday_pay'], calc['allowances'],
-                calc['gross_salary'], calc['total_deductions'], calc['net_salary']
-            ))
-            record_id = self.cursor.lastrowid
-        
-        # 清除舊的明細記錄
-        self.cursor.execute('DELETE FROM payroll_details WHERE payroll_record_id = ?', (record_id,))
+        existing = self.payroll_repo.get_record(self.cursor, user_id, year, month)
+        if existing and existing[1] in self.payroll_repo.LOCKED_STATUSES:
+            return existing[0]
+        
+        # 新增或更新當月記錄（欄位名稱依資料庫格式對應）
+        record_id = self.payroll_repo.save_record(self.cursor, user_id, year, month, {
+            'total_work_hours': work_data['total_hours'],
+            'regular_hours': work_data['regular_hours'],
+            'overtime_hours': work_data['overtime_hours'],
+            'work_days': work_data['work_days'],
+            'base_salary': calc['base_salary'],
+            'overtime_pay': calc['overtime_pay'],
+            'holiday_pay': calc['holiday_pay'],
+            'total_allowances': calc['allowances'],
+            'gross_salary': calc['gross_salary'],
+            'total_deductions': calc['total_deductions'],
+            'net_salary': calc['net_salary']
+        })
         
-        # 新增薪資明細
+        # 以新的薪資明細取代舊明細
         details = [
             ('salary', '基本薪資', calc['base_salary'], f"工時: {work_data['regular_hours']}小時"),
             ('salary', '加班費', calc['overtime_pay'], f"加班: {work_data['overtime_hours']}小時"),
-            ('allowance', '各項津貼', calc['allowances'], '津貼總計'),
-            ('deduction', '勞保費', calc['deduction_details']['labor_insurance'], '員工負擔部分'),
-            ('deduction', '健保費', calc['deduction_details']['health_insurance'], '員工負擔部分'),
-            ('deduction', '退休金', calc['deduction_details']['pension'], '6%提撥'),
-            ('deduction', '所得稅', calc['deduction_details']['income_tax'], '預扣稅額'),
-            ('deduction', '其他扣款', calc['deduction_details']['other_deductions'], '其他項目')
+            ('allowance', '各項津貼', calc['allowances'], '津貼總計')
+        ] + [
+            ('deduction', rule['label'], calc['deduction_details'].get(rule['item'], 0), DEDUCTION_NOTES.get(rule['item']))
+            for rule in SALARY_DEDUCTION_RULES
         ]
-        
-        for item_type, item_name, amount, notes in details:
-            if amount > 0:  # 只記錄有金額的項目
-                self.cursor.execute('''
-                    INSERT INTO payroll_details (payroll_record_id, item_type, item_name, amount, notes)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (record_id, item_type, item_name, amount, notes))
+        self.payroll_repo.replace_details(self.cursor, record_id, details)
+        self.payroll_repo.refresh_year_rollup(self.cursor, user_id, year)
         
         self.conn.commit()
+        stats_cache.invalidate('payroll')
         return record_id
 
 # 薪資管理類
 class PayrollManager:
-    def __init__(self):
-        self.calculator = PayrollCalculator()
+    def __init__(self, calculator=None):
+        self.calculator = calculator or PayrollCalculator()
+        self.db = self.calculator.db
         self.line_bot_api = line_bot_api
     
     def set_user_salary_structure(self, user_id, salary_data):
         """設定用戶薪資結構"""
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO salary_structures (
-                user_id, base_salary, hourly_rate, overtime_rate, holiday_rate,
-                position_allowance, transport_allowance, meal_allowance, other_allowances,
-                effective_date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, DATE('now'))
-        ''', (
-            user_id, salary_data.get('base_salary', 0), salary_data.get('hourly_rate', 183),
-            salary_data.get('overtime_rate', 1.33), salary_data.get('holiday_rate', 2.0),
-            salary_data.get('position_allowance', 0), salary_data.get('transport_allowance', 0),
-            salary_data.get('meal_allowance', 0), salary_data.get('other_allowances', 0)
-        ))
-        
-        conn.commit()
-        conn.close()
+        with self.db.session() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO salary_structures (
+                    user_id, base_salary, hourly_rate, overtime_rate, holiday_rate,
+                    position_allowance, transport_allowance, meal_allowance, other_allowances,
+                    effective_date
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, DATE('now'))
+            ''', (
+                user_id, salary_data.get('base_salary', 0), salary_data.get('hourly_rate', 183),
+                salary_data.get('overtime_rate', 1.33), salary_data.get('holiday_rate', 2.0),
+                salary_data.get('position_allowance', 0), salary_data.get('transport_allowance', 0),
+                salary_data.get('meal_allowance', 0), salary_data.get('other_allowances', 0)
+            ))
+            
+            conn.commit()
     
+    @synchronized
     def calculate_and_save_payroll(self, user_id, year=None, month=None):
         """計算並儲存薪資"""
         if not year or not month:
@@ -713,12 +814,11 @@ class PayrollManager:
         """創建文字版薪資單"""
         
         # 取得用戶名稱
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM users WHERE user_id = ?', (user_id,))
-        user_result = cursor.fetchone()
-        user_name = user_result[0] if user_result else "員工"
-        conn.close()
+        with self.db.session() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name FROM users WHERE user_id = ?', (user_id,))
+            user_result = cursor.fetchone()
+            user_name = user_result[0] if user_result else "員工"
         
         payslip_text = f"""💰 薪資單
 {year}年{month}月
@@ -757,12 +857,11 @@ ${int(calculations['net_salary']):,}
         """創建Flex Message薪資單"""
         
         # 取得用戶名稱
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM users WHERE user_id = ?', (user_id,))
-        user_result = cursor.fetchone()
-        user_name = user_result[0] if user_result else "員工"
-        conn.close()
+        with self.db.session() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name FROM users WHERE user_id = ?', (user_id,))
+            user_result = cursor.fetchone()
+            user_name = user_result[0] if user_result else "員工"
         
         bubble = BubbleContainer(
             body=BoxComponent(
@@ -968,19 +1067,18 @@ ${int(calculations['net_salary']):,}
     
     def get_payroll_history(self, user_id, limit=6):
         """取得薪資歷史記錄"""
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT period_year, period_month, net_salary, gross_salary, total_work_hours, status
-            FROM payroll_records 
-            WHERE user_id = ? 
-            ORDER BY period_year DESC, period_month DESC 
-            LIMIT ?
-        ''', (user_id, limit))
-        
-        records = cursor.fetchall()
-        conn.close()
+        with self.db.session() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT period_year, period_month, net_salary, gross_salary, total_work_hours, status
+                FROM payroll_records 
+                WHERE user_id = ? 
+                ORDER BY period_year DESC, period_month DESC 
+                LIMIT ?
+            ''', (user_id, limit))
+            
+            records = cursor.fetchall()
         
         if not records:
             return TextSendMessage(text="📋 目前沒有薪資記錄")
@@ -998,9 +1096,10 @@ ${int(calculations['net_salary']):,}
 
 # 擴展訊息處理器
 class PayrollMessageProcessor:
-    def __init__(self):
-        self.payroll_manager = PayrollManager()
-        self.calculator = PayrollCalculator()
+    def __init__(self, payroll_manager=None):
+        self.payroll_manager = payroll_manager or PayrollManager()
+        self.calculator = self.payroll_manager.calculator
+        self.db = self.calculator.db
     
     def process_payroll_command(self, user_id, message_text):
         """處理薪資相關指令"""
@@ -1037,35 +1136,27 @@ class PayrollMessageProcessor:
             """)
         
         elif '薪資統計' in message_text:
-            # 年度薪資統計
-            return self.generate_yearly_stats(user_id)
+            # 年度薪資統計（可指定年度，例如「薪資統計 2023」）
+            year_text = message_text.replace('薪資統計', '').strip()
+            year = int(year_text) if year_text.isdigit() else None
+            return self.generate_yearly_stats(user_id, year)
         
         else:
             return None
     
-    def generate_yearly_stats(self, user_id):
-        """生成年度薪資統計"""
-        current_year = datetime.now(TW_TZ).year
-        
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as months_count,
-                SUM(net_salary) as total_net,
-                SUM(gross_salary) as total_gross,
-                SUM(total_work_hours) as total_hours,
-                AVG(net_salary) as avg_net
-            FROM payroll_records 
-            WHERE user_id = ? AND period_year = ?
-        ''', (user_id, current_year))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result and result[0] > 0:
-            months_count, total_net, total_gross, total_hours, avg_net = result
+    def generate_yearly_stats(self, user_id, year=None):
+        """生成年度薪資統計（讀取年度彙總，不重新加總薪資記錄）"""
+        current_year = year or datetime.now(TW_TZ).year
+        
+        with self.db.session() as conn:
+            rollup = self.calculator.payroll_repo.get_year_rollup(conn.cursor(), user_id, current_year)
+        
+        if rollup and rollup['months'] > 0:
+            months_count = rollup['months']
+            total_net = rollup['net_salary']
+            total_gross = rollup['gross_salary']
+            total_hours = rollup['total_work_hours']
+            avg_net = total_net / months_count
             
             stats_text = f"📊 {current_year}年薪資統計\n"
             stats_text += "─" * 25 + "\n"
@@ -1079,33 +1170,98 @@ class PayrollMessageProcessor:
                 hourly_rate = total_net / total_hours
                 stats_text += f"💵 平均時薪: ${hourly_rate:.0f}\n"
             
+            if rollup['deduction_items']:
+                stats_text += "─" * 25 + "\n"
+                for item_name, amount in rollup['deduction_items'].items():
+                    stats_text += f"📉 {item_name}: ${int(amount):,}\n"
+            
             return TextSendMessage(text=stats_text)
         else:
             return TextSendMessage(text=f"📊 {current_year}年尚無薪資記錄")
 
+# 試算表會把這些字元開頭的文字當成公式（員工姓名取自 LINE 顯示名稱，由使用者自訂）
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def spreadsheet_safe(row):
+    """匯出用：可能被解讀為公式的文字欄位前加上 ' ，數值欄位不變"""
+    return [
+        "'" + value if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value
+        for value in row
+    ]
+
 # 管理員薪資功能
 class AdminPayrollManager:
-    def __init__(self):
-        self.payroll_manager = PayrollManager()
+    def __init__(self, payroll_manager=None):
+        self.payroll_manager = payroll_manager or PayrollManager()
+        self.db = self.payroll_manager.db
     
     def set_employee_salary(self, user_id, salary_data):
         """設定員工薪資結構"""
         return self.payroll_manager.set_user_salary_structure(user_id, salary_data)
     
+    def iter_payroll_csv(self, year, month, chunk_size=500):
+        """逐批產生當月薪資匯出 CSV（UTF-8 BOM，Excel 可直接開啟中文）"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        
+        buffer.write('\ufeff')
+        writer.writerow([title for title, _ in PayrollRepository.EXPORT_COLUMNS])
+        yield buffer.getvalue()
+        
+        # 另開連線串流讀取，不佔用共用連線鎖
+        with self.db.reader() as conn:
+            for rows in self.payroll_manager.calculator.payroll_repo.iter_export_rows(conn.cursor(), year, month, chunk_size):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(spreadsheet_safe(row) for row in rows)
+                yield buffer.getvalue()
+    
+    def iter_year_end_statements(self, year, chunk_size=500):
+        """逐批產生年度所得彙總（JSON Lines，每位員工一行）"""
+        with self.db.reader() as conn:
+            for rows in self.payroll_manager.calculator.payroll_repo.iter_year_rollups(conn.cursor(), year, chunk_size):
+                yield ''.join(json.dumps(statement, ensure_ascii=False) + '\n' for statement in rows)
+    
+    def iter_payroll_xlsx(self, year, month, chunk_size=500):
+        """產生當月薪資匯出 XLSX（write_only 模式逐列寫入暫存檔，整份產生完成後才分段送出）"""
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(f"{year}-{month:02d}")
+        sheet.append([title for title, _ in PayrollRepository.EXPORT_COLUMNS])
+        
+        with self.db.reader() as conn:
+            for rows in self.payroll_manager.calculator.payroll_repo.iter_export_rows(conn.cursor(), year, month, chunk_size):
+                for row in rows:
+                    sheet.append(spreadsheet_safe(row))
+        
+        with tempfile.TemporaryFile() as output:
+            workbook.save(output)
+            output.seek(0)
+            while True:
+                data = output.read(64 * 1024)
+                if not data:
+                    break
+                yield data
+
     def calculate_all_payroll(self, year, month):
         """計算所有員工薪資"""
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
+        with self.db.session() as conn:
+            cursor = conn.cursor()
+            
+            # 取得所有員工
+            cursor.execute('SELECT user_id, name FROM users WHERE status = "active"')
+            employees = cursor.fetchall()
         
-        # 取得所有員工
-        cursor.execute('SELECT user_id, name FROM users WHERE status = "active"')
-        employees = cursor.fetchall()
-        conn.close()
+        # 扣款規則對全體員工整欄運算一次，再逐筆儲存
+        calculator = self.payroll_manager.calculator
+        payrolls = calculator.calculate_monthly_payroll_batch([user_id for user_id, _ in employees], year, month)
         
         results = []
         for user_id, name in employees:
             try:
-                record_id, payroll_data = self.payroll_manager.calculate_and_save_payroll(user_id, year, month)
+                payroll_data = payrolls[user_id]
+                if isinstance(payroll_data, Exception):
+                    raise payroll_data
+                record_id = calculator.save_payroll_record(user_id, year, month, payroll_data)
                 results.append({
                     'user_id': user_id,
                     'name': name,
@@ -1123,6 +1279,11 @@ class AdminPayrollManager:
         
         return results
 
+# 共用服務（啟動時建立一次，各訊息與 API 共用）
+payroll_manager = PayrollManager(PayrollCalculator(db_provider))
+payroll_processor = PayrollMessageProcessor(payroll_manager)
+admin_payroll_manager = AdminPayrollManager(payroll_manager)
+
 # LINE Bot Webhook 處理
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -1261,7 +1422,6 @@ def calculate_payroll_api(user_id):
     month = request.args.get('month', datetime.now().month, type=int)
     
     try:
-        payroll_manager = PayrollManager()
         record_id, payroll_data = payroll_manager.calculate_and_save_payroll(user_id, year, month)
         
         return jsonify({
@@ -1280,20 +1440,19 @@ def get_payroll_history_api(user_id):
     """API: 取得薪資歷史"""
     limit = request.args.get('limit', 12, type=int)
     
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT period_year, period_month, net_salary, gross_salary, 
-               total_work_hours, status, calculated_at
-        FROM payroll_records 
-        WHERE user_id = ? 
-        ORDER BY period_year DESC, period_month DESC 
-        LIMIT ?
-    ''', (user_id, limit))
-    
-    records = cursor.fetchall()
-    conn.close()
+    with db_provider.session() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT period_year, period_month, net_salary, gross_salary, 
+                   total_work_hours, status, calculated_at
+            FROM payroll_records 
+            WHERE user_id = ? 
+            ORDER BY period_year DESC, period_month DESC 
+            LIMIT ?
+        ''', (user_id, limit))
+        
+        records = cursor.fetchall()
     
     history = []
     for record in records:
@@ -1309,35 +1468,32 @@ def get_payroll_history_api(user_id):
     
     return jsonify(history)
 
-@app.route('/api/payroll/stats')
-def get_payroll_stats():
-    """API: 取得薪資統計"""
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
-    
-    # 本月薪資統計
-    current_month = datetime.now().strftime('%Y-%m')
-    cursor.execute('''
-        SELECT COUNT(*), SUM(gross_salary), SUM(net_salary), AVG(total_work_hours)
-        FROM payroll_records 
-        WHERE strftime('%Y-%m', calculated_at) = ?
-    ''', (current_month,))
-    
-    current_stats = cursor.fetchone()
-    
-    # 年度統計
-    current_year = str(datetime.now().year)
-    cursor.execute('''
-        SELECT COUNT(*), SUM(gross_salary), SUM(net_salary), SUM(total_work_hours)
-        FROM payroll_records 
-        WHERE period_year = ?
-    ''', (current_year,))
-    
-    yearly_stats = cursor.fetchone()
-    
-    conn.close()
+def compute_payroll_stats():
+    """計算薪資統計（由 stats_cache 快取）"""
+    with db_provider.reader() as conn:
+        cursor = conn.cursor()
+        
+        # 本月薪資統計
+        current_month = datetime.now().strftime('%Y-%m')
+        cursor.execute('''
+            SELECT COUNT(*), SUM(gross_salary), SUM(net_salary), AVG(total_work_hours)
+            FROM payroll_records 
+            WHERE strftime('%Y-%m', calculated_at) = ?
+        ''', (current_month,))
+        
+        current_stats = cursor.fetchone()
+        
+        # 年度統計
+        current_year = str(datetime.now().year)
+        cursor.execute('''
+            SELECT COUNT(*), SUM(gross_salary), SUM(net_salary), SUM(total_work_hours)
+            FROM payroll_records 
+            WHERE period_year = ?
+        ''', (current_year,))
+        
+        yearly_stats = cursor.fetchone()
     
-    return jsonify({
+    return {
         'current_month': {
             'records': current_stats[0] or 0,
             'total_gross': current_stats[1] or 0,
@@ -1350,7 +1506,107 @@ def get_payroll_stats():
             'total_net': yearly_stats[2] or 0,
             'total_hours': yearly_stats[3] or 0
         }
-    })
+    }
+
+stats_cache.register('payroll_stats', compute_payroll_stats, topics=('payroll',))
+
+@app.route('/api/payroll/stats')
+def get_payroll_stats():
+    """API: 取得薪資統計（快取，支援 ETag / If-None-Match）"""
+    return conditional_json(stats_cache, 'payroll_stats')
+
+def api_permission_error(*permissions):
+    """檢查 Authorization: Bearer <API 金鑰> 的呼叫者是否具指定權限（或 all），通過時回傳 None，否則回傳錯誤回應
+    
+    金鑰由主程式的 LINE「API金鑰」指令核發，需指向統一資料庫才能驗證；資料庫沒有金鑰與角色資料表時一律拒絕。
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    if scheme.lower() != 'bearer' or not token:
+        return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+    
+    with db_provider.reader() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT t.user_id
+                FROM api_tokens t
+                JOIN users u ON t.user_id = u.user_id
+                WHERE t.token_hash = ? AND u.status = 'active'
+            ''', (hashlib.sha256(token.encode()).hexdigest(),))
+            row = cursor.fetchone()
+            if not row:
+                return jsonify({'success': False, 'error': '需提供有效的 API 金鑰'}), 401
+            
+            cursor.execute('''
+                SELECT r.permissions
+                FROM user_roles ur
+                JOIN roles r ON ur.role_id = r.id
+                WHERE ur.user_id = ?
+            ''', (row[0],))
+            role_permissions = [permission for (permission,) in cursor.fetchall()]
+        except sqlite3.OperationalError:
+            return jsonify({'success': False, 'error': '此資料庫未啟用 API 金鑰驗證'}), 401
+    
+    granted = {}
+    for role_permission in role_permissions:
+        try:
+            granted.update(json.loads(role_permission))
+        except (TypeError, ValueError):
+            continue
+    
+    if granted.get('all') or any(granted.get(permission) for permission in permissions):
+        return None
+    return jsonify({'success': False, 'error': '沒有存取薪資資料的權限'}), 403
+
+@app.route('/api/payroll/year-end/<int:year>')
+def get_year_end_statements_api(year):
+    """API: 年度所得彙總（扣繳憑單資料，需薪資權限的 API 金鑰；JSON Lines 每位員工一行，逐批送出）"""
+    error = api_permission_error('payroll')
+    if error:
+        return error
+    
+    return Response(
+        stream_with_context(admin_payroll_manager.iter_year_end_statements(year)),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="year_end_{year}.jsonl"'}
+    )
+
+@app.route('/api/payroll/export')
+def export_payroll_api():
+    """API: 匯出當月薪資（需薪資權限的 API 金鑰）
+    
+    CSV 逐批讀取並邊讀邊送出；format=xlsx 時先在暫存檔產生整份 Excel，完成後才開始送出。
+    """
+    error = api_permission_error('payroll')
+    if error:
+        return error
+    
+    year = request.args.get('year', datetime.now().year, type=int)
+    month = request.args.get('month', datetime.now().month, type=int)
+    export_format = request.args.get('format', 'csv').lower()
+    
+    if not 1 <= month <= 12:
+        return jsonify({'success': False, 'error': 'month 必須為 1-12'}), 400
+    
+    filename = f"payroll_{year}_{month:02d}.{export_format}"
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    
+    if export_format == 'csv':
+        return Response(
+            stream_with_context(admin_payroll_manager.iter_payroll_csv(year, month)),
+            mimetype='text/csv', headers=headers
+        )
+    
+    if export_format == 'xlsx':
+        if not XLSX_AVAILABLE:
+            return jsonify({'success': False, 'error': 'XLSX 匯出需要安裝 openpyxl'}), 501
+        return Response(
+            stream_with_context(admin_payroll_manager.iter_payroll_xlsx(year, month)),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers=headers
+        )
+    
+    return jsonify({'success': False, 'error': 'format 必須為 csv 或 xlsx'}), 400
 
 # 整合到原有的訊息處理
 def handle_payroll_message(event):
@@ -1359,8 +1615,7 @@ def handle_payroll_message(event):
         user_id = event.source.user_id
         message_text = event.message.text
         
-        processor = PayrollMessageProcessor()
-        response = processor.process_payroll_command(user_id, message_text)
+        response = payroll_processor.process_payroll_command(user_id, message_text)
         
         if response:
             line_bot_api.reply_message(event.reply_token, response)
@@ -1391,8 +1646,7 @@ def handle_payroll_postback(event):
         parts = data.split('_')
         year, month = int(parts[2]), int(parts[3])
         
-        processor = PayrollMessageProcessor()
-        response = processor.payroll_manager.generate_payslip_message(user_id, year, month)
+        response = payroll_manager.generate_payslip_message(user_id, year, month)
         line_bot_api.reply_message(event.reply_token, response)
 
 # Flask 首頁路由
@@ -0,0 +1,74 @@
+# stats_cache.py - 統計查詢結果快取（TTL + 依資料類別失效 + ETag）
+#
+# 每個快取項目登記計算函式與其依賴的資料類別（例如 'attendance'、'leave'、'payroll'），
+# 寫入這些資料的程式呼叫 invalidate(類別) 後，下一次讀取才重新查詢；
+# 沒有寫入時最多 ttl 秒重算一次，作為遺漏失效通知時的保險。
+#
+# ETag 由結果內容雜湊而得，內容不變時 ETag 不變，
+# conditional_json() 依 If-None-Match 回傳 304，輪詢的用戶端不需重新下載內容。
+
+import hashlib
+import json
+import threading
+import time
+
+from flask import request, jsonify, make_response
+
+
+class StatsCache:
+    """執行緒安全的統計快取"""
+
+    def __init__(self, ttl=15):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sources = {}  # key → (計算函式, 依賴類別, ttl)
+        self._entries = {}  # key → (結果, ETag, 到期時間)
+        self._versions = {}  # key → 失效次數（計算期間被失效的結果不寫入快取）
+
+    def register(self, key, compute, topics=(), ttl=None):
+        """登記快取項目，compute 不帶參數並回傳可序列化為 JSON 的結果"""
+        with self._lock:
+            self._sources[key] = (compute, frozenset(topics), ttl or self.ttl)
+            self._entries.pop(key, None)
+
+    def get(self, key):
+        """取得 (結果, ETag)，過期或已失效時重新計算"""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and entry[2] > now:
+            return entry[0], entry[1]
+
+        with self._lock:
+            compute, _, ttl = self._sources[key]
+            version = self._versions.get(key, 0)
+
+        # 重新計算不持有鎖，避免慢查詢阻塞其他項目；同時過期時可能重複計算一次
+        value = compute()
+        etag = hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            if self._versions.get(key, 0) == version:
+                self._entries[key] = (value, etag, now + ttl)
+        return value, etag
+
+    def invalidate(self, *topics):
+        """使依賴指定資料類別的項目失效（不帶參數時全部失效）"""
+        with self._lock:
+            for key, (_, key_topics, _) in self._sources.items():
+                if not topics or key_topics.intersection(topics):
+                    self._entries.pop(key, None)
+                    self._versions[key] = self._versions.get(key, 0) + 1
+
+
+def conditional_json(cache, key):
+    """回傳快取結果的 JSON 回應；用戶端 ETag 相符時回傳 304"""
+    value, etag = cache.get(key)
+
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = jsonify(value)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,78 @@
+# 測試共用設定：整個測試過程共用一個暫存目錄中的主程式資料庫
+
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def payroll(tmp_path_factory):
+    """在暫存目錄載入主程式（主程式載入時即以相對路徑建立 payroll_system.db）"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('payroll'))
+    try:
+        module = importlib.import_module('complete_payroll_system')
+        # 背景執行緒與程序結束時的寫入（稽核記錄等）也要寫到暫存資料庫，不能寫回專案目錄
+        module.db_manager.db_path = os.path.abspath(module.db_manager.db_path)
+        yield module
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def salary_finance(tmp_path_factory):
+    """在暫存目錄載入 salary_finance 並建立資料表（資料庫路徑由 SALARY_DB_PATH 指定）"""
+    os.environ['SALARY_DB_PATH'] = str(tmp_path_factory.mktemp('salary_finance') / 'attendance.db')
+    try:
+        module = importlib.import_module('salary_finance')
+        module.init_user_management()
+        module.init_payroll_db()
+        yield module
+    finally:
+        os.environ.pop('SALARY_DB_PATH', None)
+
+
+def add_user(module, user_id, base_salary=None, **deductions):
+    """新增員工；可一併設定月薪與扣款設定（salary_deductions 欄位）"""
+    conn = module.db_manager.get_connection()
+    conn.execute('INSERT OR IGNORE INTO users (user_id, employee_id, name) VALUES (?, ?, ?)',
+                 (user_id, user_id.upper(), user_id))
+    if base_salary is not None:
+        conn.execute('''
+            INSERT INTO salary_structures (user_id, base_salary, effective_date, status)
+            VALUES (?, ?, '2024-01-01', 'active')
+        ''', (user_id, base_salary))
+    if deductions:
+        columns = ', '.join(deductions)
+        conn.execute(f'''
+            INSERT INTO salary_deductions (user_id, {columns}, effective_date)
+            VALUES (?, {', '.join('?' * len(deductions))}, '2024-01-01')
+        ''', (user_id, *deductions.values()))
+    conn.commit()
+    conn.close()
+
+
+def issue_salary_finance_token(module, user_id, permissions):
+    """在 salary_finance 資料庫建立統一資料庫的金鑰與角色資料表，核發具 permissions 權限的 API 金鑰"""
+    token = f'token-{user_id}'
+    with module.db_provider.session() as conn:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY AUTOINCREMENT, role_name TEXT UNIQUE, permissions TEXT);
+            CREATE TABLE IF NOT EXISTS user_roles (user_id TEXT, role_id INTEGER);
+            CREATE TABLE IF NOT EXISTS api_tokens (token_hash TEXT PRIMARY KEY, user_id TEXT);
+        ''')
+        conn.execute('INSERT OR IGNORE INTO users (user_id, name) VALUES (?, ?)', (user_id, user_id))
+        role_id = conn.execute('INSERT INTO roles (role_name, permissions) VALUES (?, ?)',
+                               (f'role-{user_id}', json.dumps(permissions))).lastrowid
+        conn.execute('INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)', (user_id, role_id))
+        conn.execute('INSERT INTO api_tokens (token_hash, user_id) VALUES (?, ?)',
+                     (hashlib.sha256(token.encode()).hexdigest(), user_id))
+        conn.commit()
+    return token
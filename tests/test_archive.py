@@ -0,0 +1,45 @@
+# 歸檔測試：歸檔期間仍可由 _all 視圖查詢與計算工時，還原後搬回熱資料表；未結束的期間不可歸檔
+
+from datetime import datetime
+
+import pytest
+
+from conftest import add_user
+
+
+def count_punches(module, table):
+    conn = module.db_manager.get_connection()
+    count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = 'archive1'").fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_archive_and_restore_period(payroll):
+    add_user(payroll, 'archive1')
+    conn = payroll.db_manager.get_connection()
+    # 2022-07-05 為週二
+    for action_type, punch_time in (('clock_in', '2022-07-05T09:00:00'), ('clock_out', '2022-07-05T17:00:00')):
+        conn.execute('''
+            INSERT INTO attendance_records (user_id, record_date, action_type, record_time, taiwan_time, status)
+            VALUES ('archive1', '2022-07-05', ?, ?, ?, 'normal')
+        ''', (action_type, punch_time + '+08:00', punch_time.replace('T', ' ')))
+    conn.commit()
+    conn.close()
+    archive = payroll.ArchiveManager(payroll.db_manager)
+
+    assert archive.archive_period('attendance_records', 2022, 7) == 2
+    assert count_punches(payroll, 'attendance_records') == 0
+    assert count_punches(payroll, 'attendance_records_all') == 2
+    work_data = payroll.message_handler.attendance_mgr.calculate_work_hours('archive1', 2022, 7)
+    assert work_data['total_hours'] == 8
+
+    assert archive.restore_period('attendance_records', 2022, 7) == 2
+    assert count_punches(payroll, 'attendance_records') == 2
+    assert 'attendance_records_archive_2022' not in archive.list_archive_tables('attendance_records')
+
+
+def test_current_period_cannot_be_archived(payroll):
+    now = datetime.now(payroll.TW_TZ)
+
+    with pytest.raises(ValueError):
+        payroll.ArchiveManager(payroll.db_manager).archive_period('attendance_records', now.year, now.month)
@@ -0,0 +1,45 @@
+# 操作記錄測試：整批寫入 operation_logs；資料庫無法寫入時 log() 不拋出例外，緩衝區有上限
+
+import sqlite3
+
+
+class UnavailableDatabase:
+    def get_connection(self):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_flush_writes_buffered_entries(payroll):
+    logger = payroll.AuditLogger(payroll.db_manager, flush_interval=60)
+    try:
+        logger.log('audit1', 'leave_approved', 'leave_application', {'application_id': 1})
+        logger.log('audit1', 'leave_rejected', 'leave_application', {'application_id': 2})
+
+        assert logger.flush() == 2
+    finally:
+        logger.close()
+
+    conn = payroll.db_manager.get_connection()
+    rows = conn.execute(
+        "SELECT operation_type FROM operation_logs WHERE user_id = 'audit1' ORDER BY id"
+    ).fetchall()
+    conn.close()
+    assert rows == [('leave_approved',), ('leave_rejected',)]
+
+
+def test_failed_writes_stay_buffered_up_to_capacity(payroll):
+    logger = payroll.AuditLogger(UnavailableDatabase(), flush_size=1000, flush_interval=60, capacity=3)
+    try:
+        for n in range(5):
+            logger.log('audit2', f'operation_{n}')
+
+        try:
+            logger.flush()
+        except sqlite3.OperationalError:
+            pass
+
+        # 寫入失敗的記錄放回緩衝區，只保留最新的 capacity 筆
+        assert [entry[1] for entry in logger._buffer] == ['operation_2', 'operation_3', 'operation_4']
+        assert logger.dropped == 2
+    finally:
+        logger._stop_event.set()
+        logger._flush_event.set()
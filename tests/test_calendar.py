@@ -0,0 +1,42 @@
+# 行事曆測試：其他實例設定的特殊日期會使年度索引失效，設定 API 以 API 金鑰辨識管理員
+
+from conftest import add_user
+
+
+def test_calendar_change_invalidates_other_instances(payroll):
+    reader = payroll.WorkCalendar(payroll.db_manager)
+    writer = payroll.WorkCalendar(payroll.db_manager)
+
+    # 2025-03-05 為週三
+    reader.refresh()
+    assert reader.day_type('2025-03-05') == payroll.WorkCalendar.WORKDAY
+
+    writer.set_day('2025-03-05', 'holiday', '臨時假日')
+
+    reader.refresh()
+    assert reader.day_type('2025-03-05') == payroll.WorkCalendar.HOLIDAY
+
+
+def test_calendar_api_requires_admin_token(payroll):
+    add_user(payroll, 'caladmin')
+    payroll.permission_manager.assign_role('caladmin', 'admin', 'test')
+    token = payroll.permission_manager.issue_api_token('caladmin')
+    client = payroll.app.test_client()
+    day = {'date': '2025-03-06', 'day_type': 'holiday', 'name': '臨時假日'}
+
+    # 請求內容中的 created_by 不能代替金鑰
+    response = client.post('/api/calendar/2025', json={**day, 'created_by': 'caladmin'})
+    assert response.status_code == 401
+
+    response = client.post('/api/calendar/2025', json=day, headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+    response = client.post('/api/calendar/2025', json=day, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+
+    conn = payroll.db_manager.get_connection()
+    created_by = conn.execute(
+        "SELECT created_by FROM calendar_days WHERE calendar_date = '2025-03-06'"
+    ).fetchone()[0]
+    conn.close()
+    assert created_by == 'caladmin'
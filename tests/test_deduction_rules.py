@@ -0,0 +1,78 @@
+# 扣款規則測試：扣繳稅額表、投保級距查詢與批次計算（金額依預設 2023、2024 年度資料手算）
+
+from datetime import date
+
+import pytest
+
+from payroll_rules import DEDUCTION_RULES, compile_rules, lookup_bracket
+
+
+@pytest.mark.parametrize('tax_year, gross_salary, dependents, expected', [
+    # 2024：薪資特別扣除 218000 + 標準扣除 131000 + 免稅額 97000 × (1 + 扶養人數)
+    (2024, 40000, 0, 0),        # 年應稅 34000，月扣 142 未達最低扣繳額 2000
+    (2024, 70000, 0, 0),        # 年應稅 394000，月扣 1642 未達 2000
+    (2024, 80000, 0, 2142),     # 年應稅 514000 × 5%
+    (2024, 95000, 0, 3498),     # 590000 × 5% + 104000 × 12%
+    (2024, 95000, 1, 2528),     # 多一位扶養人數再減 97000
+    (2024, 95000, 5, 0),        # 應稅所得為負
+    (2024, 300000, 0, 44375),   # 跨入 30% 級距
+    # 2023 年度使用當年的扣除額與級距
+    (2023, 95000, 0, 3903),
+    # 沒有 2026 年度資料時沿用最近的 2024 年度
+    (2026, 95000, 0, 3498),
+])
+def test_withholding_tax(payroll, tax_year, gross_salary, dependents, expected):
+    table = payroll.db_manager.get_withholding_table(tax_year)
+
+    assert table.lookup(gross_salary, dependents) == expected
+
+
+def test_withholding_table_missing_before_first_year(payroll):
+    assert payroll.db_manager.get_withholding_table(2022) is None
+
+
+@pytest.mark.parametrize('insurance_type, amount, expected', [
+    ('labor', 20000, 27470),    # 低於最低級距以最低級距計
+    ('labor', 27470, 27470),
+    ('labor', 27471, 27600),    # 取不低於薪資的最小級距
+    ('labor', 50000, 45800),    # 超過最高級距以最高級距計
+    ('health', 50000, 50600),
+    ('health', 500000, 219500),
+])
+def test_insurance_bracket_lookup(payroll, insurance_type, amount, expected):
+    brackets = payroll.db_manager.get_insurance_brackets(date(2024, 3, 1))
+
+    assert lookup_bracket(brackets[insurance_type], amount) == expected
+
+
+def test_insurance_brackets_not_yet_effective(payroll):
+    assert payroll.db_manager.get_insurance_brackets(date(2023, 12, 31)) == {}
+
+
+def test_batch_evaluation_matches_single(payroll):
+    tables = payroll.db_manager.get_insurance_brackets(date(2024, 3, 1))
+    tables['withholding'] = payroll.db_manager.get_withholding_table(2024)
+    plan = compile_rules(DEDUCTION_RULES, payroll.db_manager.get_settings(), tables)
+    rows = [
+        {'gross_salary': 28000},
+        {'gross_salary': 50000, 'union_fee': 300},
+        {'gross_salary': 95000, 'tax_dependents': 1, 'labor_insurance': 500},
+    ]
+
+    single = [plan.evaluate(dict(row)) for row in rows]
+
+    assert plan.evaluate_batch(rows) == single
+    assert single[1]['labor_insurance'] == 962     # 45800 × 10.5% × 20%
+    assert single[1]['health_insurance'] == 785    # 50600 × 5.17% × 30%
+    assert single[2]['labor_insurance'] == 500     # 扣款設定不為 0 時直接使用
+    assert single[2]['income_tax'] == 2528
+
+
+def test_salary_finance_keeps_its_own_deduction_items(salary_finance):
+    # salary_finance 與主程式共用扣款規則，但不扣就業保險、工會費與借支扣款
+    plan = salary_finance.payroll_manager.calculator.get_deduction_plan(date(2024, 5, 1))
+    details = plan.evaluate({'gross_salary': 45000, 'union_fee': 300, 'loan_deduction': 1000})
+    total_deductions = details.pop('total_deductions')
+
+    assert set(details) == set(salary_finance.DEDUCTION_ITEMS)
+    assert total_deductions == sum(details.values())
@@ -0,0 +1,29 @@
+# 事件匯流排測試：SSE 連線先送出初始統計，重連時依 Last-Event-ID 補送漏掉的事件
+
+from event_bus import EventBus, sse_stream
+
+
+def test_reconnect_replays_missed_events():
+    bus = EventBus()
+    bus.publish('leave', {'application_ids': [1]})
+    bus.publish('payroll', {'period': '2024-05'})
+    bus.publish('leave', {'application_ids': [2]})
+
+    subscription = bus.subscribe(last_event_id=1)
+    replayed = [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+
+    assert [(event_id, event) for event_id, event, _ in replayed] == [(2, 'payroll'), (3, 'leave')]
+
+
+def test_stream_sends_initial_stats_then_events():
+    bus = EventBus()
+    stream = sse_stream(bus, initial=[('stats', {'pending_leaves': 3})], heartbeat=0.01)
+
+    assert next(stream) == 'retry: 3000\n\n'
+    assert next(stream) == 'event: stats\ndata: {"pending_leaves": 3}\n\n'
+
+    bus.publish('leave', {'status': 'approved'})
+    assert next(stream) == 'id: 1\nevent: leave\ndata: {"status": "approved"}\n\n'
+
+    stream.close()
+    assert not bus.has_subscribers()
@@ -0,0 +1,75 @@
+# 薪資匯出測試：API 金鑰權限、CSV 逐批下載、試算表公式字元處理、參數檢查與年度所得彙總（salary_finance）
+
+import csv
+import io
+import json
+
+from conftest import issue_salary_finance_token
+
+
+def add_payroll_record(module, user_id, name, year, month):
+    with module.db_provider.session() as conn:
+        conn.execute('INSERT OR IGNORE INTO users (user_id, name) VALUES (?, ?)', (user_id, name))
+        conn.execute('''
+            INSERT INTO payroll_records (user_id, period_year, period_month, gross_salary, net_salary)
+            VALUES (?, ?, ?, 40000, 36000)
+        ''', (user_id, year, month))
+        conn.commit()
+
+
+def test_export_streams_csv_with_formula_cells_neutralized(salary_finance):
+    add_payroll_record(salary_finance, 'export1', '=HYPERLINK("http://example.com")', 2024, 5)
+    client = salary_finance.app.test_client()
+    token = issue_salary_finance_token(salary_finance, 'exporthr', {'payroll': True})
+
+    response = client.get('/api/payroll/export?year=2024&month=5', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert 'payroll_2024_05.csv' in response.headers['Content-Disposition']
+
+    text = response.get_data(as_text=True)
+    assert text.startswith('﻿')
+    header, *rows = csv.reader(io.StringIO(text.lstrip('﻿')))
+    assert header[:2] == ['員工ID', '姓名']
+
+    # 以 = 開頭的姓名加上 ' 前綴，試算表不會當作公式執行
+    row = next(row for row in rows if row[0] == 'export1')
+    assert row[1] == '\'=HYPERLINK("http://example.com")'
+
+
+def test_export_requires_payroll_token(salary_finance):
+    client = salary_finance.app.test_client()
+    staff_token = issue_salary_finance_token(salary_finance, 'exportstaff', {'self_payroll': True})
+
+    assert client.get('/api/payroll/export?year=2024&month=5').status_code == 401
+    assert client.get('/api/payroll/export?year=2024&month=5',
+                      headers={'Authorization': 'Bearer not-a-token'}).status_code == 401
+    assert client.get('/api/payroll/export?year=2024&month=5',
+                      headers={'Authorization': f'Bearer {staff_token}'}).status_code == 403
+
+
+def test_export_rejects_bad_parameters(salary_finance):
+    client = salary_finance.app.test_client()
+    headers = {'Authorization': f"Bearer {issue_salary_finance_token(salary_finance, 'exportadmin', {'all': True})}"}
+
+    assert client.get('/api/payroll/export?year=2024&month=13', headers=headers).status_code == 400
+    assert client.get('/api/payroll/export?year=2024&month=5&format=pdf', headers=headers).status_code == 400
+
+
+def test_year_end_statements_stream_as_json_lines(salary_finance):
+    add_payroll_record(salary_finance, 'yearend1', 'yearend1', 2023, 3)
+    add_payroll_record(salary_finance, 'yearend1', 'yearend1', 2023, 4)
+    with salary_finance.db_provider.session() as conn:
+        salary_finance.payroll_manager.calculator.payroll_repo.refresh_year_rollup(conn.cursor(), 'yearend1', 2023)
+        conn.commit()
+    client = salary_finance.app.test_client()
+
+    assert client.get('/api/payroll/year-end/2023').status_code == 401
+
+    token = issue_salary_finance_token(salary_finance, 'yearendhr', {'payroll': True})
+    response = client.get('/api/payroll/year-end/2023', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    statements = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [(statement['user_id'], statement['months'], statement['gross_salary']) for statement in statements] == [('yearend1', 2, 80000)]
@@ -0,0 +1,237 @@
+# 請假測試：申請的重疊與額度檢查、審核（單筆與批次 API）、請假分錄計入薪資、審核佇列分頁與 API 權限
+
+import pytest
+
+from conftest import add_user
+
+
+def leave_notifications(module, user_id):
+    conn = module.db_manager.get_connection()
+    count = conn.execute('''
+        SELECT COUNT(*) FROM notifications
+        WHERE user_id = ? AND related_object_type = 'leave_application'
+    ''', (user_id,)).fetchone()[0]
+    conn.close()
+    return count
+
+
+def add_admin(module, user_id, role_name='admin'):
+    add_user(module, user_id)
+    module.permission_manager.assign_role(user_id, role_name, 'test')
+    return module.permission_manager.issue_api_token(user_id)
+
+
+def test_approve_leave_only_once(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave1')
+    # 2024-06-03 為週一
+    application_id = leave_mgr.apply_leave('leave1', 1, '2024-06-03', '2024-06-03', '休假')['application_id']
+
+    assert leave_mgr.approve_leave(application_id, 'boss', approved=True)
+    approved_at = payroll.db_manager.get_connection().execute(
+        'SELECT approved_at FROM leave_applications WHERE id = ?', (application_id,)
+    ).fetchone()[0]
+
+    # 已核准的申請不可再核准或改為駁回，額度與通知不重複
+    assert not leave_mgr.approve_leave(application_id, 'boss', approved=True)
+    assert not leave_mgr.approve_leave(application_id, 'boss', approved=False, reject_reason='重複')
+
+    conn = payroll.db_manager.get_connection()
+    status, stored_approved_at = conn.execute(
+        'SELECT status, approved_at FROM leave_applications WHERE id = ?', (application_id,)
+    ).fetchone()
+    conn.close()
+    assert (status, stored_approved_at) == ('approved', approved_at)
+    assert leave_mgr.get_leave_balances('leave1', 2024)[1]['used_hours'] == 8
+    assert leave_notifications(payroll, 'leave1') == 1
+
+
+def test_bulk_approve_api_identifies_approver_by_token(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave2')
+    token = add_admin(payroll, 'approver1', 'manager')
+    application_id = leave_mgr.apply_leave('leave2', 1, '2024-06-04', '2024-06-04', '休假')['application_id']
+    client = payroll.app.test_client()
+
+    # 請求內容中的 approved_by 不能代替金鑰
+    response = client.post('/api/leaves/bulk-approve',
+                           json={'application_ids': [application_id], 'approved_by': 'approver1'})
+    assert response.status_code == 401
+
+    response = client.post('/api/leaves/bulk-approve', json={'application_ids': [application_id]},
+                           headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.get_json()['updated'] == [application_id]
+
+    conn = payroll.db_manager.get_connection()
+    approved_by = conn.execute(
+        'SELECT approved_by FROM leave_applications WHERE id = ?', (application_id,)
+    ).fetchone()[0]
+    conn.close()
+    assert approved_by == 'approver1'
+
+    # 已審核或不存在的申請回傳 409 與逐筆結果
+    response = client.post('/api/leaves/bulk-approve', json={'application_ids': [application_id, 999999]},
+                           headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 409
+    assert response.get_json()['skipped'] == [application_id, 999999]
+
+
+def test_leave_across_new_year_is_charged_to_each_year(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave3')
+    # 2024-12-30、31 為工作日，2025-01-01 為開國紀念日，2025-01-02 為工作日
+    result = leave_mgr.apply_leave('leave3', 1, '2024-12-30', '2025-01-02', '跨年休假')
+
+    assert leave_mgr.get_leave_balances('leave3', 2024)[1]['pending_hours'] == 16
+    assert leave_mgr.get_leave_balances('leave3', 2025)[1]['pending_hours'] == 8
+
+    assert leave_mgr.approve_leave(result['application_id'], 'boss', approved=True)
+
+    balances_2024 = leave_mgr.get_leave_balances('leave3', 2024)[1]
+    balances_2025 = leave_mgr.get_leave_balances('leave3', 2025)[1]
+    assert (balances_2024['pending_hours'], balances_2024['used_hours']) == (0, 16)
+    assert (balances_2025['pending_hours'], balances_2025['used_hours']) == (0, 8)
+
+
+def test_leave_quota_follows_leave_type_setting(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave4')
+    # 2024-06-05 為週三；婚假（id 4）預設 8 天
+    leave_mgr.apply_leave('leave4', 4, '2024-06-05', '2024-06-05', '結婚')
+    assert leave_mgr.get_leave_balance('leave4', 4, 2024) == 8 * 8 - 8
+
+    conn = payroll.db_manager.get_connection()
+    conn.execute('UPDATE leave_types SET max_days_per_year = 10 WHERE id = 4')
+    conn.commit()
+    try:
+        assert leave_mgr.get_leave_balance('leave4', 4, 2024) == 10 * 8 - 8
+        assert leave_mgr.get_leave_balances('leave4', 2024)[4]['quota_hours'] == 80
+    finally:
+        conn.execute('UPDATE leave_types SET max_days_per_year = 8 WHERE id = 4')
+        conn.commit()
+        conn.close()
+
+
+def test_leave_conflicts_with_archived_attendance(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave5')
+    conn = payroll.db_manager.get_connection()
+    # 2023-05-03 為週三
+    for action_type, punch_time in (('clock_in', '2023-05-03T09:00:00'), ('clock_out', '2023-05-03T18:00:00')):
+        conn.execute('''
+            INSERT INTO attendance_records (user_id, record_date, action_type, record_time, taiwan_time, status)
+            VALUES ('leave5', '2023-05-03', ?, ?, ?, 'normal')
+        ''', (action_type, punch_time + '+08:00', punch_time.replace('T', ' ')))
+    conn.commit()
+    conn.close()
+
+    payroll.ArchiveManager(payroll.db_manager).archive_period('attendance_records', 2023, 5)
+
+    # 補請已歸檔期間的假，仍會與歸檔的出勤記錄比對
+    result = leave_mgr.apply_leave('leave5', 1, '2023-05-03', '2023-05-03', '補請假')
+    assert not result['success']
+    assert '出勤' in result['error']
+
+
+def test_unpaid_leave_is_charged_to_each_payroll_month(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave6', 44000)
+    # 2024-10-31（週四）至 11-01（週五）事假（無薪）
+    result = leave_mgr.apply_leave('leave6', 3, '2024-10-31', '2024-11-01', '私事')
+    assert leave_mgr.approve_leave(result['application_id'], 'boss', approved=True)
+
+    conn = payroll.db_manager.get_connection()
+    ledger = conn.execute(
+        "SELECT leave_date, hours, is_paid FROM leave_ledger WHERE user_id = 'leave6' ORDER BY leave_date"
+    ).fetchall()
+    conn.close()
+    assert ledger == [('2024-10-31', 8, 0), ('2024-11-01', 8, 0)]
+
+    for month in (10, 11):
+        payroll_data = payroll.message_handler.payroll_calc.calculate_monthly_payroll('leave6', 2024, month)
+        assert payroll_data['work_data']['unpaid_leave_hours'] == 8
+        assert 0 < payroll_data['calculations']['leave_deduction'] < 44000
+        assert payroll_data['calculations']['base_salary'] == 44000 - payroll_data['calculations']['leave_deduction']
+
+
+def test_overlapping_leave_is_rejected_until_first_is_rejected(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    add_user(payroll, 'leave7')
+    # 2024-07-01 為週一
+    first = leave_mgr.apply_leave('leave7', 1, '2024-07-01', '2024-07-01', '整天')
+
+    result = leave_mgr.apply_leave('leave7', 1, '2024-07-01', '2024-07-01', '時假', '10:00', '12:00')
+    assert not result['success']
+    assert f"#{first['application_id']}" in result['error']
+
+    # 駁回的申請不再占用時段
+    assert leave_mgr.approve_leave(first['application_id'], 'boss', approved=False, reject_reason='人力不足')
+    assert leave_mgr.apply_leave('leave7', 1, '2024-07-01', '2024-07-01', '時假', '10:00', '12:00')['success']
+
+
+def test_approval_queue_pages_through_every_application_once(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    application_ids = []
+    for n in range(5):
+        user_id = f'queue{n}'
+        add_user(payroll, user_id)
+        # 只列出行政部（id 6）的申請，不受其他測試的待審核申請影響
+        conn = payroll.db_manager.get_connection()
+        conn.execute('UPDATE users SET department_id = 6 WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+        application_ids.append(leave_mgr.apply_leave(user_id, 1, '2024-07-02', '2024-07-02', '休假')['application_id'])
+
+    seen = []
+    page_cursor = None
+    while True:
+        page = leave_mgr.get_approval_queue(department_id=6, page_cursor=page_cursor, limit=2)
+        seen.extend(app['id'] for app in page['applications'])
+        page_cursor = page['next_cursor']
+        if not page_cursor:
+            break
+
+    assert seen == sorted(application_ids, reverse=True)
+
+    with pytest.raises(ValueError):
+        leave_mgr.get_approval_queue(page_cursor='not-a-cursor')
+
+
+def test_pending_api_limits_managers_to_their_departments(payroll):
+    leave_mgr = payroll.message_handler.leave_mgr
+    manager_token = add_admin(payroll, 'manager1', 'manager')
+    admin_token = add_admin(payroll, 'admin1')
+    application_ids = {}
+    add_user(payroll, 'leave8')
+    add_user(payroll, 'leave9')
+    conn = payroll.db_manager.get_connection()
+    # leave8 屬技術部（id 5，由 manager1 管理），leave9 屬業務部（id 4）
+    for user_id, department_id in (('leave8', 5), ('leave9', 4)):
+        conn.execute('UPDATE users SET department_id = ? WHERE user_id = ?', (department_id, user_id))
+    conn.execute("UPDATE departments SET manager_id = 'manager1' WHERE id = 5")
+    conn.commit()
+    for user_id in ('leave8', 'leave9'):
+        application_ids[user_id] = leave_mgr.apply_leave(user_id, 1, '2024-07-03', '2024-07-03', '休假')['application_id']
+    client = payroll.app.test_client()
+
+    def pending_ids(token=None, query=''):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = client.get(f'/api/leaves/pending?limit=100{query}', headers=headers)
+        return response.status_code, [app['id'] for app in (response.get_json() or {}).get('applications', [])]
+
+    try:
+        assert pending_ids()[0] == 401
+
+        # 主管只看到自己部門的申請，查詢參數不能改看其他主管的佇列
+        status, ids = pending_ids(manager_token, '&manager_id=someone_else')
+        assert status == 200
+        assert application_ids['leave8'] in ids and application_ids['leave9'] not in ids
+
+        status, ids = pending_ids(admin_token)
+        assert status == 200
+        assert set(application_ids.values()) <= set(ids)
+    finally:
+        conn.execute('UPDATE departments SET manager_id = NULL WHERE id = 5')
+        conn.commit()
+        conn.close()
@@ -0,0 +1,61 @@
+# 通知派送測試：派送前先取走（sending）整批通知，同一則通知只送出一次；中斷而停留的通知逾時後重送
+
+from conftest import add_user
+
+
+class RecordingLineApi:
+    def __init__(self):
+        self.recipients = []
+
+    def push_message(self, user_id, message):
+        self.recipients.append(user_id)
+
+    def multicast(self, user_ids, message):
+        self.recipients.extend(user_ids)
+
+
+def enqueue(module, user_id):
+    add_user(module, user_id)
+    module.message_handler.notifier.enqueue(user_id, '測試通知', f'給 {user_id} 的通知', 'info')
+
+
+def delivery_status(module, user_id):
+    conn = module.db_manager.get_connection()
+    row = conn.execute('SELECT delivery_status, attempts FROM notifications WHERE user_id = ?', (user_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_claimed_notifications_are_not_sent_by_another_dispatcher(payroll):
+    enqueue(payroll, 'notify1')
+    first = payroll.NotificationDispatcher(payroll.db_manager, RecordingLineApi(), requests_per_second=0)
+    second = payroll.NotificationDispatcher(payroll.db_manager, RecordingLineApi(), requests_per_second=0)
+
+    # 第一個派送程序取走整批後、送出前，第二個派送程序看不到這些通知
+    conn = payroll.db_manager.get_connection()
+    first._claim_batch(conn.cursor())
+    conn.commit()
+    conn.close()
+    assert delivery_status(payroll, 'notify1')[0] == 'sending'
+
+    second.dispatch_once()
+    assert 'notify1' not in second.line_api.recipients
+
+
+def test_stuck_sending_notifications_are_retried(payroll):
+    enqueue(payroll, 'notify2')
+    dispatcher = payroll.NotificationDispatcher(payroll.db_manager, RecordingLineApi(), requests_per_second=0)
+
+    # 模擬派送程序在送出期間中斷：停在 sending 且已超過時限
+    conn = payroll.db_manager.get_connection()
+    conn.execute('''
+        UPDATE notifications SET delivery_status = 'sending', claimed_at = datetime('now', '-1 hour')
+        WHERE user_id = 'notify2'
+    ''')
+    conn.commit()
+    conn.close()
+
+    dispatcher.dispatch_once()
+
+    assert dispatcher.line_api.recipients.count('notify2') == 1
+    assert delivery_status(payroll, 'notify2') == ('sent', 2)
@@ -0,0 +1,74 @@
+# 轉帳批次測試：銀行代碼或帳號格式不符的記錄不截斷寫入，列為未轉帳並保留待發放狀態；提交後的通知失敗不影響批次
+
+import io
+
+import pytest
+
+from conftest import add_user
+
+
+def add_confirmed_payroll(module, user_id, net_salary, bank_code, account_number, month=8):
+    add_user(module, user_id)
+    conn = module.db_manager.get_connection()
+    conn.execute('''
+        INSERT INTO payroll_records (user_id, period_year, period_month, net_salary, status)
+        VALUES (?, 2024, ?, ?, 'confirmed')
+    ''', (user_id, month, net_salary))
+    conn.execute('''
+        INSERT INTO employee_bank_accounts (user_id, bank_code, account_number)
+        VALUES (?, ?, ?)
+    ''', (user_id, bank_code, account_number))
+    conn.commit()
+    conn.close()
+
+
+def test_payment_batch_rejects_overlong_bank_code(payroll):
+    add_confirmed_payroll(payroll, 'pay1', 40000, '0040012', '123456789012')
+    add_confirmed_payroll(payroll, 'pay2', 35000, '00400123', '223456789012')
+
+    output = io.BytesIO()
+    summary = payroll.PaymentBatchGenerator(payroll.db_manager).generate(2024, 8, output, paid_by='hr')
+
+    detail_lines = [line for line in output.getvalue().split(b'\r\n') if line.startswith(b'D')]
+    assert summary['record_count'] == 1
+    assert summary['total_amount'] == 40000
+    assert len(detail_lines) == 1 and detail_lines[0][7:14] == b'0040012'
+    assert [(missing['user_id'], missing['reason']) for missing in summary['missing_accounts']] == [
+        ('pay2', '銀行代碼須為 7 位數字')
+    ]
+
+    conn = payroll.db_manager.get_connection()
+    statuses = dict(conn.execute(
+        "SELECT user_id, status FROM payroll_records WHERE user_id IN ('pay1', 'pay2')"
+    ).fetchall())
+    conn.close()
+    assert statuses == {'pay1': 'paid', 'pay2': 'confirmed'}
+
+
+def test_fixed_width_text_is_not_truncated(payroll):
+    generator = payroll.PaymentBatchGenerator(payroll.db_manager)
+
+    with pytest.raises(ValueError):
+        generator._fixed('00400123', 7, 'cp950')
+    assert generator._fixed('王大明' * 10, 40, 'cp950', truncate=True) == ('王大明' * 10).encode('cp950')[:40]
+
+
+def test_payment_batch_survives_publish_failure_after_commit(payroll, monkeypatch):
+    add_confirmed_payroll(payroll, 'pay3', 30000, '0040012', '323456789012', month=12)
+
+    def broken_publish(event, data=None):
+        if data and data.get('done'):
+            raise RuntimeError('event bus down')
+
+    # 完成事件在記錄提交後才發布；發布失敗不可讓呼叫端誤以為批次失敗而捨棄轉帳檔
+    monkeypatch.setattr(payroll.event_bus, 'publish', broken_publish)
+    output = io.BytesIO()
+    summary = payroll.PaymentBatchGenerator(payroll.db_manager).generate(2024, 12, output, paid_by='hr')
+
+    assert summary['record_count'] == 1 and summary['batch_id']
+    assert output.getvalue().count(b'\r\nD') == 1
+
+    conn = payroll.db_manager.get_connection()
+    status = conn.execute("SELECT status FROM payroll_records WHERE user_id = 'pay3'").fetchone()[0]
+    conn.close()
+    assert status == 'paid'
@@ -0,0 +1,62 @@
+# 薪資明細測試：扣款明細、年度彙總與統計立方體的扣款合計需與薪資記錄一致；統計立方體 API 需薪資權限
+
+import json
+
+from conftest import add_user
+
+
+def test_deduction_details_match_total_deductions(payroll):
+    add_user(payroll, 'detail1', 45000, union_fee=300, loan_deduction=1000, other_deductions=50)
+    add_user(payroll, 'detail2', 32000)
+
+    for user_id in ('detail1', 'detail2'):
+        payroll.message_handler.payroll_calc.calculate_monthly_payroll(user_id, 2024, 5)
+
+    conn = payroll.db_manager.get_connection()
+    records = dict(conn.execute('''
+        SELECT user_id, total_deductions FROM payroll_records
+        WHERE period_year = 2024 AND period_month = 5
+    ''').fetchall())
+    details = dict(conn.execute('''
+        SELECT pr.user_id, SUM(pd.amount) FROM payroll_details pd
+        JOIN payroll_records pr ON pr.id = pd.payroll_record_id
+        WHERE pr.period_year = 2024 AND pr.period_month = 5 AND pd.item_category = 'deduction'
+        GROUP BY pr.user_id
+    ''').fetchall())
+    rollup_items = json.loads(conn.execute(
+        "SELECT deduction_items FROM payroll_year_rollups WHERE user_id = 'detail1' AND period_year = 2024"
+    ).fetchone()[0])
+    cube = payroll.PayrollRepository(None).query_cube(
+        conn.cursor(), 202405, 202405, group_by=('item_name',), item_category='deduction'
+    )
+    conn.close()
+    cube_items = {row['item_name']: row['amount'] for row in cube}
+
+    assert details == records
+    assert rollup_items['工會費'] == 300
+    assert rollup_items['借支扣款'] == 1000
+    assert rollup_items['其他扣款'] == 50
+    assert sum(rollup_items.values()) == records['detail1']
+    assert cube_items['工會費'] == 300
+    assert sum(cube_items.values()) == sum(records.values())
+
+
+def test_cube_api_requires_payroll_permission(payroll):
+    add_user(payroll, 'cubehr')
+    add_user(payroll, 'cubestaff')
+    payroll.permission_manager.assign_role('cubehr', 'hr', 'test')
+    payroll.permission_manager.assign_role('cubestaff', 'employee', 'test')
+    client = payroll.app.test_client()
+
+    def get_cube(user_id=None):
+        headers = {}
+        if user_id:
+            headers['Authorization'] = f'Bearer {payroll.permission_manager.issue_api_token(user_id)}'
+        return client.get('/api/payroll/cube?from=2024-05&group_by=item_category', headers=headers)
+
+    assert get_cube().status_code == 401
+    assert get_cube('cubestaff').status_code == 403
+
+    response = get_cube('cubehr')
+    assert response.status_code == 200
+    assert response.get_json()['success']
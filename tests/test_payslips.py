@@ -0,0 +1,27 @@
+# 薪資單封存測試：分批讀取、程序池產生的 zip 與單一程序依序產生的內容相同
+
+import io
+import zipfile
+
+from conftest import add_user
+
+
+def read_zip(module, processes):
+    output = io.BytesIO()
+    count = module.PayslipArchive(module.db_manager, processes=processes, chunk_size=1).write_zip(2024, 9, output)
+    with zipfile.ZipFile(io.BytesIO(output.getvalue())) as archive:
+        return count, {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_process_pool_matches_sequential_rendering(payroll):
+    for user_id, base_salary in (('slip1', 36000), ('slip2', 52000)):
+        add_user(payroll, user_id, base_salary, union_fee=200)
+        payroll.message_handler.payroll_calc.calculate_monthly_payroll(user_id, 2024, 9)
+
+    count, sequential = read_zip(payroll, processes=1)
+    pooled_count, pooled = read_zip(payroll, processes=2)
+
+    assert count == pooled_count == 2
+    assert sorted(sequential) == ['202409_SLIP1_slip1.pdf', '202409_SLIP2_slip2.pdf']
+    assert pooled == sequential
+    assert all(pdf.startswith(b'%PDF-1.4') and pdf.rstrip().endswith(b'%%EOF') for pdf in pooled.values())
@@ -0,0 +1,92 @@
+# 資料存取層測試：舊版 attendance.db 搬移（可續跑、略過格式錯誤的打卡）與打卡時間 epoch 回填
+
+import sqlite3
+
+from contextlib import contextmanager
+
+from payroll_repository import AttendanceRepository, ensure_punch_epochs, migrate_attendance_db
+
+
+def create_legacy_db(path, punches):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT UNIQUE, name TEXT,
+            status TEXT DEFAULT 'active', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE attendance_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, action_type TEXT,
+            taiwan_time TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.executemany('INSERT INTO users (user_id, name) VALUES (?, ?)',
+                     sorted({(user_id, user_id) for user_id, _, _ in punches}))
+    conn.executemany('INSERT INTO attendance_records (user_id, action_type, taiwan_time) VALUES (?, ?, ?)', punches)
+    conn.commit()
+    conn.close()
+
+
+def test_migrate_attendance_db_converts_punches_and_resumes(payroll, tmp_path):
+    source = tmp_path / 'attendance.db'
+    create_legacy_db(source, [
+        ('legacy1', '上班', '2024-04-01 22:00:00'),
+        ('legacy1', '下班', '2024-04-02 06:00:00'),
+        ('legacy1', '上班', 'not a time'),
+    ])
+
+    conn = payroll.db_manager.get_connection()
+    try:
+        moved = migrate_attendance_db(str(source), conn, chunk_size=2)
+        rows = conn.execute('''
+            SELECT record_date, action_type, record_time FROM attendance_records
+            WHERE user_id = 'legacy1' ORDER BY record_time
+        ''').fetchall()
+
+        # 重跑只處理上次位置之後的資料
+        rerun = migrate_attendance_db(str(source), conn, chunk_size=2)
+    finally:
+        conn.close()
+
+    assert moved['attendance_records'] == 2
+    assert moved['attendance_records_skipped'] == 1
+    assert rows == [
+        ('2024-04-01', 'clock_in', '2024-04-01T22:00:00+08:00'),
+        ('2024-04-02', 'clock_out', '2024-04-02T06:00:00+08:00'),
+    ]
+    assert rerun['attendance_records'] == 0
+
+
+def test_punch_epochs_backfill_and_range_query(tmp_path):
+    path = tmp_path / 'attendance.db'
+    create_legacy_db(path, [
+        ('epoch1', '上班', '2024-04-30 22:00:00'),
+        ('epoch1', '下班', '2024-05-01 06:00:00'),
+        ('epoch1', '上班', '2024-05-02 09:00:00'),
+    ])
+    conn = sqlite3.connect(path)
+
+    @contextmanager
+    def session():
+        yield conn
+
+    try:
+        assert ensure_punch_epochs(conn, chunk_size=2) == 3
+        assert ensure_punch_epochs(conn) == 0
+
+        # 只寫入 taiwan_time 的舊程式新增記錄時，由觸發器補上 punch_epoch
+        conn.execute("INSERT INTO attendance_records (user_id, action_type, taiwan_time) VALUES ('epoch1', '下班', '2024-05-02 18:00:00')")
+        conn.commit()
+        punch_dates = conn.execute('SELECT punch_date FROM attendance_records ORDER BY id').fetchall()
+
+        punches = list(AttendanceRepository(session).iter_punches('epoch1', '2024-05-01', '2024-05-02'))
+    finally:
+        conn.close()
+
+    assert punch_dates == [('2024-04-30',), ('2024-05-01',), ('2024-05-02',), ('2024-05-02',)]
+    assert [(action_type, punch_time.isoformat()) for action_type, punch_time in punches] == [
+        ('clock_out', '2024-05-01T06:00:00'),
+        ('clock_in', '2024-05-02T09:00:00'),
+        ('clock_out', '2024-05-02T18:00:00'),
+    ]
@@ -0,0 +1,40 @@
+# 統計快取測試：資料類別失效後重新計算，ETag 相符時回傳 304
+
+from stats_cache import StatsCache
+
+
+def test_invalidate_recomputes_only_dependent_entries():
+    counts = {'leave': 0, 'payroll': 0}
+
+    def counter(key):
+        def compute():
+            counts[key] += 1
+            return {key: counts[key]}
+        return compute
+
+    cache = StatsCache(ttl=60)
+    cache.register('leave_stats', counter('leave'), topics=('leave',))
+    cache.register('payroll_stats', counter('payroll'), topics=('payroll',))
+
+    first, first_etag = cache.get('leave_stats')
+    cache.get('payroll_stats')
+    assert cache.get('leave_stats') == (first, first_etag)
+
+    cache.invalidate('leave')
+    second, second_etag = cache.get('leave_stats')
+    cache.get('payroll_stats')
+
+    assert second == {'leave': 2} and second_etag != first_etag
+    assert counts['payroll'] == 1
+
+
+def test_system_stats_returns_304_for_matching_etag(payroll):
+    client = payroll.app.test_client()
+
+    response = client.get('/api/system/stats')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    response = client.get('/api/system/stats', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
@@ -0,0 +1,64 @@
+# 工時計算測試：跨午夜班別的加班判斷、跨月打卡異常統計與加班申請對應
+
+from conftest import add_user
+
+
+def add_punches(module, user_id, punches):
+    add_user(module, user_id)
+    conn = module.db_manager.get_connection()
+    for action_type, punch_time in punches:
+        conn.execute('''
+            INSERT INTO attendance_records (user_id, record_date, action_type, record_time, taiwan_time, status)
+            VALUES (?, ?, ?, ?, ?, 'normal')
+        ''', (user_id, punch_time[:10], action_type, punch_time + '+08:00', punch_time.replace('T', ' ')))
+    conn.commit()
+    conn.close()
+
+
+def test_overnight_shift_pays_overtime_beyond_eight_hours(payroll):
+    # 2024-03-04 為週一，18:00 上班至次日 06:00 下班共 12 小時
+    add_punches(payroll, 'night1', [('clock_in', '2024-03-04T18:00:00'), ('clock_out', '2024-03-05T06:00:00')])
+
+    work_data = payroll.message_handler.attendance_mgr.calculate_work_hours('night1', 2024, 3)
+
+    assert work_data['total_hours'] == 12
+    assert work_data['regular_hours'] == 8
+    assert work_data['overtime_hours'] == 4
+    assert work_data['daily_hours'] == {'2024-03-04': 12}
+    assert work_data['night_shift_hours'] == 8
+
+
+def test_anomalies_outside_month_are_not_counted(payroll):
+    # 前一個月最後一天的漏打上班，只為配對跨月班別而讀入，不計入三月的異常
+    add_punches(payroll, 'night2', [
+        ('clock_out', '2024-02-29T18:00:00'),
+        ('clock_in', '2024-03-01T09:00:00'),
+        ('clock_out', '2024-03-01T17:00:00'),
+        ('clock_out', '2024-03-02T10:00:00'),
+    ])
+
+    work_data = payroll.message_handler.attendance_mgr.calculate_work_hours('night2', 2024, 3)
+
+    assert work_data['total_hours'] == 8
+    assert work_data['punch_anomalies']['orphan_clock_out'] == 1
+
+
+def test_approved_rest_day_overtime_is_paid_at_its_type(payroll):
+    # 2024-03-09 為週六，出勤 6 小時，其中 4 小時有核准的休息日加班申請
+    add_punches(payroll, 'overtime1', [('clock_in', '2024-03-09T09:00:00'), ('clock_out', '2024-03-09T15:00:00')])
+    conn = payroll.db_manager.get_connection()
+    conn.execute('''
+        INSERT INTO overtime_applications
+        (user_id, overtime_date, start_time, end_time, total_hours, overtime_type, status)
+        VALUES ('overtime1', '2024-03-09', '09:00', '13:00', 4, 'weekend', 'approved')
+    ''')
+    conn.commit()
+    conn.close()
+
+    work_data = payroll.message_handler.attendance_mgr.calculate_work_hours('overtime1', 2024, 3)
+
+    assert work_data['overtime_by_type'] == {'weekday': 0, 'weekend': 4, 'holiday': 0}
+    assert work_data['approved_overtime_hours'] == 4
+    assert work_data['unapproved_overtime_hours'] == 2
+    # 未申請的休息日時數在不需核准時以休息日出勤計
+    assert work_data['weekend_hours'] == 2